@@ -0,0 +1,178 @@
+import asyncio
+import contextlib
+import math
+import os
+import threading
+import time
+
+
+# Concurrent upstream calls allowed per model, with per model overrides as "model=limit,model=limit"
+model_max_concurrency = int(os.environ.get("MODEL_MAX_CONCURRENCY", 10))
+model_concurrency_overrides = os.environ.get("MODEL_CONCURRENCY_LIMITS", "")
+# Requests allowed to wait for a slot per model, and how long they wait before being turned away
+model_max_queue = int(os.environ.get("MODEL_MAX_QUEUE", 20))
+queue_timeout_seconds = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 5))
+
+
+def parse_concurrency_overrides(overrides):
+    limits = {}
+    for item in overrides.split(","):
+        if "=" not in item:
+            continue
+        name, limit = item.split("=", 1)
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+concurrency_limits = parse_concurrency_overrides(model_concurrency_overrides)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a model is at capacity and its queue is full, or the queue timeout expired.
+    """
+
+    status_code = 429
+
+    def __init__(self, model_name, reason):
+        super().__init__(f"Model {model_name} is over capacity: {reason}")
+        self.model_name = model_name
+        self.retry_after = max(1, math.ceil(queue_timeout_seconds))
+
+
+class _AdmissionStats:
+    def __init__(self, model_name, max_concurrency, max_queue):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": self.wait_seconds_total,
+        }
+
+
+class AdmissionController(_AdmissionStats):
+    """
+    Limits the concurrent upstream calls for one model, with a bounded queue of waiting requests.
+    """
+
+    def __init__(self, model_name, max_concurrency, max_queue):
+        super().__init__(model_name, max_concurrency, max_queue)
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def admit(self):
+        start = time.monotonic()
+        with self._condition:
+            if self.in_flight >= self.max_concurrency:
+                if self.queued >= self.max_queue:
+                    self.rejected += 1
+                    raise AdmissionRejected(self.model_name, "queue is full")
+
+                self.queued += 1
+                try:
+                    has_slot = self._condition.wait_for(lambda: self.in_flight < self.max_concurrency, timeout=queue_timeout_seconds)
+                finally:
+                    self.queued -= 1
+                if not has_slot:
+                    self.timed_out += 1
+                    raise AdmissionRejected(self.model_name, "timed out waiting in queue")
+
+            self.in_flight += 1
+            self.admitted += 1
+            self.wait_seconds_total += time.monotonic() - start
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+
+class AsyncAdmissionController(_AdmissionStats):
+    """
+    Async version of AdmissionController, for the ASGI app.
+    """
+
+    def __init__(self, model_name, max_concurrency, max_queue):
+        super().__init__(model_name, max_concurrency, max_queue)
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        start = time.monotonic()
+        async with self._condition:
+            if self.in_flight >= self.max_concurrency:
+                if self.queued >= self.max_queue:
+                    self.rejected += 1
+                    raise AdmissionRejected(self.model_name, "queue is full")
+
+                self.queued += 1
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self.in_flight < self.max_concurrency),
+                        timeout=queue_timeout_seconds,
+                    )
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    raise AdmissionRejected(self.model_name, "timed out waiting in queue")
+                finally:
+                    self.queued -= 1
+
+            self.in_flight += 1
+            self.admitted += 1
+            self.wait_seconds_total += time.monotonic() - start
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+
+_controllers = {}
+_async_controllers = {}
+_lock = threading.Lock()
+
+
+def _get_controller(controllers, controller_class, model_name):
+    controller = controllers.get(model_name)
+    if controller is None:
+        with _lock:
+            controller = controllers.get(model_name)
+            if controller is None:
+                max_concurrency = concurrency_limits.get(model_name, model_max_concurrency)
+                controller = controllers[model_name] = controller_class(model_name, max_concurrency, model_max_queue)
+    return controller
+
+
+def admit(model_name):
+    return _get_controller(_controllers, AdmissionController, model_name).admit()
+
+
+def admit_async(model_name):
+    return _get_controller(_async_controllers, AsyncAdmissionController, model_name).admit()
+
+
+def admission_stats():
+    return {
+        model_name: controller.stats()
+        for controllers in (_controllers, _async_controllers)
+        for model_name, controller in list(controllers.items())
+    }
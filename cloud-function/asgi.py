@@ -0,0 +1,377 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from admission import admission_stats
+from circuit_breaker import circuit_stats
+from client_pool import aclose_clients
+from metrics import get_metrics, instrument_route_async, time_stage
+from main import (
+    REJECTED_ERRORS,
+    batch_max_parallelism,
+    check_request_preconditions,
+    check_signed_body,
+    format_sse_event,
+    gemini_generate_async_with_model,
+    gemini_generate_stream_async,
+    get_batch_item_error,
+    get_batch_item_rejection,
+    get_batch_item_result,
+    get_batch_item_timeout,
+    get_liveness,
+    get_model_response_headers,
+    get_readiness,
+    get_rejected_response,
+    get_response_headers,
+    get_stream_headers,
+    max_request_bytes,
+    parse_signed_body,
+    run_warm_up,
+    stream_heartbeat_seconds,
+    validate_batch_request,
+    validate_generate_request,
+    warm_up_on_start,
+)
+from prompt_registry import prompt_registry
+from region_router import region_stats
+from retry import get_deadline, remaining_seconds
+from response_cache import response_cache
+from tracing import start_span, trace_route_async
+
+
+async def read_body(request):
+    """
+    Reads the raw body of an ASGI request once, at most max_request_bytes of it,
+    unless the request can be turned away without it. Returns the body, or an error response tuple.
+    """
+    content_length = request.headers.get("Content-Length")
+    try:
+        content_length = int(content_length) if content_length is not None else None
+    except ValueError:
+        return None, ({"error": "Invalid Content-Length"}, 400)
+    error_response = check_request_preconditions(request.headers.get("X-Signature"), content_length)
+    if error_response:
+        return None, error_response
+
+    request_data = bytearray()
+    with time_stage("ingest"):
+        async for chunk in request.stream():
+            request_data += chunk
+            # Stop reading once the body is known to be too large
+            if len(request_data) > max_request_bytes:
+                break
+
+    return bytes(request_data), None
+
+
+async def ingest_request(request):
+    """
+    Reads the raw body of an ASGI request and returns the parsed JSON only if the signature matches.
+    """
+    request_data, error_response = await read_body(request)
+    if error_response:
+        return None, error_response
+    return parse_signed_body(request.headers.get("X-Signature"), request_data)
+
+
+async def check_signature(request):
+    """
+    Checks the signature of an ASGI request to one of SIGNED_STATUS_PATHS. Returns an error response tuple, or None.
+    """
+    request_data, error_response = await read_body(request)
+    if error_response:
+        return error_response
+    return check_signed_body(request.headers.get("X-Signature"), request_data)
+
+
+def signature_required(endpoint):
+    """
+    Answers an ASGI request to a route without a JSON body only if it is signed.
+    """
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        error_response = await check_signature(request)
+        if error_response:
+            return JSONResponse(*error_response)
+        return await endpoint(request)
+    return wrapper
+
+
+async def load_prompt_registry():
+    """
+    Loads the prompt registry on a thread the first time, as its loaders read files or BigQuery.
+    Later reloads already run in the background.
+    """
+    if not prompt_registry.is_loaded():
+        await asyncio.to_thread(prompt_registry.load_once)
+
+
+async def read_generate_request(request, default_model_name):
+    """
+    Checks the signature of a /generate_content style ASGI request, then parses and validates it.
+    Returns the gemini_generate keyword arguments, or an error response tuple.
+    """
+    incoming_request, error_response = await ingest_request(request)
+    if error_response:
+        return None, error_response
+
+    await load_prompt_registry()
+    with start_span("validation"):
+        return validate_generate_request(incoming_request, default_model_name)
+
+
+async def read_batch_request(request, default_model_name):
+    """
+    Checks the signature of a /batch_generate_content ASGI request, then parses and validates it.
+    One signature covers the whole batch.
+    """
+    incoming_request, error_response = await ingest_request(request)
+    if error_response:
+        return None, error_response
+
+    await load_prompt_registry()
+    with start_span("validation"):
+        return validate_batch_request(incoming_request, default_model_name)
+
+
+async def gemini_generate_batch(batch_items):
+    """
+    Runs the batch with at most batch_max_parallelism concurrent generations,
+    returning one result per request in the order of the batch.
+    The requests share the time budget of the HTTP request, so the ones that start after it ran out fail with a 504.
+    """
+    deadline = get_deadline()
+    semaphore = asyncio.Semaphore(batch_max_parallelism)
+
+    async def generate_batch_item(batch_item):
+        generate_args, error_response = batch_item
+        if error_response:
+            return get_batch_item_error(error_response)
+
+        async with semaphore:
+            if remaining_seconds(deadline) == 0:
+                return get_batch_item_timeout()
+            try:
+                response_parts, answered_model, usage = await gemini_generate_async_with_model(**generate_args, deadline=deadline)
+                return get_batch_item_result(response_parts, answered_model, usage, generate_args["session_id"])
+            except REJECTED_ERRORS as e:
+                return get_batch_item_rejection(e)
+            except Exception as e:
+                return {"status": 500, "error": str(e)}
+
+    return await asyncio.gather(*[generate_batch_item(batch_item) for batch_item in batch_items])
+
+
+async def stream_events(events):
+    """
+    Formats the async generator from gemini_generate_stream_async as Server-Sent Events,
+    sending a heartbeat comment whenever no event has been produced for stream_heartbeat_seconds.
+    Returns once the first event is ready, raising the error the generator failed with before it, like stream_events in main.py.
+    """
+    # The response is streamed after the endpoint has returned, so the request's context is captured now
+    body = _stream_events(events, contextvars.copy_context())
+    await anext(body)
+    return body
+
+
+async def _stream_events(events, context):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=1)
+
+    # The generator runs in one task, so each of its steps sees the context vars set by the ones before,
+    # like the span it is in
+    async def produce():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await events.aclose()
+        await queue.put(None)
+
+    producer = context.run(loop.create_task, produce())
+    next_event = loop.create_task(queue.get())
+    try:
+        event = await next_event
+        if isinstance(event, Exception):
+            raise event
+        # The first event is ready, so stream_events returns
+        yield None
+
+        while event is not None:
+            # Once the response has started, an error can only be sent as an event
+            yield format_sse_event("error", {"error": str(event)}) if isinstance(event, Exception) else format_sse_event(*event)
+            next_event = loop.create_task(queue.get())
+            while True:
+                done, _ = await asyncio.wait({next_event}, timeout=stream_heartbeat_seconds)
+                if done:
+                    break
+                yield ": heartbeat\n\n"
+            event = next_event.result()
+    finally:
+        next_event.cancel()
+        # The client went away before the stream finished
+        if not producer.done():
+            producer.cancel()
+            with contextlib.suppress(BaseException):
+                await producer
+
+
+@trace_route_async("/generate_content")
+@instrument_route_async("/generate_content")
+async def generate_content(request):
+    if request.method == "OPTIONS":
+        return Response("", 204, get_response_headers(request))
+
+    try:
+        generate_args, error_response = await read_generate_request(request, "gemini-2.0-flash-exp")
+        if error_response:
+            return JSONResponse(*error_response)
+
+        response_text, answered_model, usage = await gemini_generate_async_with_model(**generate_args)
+        with time_stage("serialization"):
+            return JSONResponse(response_text, 200, get_model_response_headers(request, answered_model, generate_args["session_id"], usage))
+    except REJECTED_ERRORS as e:
+        return JSONResponse(*get_rejected_response(request, e))
+    except Exception as e:
+        logging.error(f"Error in generate_content route: {str(e)}", exc_info=True)
+        return JSONResponse({"error": str(e)}, 500, get_response_headers(request))
+
+
+@trace_route_async("/stream_generate_content")
+@instrument_route_async("/stream_generate_content")
+async def stream_generate_content(request):
+    if request.method == "OPTIONS":
+        return Response("", 204, get_response_headers(request))
+
+    try:
+        generate_args, error_response = await read_generate_request(request, "gemini-2.0-flash-exp")
+        if error_response:
+            return JSONResponse(*error_response)
+
+        events = gemini_generate_stream_async(**generate_args)
+        return StreamingResponse(await stream_events(events), 200, get_stream_headers(request, generate_args["session_id"]), media_type="text/event-stream")
+    except REJECTED_ERRORS as e:
+        return JSONResponse(*get_rejected_response(request, e))
+    except Exception as e:
+        logging.error(f"Error in stream_generate_content route: {str(e)}", exc_info=True)
+        return JSONResponse({"error": str(e)}, 500, get_response_headers(request))
+
+
+@trace_route_async("/batch_generate_content")
+@instrument_route_async("/batch_generate_content")
+async def batch_generate_content(request):
+    if request.method == "OPTIONS":
+        return Response("", 204, get_response_headers(request))
+
+    try:
+        batch_items, error_response = await read_batch_request(request, "gemini-2.0-flash-exp")
+        if error_response:
+            return JSONResponse(*error_response)
+
+        batch_results = await gemini_generate_batch(batch_items)
+        with time_stage("serialization"):
+            return JSONResponse(batch_results, 200, get_response_headers(request))
+    except REJECTED_ERRORS as e:
+        return JSONResponse(*get_rejected_response(request, e))
+    except Exception as e:
+        logging.error(f"Error in batch_generate_content route: {str(e)}", exc_info=True)
+        return JSONResponse({"error": str(e)}, 500, get_response_headers(request))
+
+
+@signature_required
+async def get_admission_stats(request):
+    return JSONResponse(admission_stats(), 200, get_response_headers(request))
+
+
+@signature_required
+async def get_circuit_stats(request):
+    return JSONResponse(circuit_stats(), 200, get_response_headers(request))
+
+
+@signature_required
+async def get_region_stats(request):
+    return JSONResponse(region_stats(), 200, get_response_headers(request))
+
+
+@signature_required
+async def cache_stats(request):
+    return JSONResponse(response_cache.stats(), 200, get_response_headers(request))
+
+
+@signature_required
+async def metrics(request):
+    body, content_type = get_metrics()
+    return Response(body, 200, media_type=content_type)
+
+
+@signature_required
+async def warmup(request):
+    status, status_code = await asyncio.to_thread(run_warm_up)
+    return JSONResponse(status, status_code, get_response_headers(request))
+
+
+async def readiness(request):
+    status, status_code = get_readiness()
+    return JSONResponse(status, status_code, get_response_headers(request))
+
+
+async def liveness(request):
+    status, status_code = get_liveness()
+    return JSONResponse(status, status_code, get_response_headers(request))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # The server only accepts connections once startup is done, so no request pays for the warm-up
+    if warm_up_on_start:
+        await asyncio.to_thread(run_warm_up)
+    await load_prompt_registry()
+    yield
+    await aclose_clients()
+
+
+# ASGI app for running under uvicorn or any other ASGI server
+def create_asgi_app():
+    return Starlette(
+        routes=[
+            Route("/generate_content", generate_content, methods=["POST", "OPTIONS"]),
+            Route("/stream_generate_content", stream_generate_content, methods=["POST", "OPTIONS"]),
+            Route("/batch_generate_content", batch_generate_content, methods=["POST", "OPTIONS"]),
+            Route("/admission_stats", get_admission_stats, methods=["GET"]),
+            Route("/circuit_stats", get_circuit_stats, methods=["GET"]),
+            Route("/region_stats", get_region_stats, methods=["GET"]),
+            Route("/cache_stats", cache_stats, methods=["GET"]),
+            Route("/metrics", metrics, methods=["GET"]),
+            Route("/warmup", warmup, methods=["GET", "POST"]),
+            Route("/readiness", readiness, methods=["GET"]),
+            Route("/liveness", liveness, methods=["GET"]),
+        ],
+        middleware=[Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["POST", "OPTIONS"],
+            allow_headers=["Content-Type", "X-Signature"],
+            expose_headers=["X-Model-Name", "X-Session-Id", "X-Prompt-Token-Count", "X-Cached-Token-Count", "Retry-After"],
+        )],
+        lifespan=lifespan,
+    )
+
+
+app = create_asgi_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
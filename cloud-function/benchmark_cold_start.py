@@ -0,0 +1,140 @@
+"""
+Cold start benchmark for the Cloud Function.
+
+Measures, in fresh processes:
+- the import time of main.py and of each module it imports, from python -X importtime
+- the time from starting functions_framework until it listens, and until it answers its first
+  /generate_content request against the offline Vertex AI stand-in, with and without the warm-up
+
+    python benchmark_cold_start.py --runs 5 --output cold_start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmark_load import (
+    AUTH_TOKEN,
+    SOURCE_DIR,
+    get_free_port,
+    get_git_commit,
+    get_payload,
+    sign,
+    start_backend,
+    start_fake_vertex,
+    wait_for_port,
+)
+
+
+def parse_import_times(output):
+    """
+    Returns the cumulative import time in microseconds of main and of each module main imports directly.
+    """
+    times = {}
+    lines = [line for line in output.splitlines() if line.startswith("import time:") and "|" in line]
+    for line in lines:
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        # Nesting is shown with two spaces per level; modules imported by main are one level in
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if depth <= 1:
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure_imports(runs):
+    samples = {}
+    env = {**os.environ, "VERTEX_CF_AUTH_TOKEN": AUTH_TOKEN, "WARM_UP_ON_START": "0"}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], env=env, cwd=SOURCE_DIR, capture_output=True, text=True, check=True).stderr
+        for name, microseconds in parse_import_times(output).items():
+            samples.setdefault(name, []).append(microseconds)
+
+    median_ms = {name: statistics.median(values) / 1000 for name, values in samples.items()}
+    return dict(sorted(median_ms.items(), key=lambda item: item[1], reverse=True))
+
+
+def measure_first_request(vertex_port, warm_up):
+    """
+    Starts functions_framework and returns the seconds until it listens, and until its first answer.
+    """
+    port = get_free_port()
+    start = time.perf_counter()
+    backend = start_backend("functions_framework", port, vertex_port, {"WARM_UP_ON_START": "1" if warm_up else "0"})
+    try:
+        wait_for_port(port, timeout=60)
+        request_start = time.perf_counter()
+
+        body = json.dumps(get_payload(0)).encode()
+        response = httpx.post(
+            f"http://127.0.0.1:{port}/generate_content",
+            content=body,
+            headers={"Content-Type": "application/json", "X-Signature": sign(body)},
+            timeout=60,
+        )
+        response.raise_for_status()
+        end = time.perf_counter()
+        return {
+            "listening_seconds": request_start - start,
+            "first_response_seconds": end - start,
+            "first_request_seconds": end - request_start,
+        }
+    finally:
+        backend.terminate()
+        backend.wait(timeout=10)
+
+
+def measure_first_requests(runs, vertex_latency):
+    vertex_port = get_free_port()
+    fake_vertex = start_fake_vertex(vertex_port, vertex_latency, 0)
+    try:
+        wait_for_port(vertex_port)
+        results = {}
+        for warm_up in (False, True):
+            samples = [measure_first_request(vertex_port, warm_up) for _ in range(runs)]
+            results["warm_up" if warm_up else "no_warm_up"] = {
+                key: statistics.median(sample[key] for sample in samples)
+                for key in samples[0]
+            }
+        return results
+    finally:
+        fake_vertex.terminate()
+        fake_vertex.wait(timeout=10)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement, the median is reported")
+    parser.add_argument("--vertex-latency", default="fixed:200", help="latency of the stand-in, see fake_vertex.py")
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+
+    import_ms = measure_imports(args.runs)
+    for name, milliseconds in list(import_ms.items())[:15]:
+        print(f"{name:<32} {milliseconds:>8.1f} ms", file=sys.stderr)
+
+    first_requests = measure_first_requests(args.runs, args.vertex_latency)
+    for mode, timings in first_requests.items():
+        print(f"{mode:<12} listening after {timings['listening_seconds']:.2f}s, first response after {timings['first_response_seconds']:.2f}s", file=sys.stderr)
+
+    results = {
+        "git_commit": get_git_commit(),
+        "python": sys.version.split()[0],
+        "import_ms": import_ms,
+        "first_request": first_requests,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,203 @@
+"""
+Microbenchmarks for the CPU-bound steps of a request in main.py, at growing history lengths and tool list sizes:
+
+- history validation (is_invalid_history)
+- signature check and JSON parsing of the body (has_valid_signature and parse_signed_body)
+- history conversion to types.Content (build_generate_request)
+- a session turn, which only converts the new turn and reuses the session's converted history
+- the prefix hashing that looks up a request's context cache (hash_prefixes, once per request, and get_prefixes, per attempt)
+- tool declaration construction (build_generate_request)
+- top-k example selection over example banks of growing size (top_k)
+- response part extraction and serialization (get_response_parts and json.dumps)
+
+    python benchmark_hot_path.py --output baseline.json
+    python benchmark_hot_path.py --baseline baseline.json --threshold 0.2
+
+With --baseline, exits with status 1 when any case is slower than the baseline by more than the threshold.
+"""
+import argparse
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("VERTEX_CF_AUTH_TOKEN", "benchmark")
+# Keep the warm-up's imports and client creation out of the timings
+os.environ.setdefault("WARM_UP_ON_START", "0")
+
+import numpy
+from flask import Flask
+from google.genai import types
+
+import main
+from context_cache import context_cache_min_tokens, get_prefixes, hash_prefixes
+from example_selector import example_embedding_dimensions, normalize, top_k
+
+
+HISTORY_TURNS = [1, 100, 1000, 10000]
+TOOL_COUNTS = [1, 10, 100, 1000]
+EXAMPLE_BANK_SIZES = [100, 1000, 10000, 50000]
+EXAMPLE_COUNT = 10
+
+
+def make_history(turns):
+    """
+    Returns a conversation of alternating user and model turns, with a function call and its response every tenth turn.
+    """
+    history = []
+    for index in range(turns):
+        if index % 10 == 9:
+            history.append({"role": "model", "parts": [{"functionCall": {"name": "run_query", "args": {"model": "sales", "fields": ["orders.count"]}}}]})
+            history.append({"role": "user", "parts": [{"functionResponse": {"name": "run_query", "response": {"rows": [{"orders.count": index}]}}}]})
+        elif index % 2 == 0:
+            history.append({"role": "user", "parts": [f"Show me the total sales by region for quarter {index}"]})
+        else:
+            history.append({"role": "model", "parts": [f"Here are the total sales by region for quarter {index - 1}."]})
+    return history[:turns]
+
+
+def make_tools(count):
+    return [
+        {
+            "name": f"tool_{index}",
+            "description": f"Runs query {index} against the sales explore, filtered by any dimension.",
+            "parameters": {
+                "type": "OBJECT",
+                "properties": {
+                    "dimension": {"type": "STRING", "description": "The dimension to group by"},
+                    "limit": {"type": "INTEGER", "description": "The number of rows to return"},
+                },
+                "required": ["dimension"],
+            },
+        }
+        for index in range(count)
+    ]
+
+
+def make_response(part_count):
+    parts = []
+    for index in range(part_count):
+        if index % 5 == 4:
+            parts.append(types.Part(function_call=types.FunctionCall(name="run_query", args={"model": "sales", "limit": index})))
+        else:
+            parts.append(types.Part(text=f"The total sales in region {index} grew by {index % 17}% over the last quarter."))
+    return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=parts))])
+
+
+def make_signed_request(app, history):
+    body = json.dumps({"contents": "Summarize our conversation so far.", "history": history}).encode()
+    signature = hmac.new(main.vertex_cf_auth_token.encode(), body, "sha256").hexdigest()
+    context = app.test_request_context("/generate_content", method="POST", data=body, headers={"X-Signature": signature})
+    return context.request, signature, body
+
+
+def get_cases():
+    """
+    Returns (name, size, fn) for every case. fn runs the step once.
+    """
+    app = Flask(__name__)
+    cases = []
+    for turns in HISTORY_TURNS:
+        history = make_history(turns)
+        request, signature, body = make_signed_request(app, history)
+        cases.append(("is_invalid_history", turns, lambda history=history: main.is_invalid_history(history)))
+        cases.append(("has_valid_signature", turns, lambda request=request: main.has_valid_signature(request)))
+        cases.append(("parse_signed_body", turns, lambda signature=signature, body=body: main.parse_signed_body(signature, body)))
+        cases.append(("history_conversion", turns, lambda history=history: main.build_generate_request("Summarize our conversation so far.", history=history)))
+        session_contents = tuple(main.build_generate_request(None, history=history)[0])
+        cases.append(("session_turn", turns, lambda session_contents=session_contents: [*session_contents, *main.build_generate_request("Summarize our conversation so far.")[0]]))
+        contents, config = main.build_generate_request("Summarize our conversation so far.", history=history)
+        cases.append(("context_cache_prefixes", turns, lambda contents=contents, config=config: hash_prefixes(config, contents, context_cache_min_tokens)))
+        prefix_hashes = hash_prefixes(config, contents, context_cache_min_tokens)
+        cases.append(("context_cache_attempt", turns, lambda prefix_hashes=prefix_hashes: get_prefixes("gemini-1.5-flash", "us-central1", prefix_hashes)))
+        response = make_response(turns)
+        cases.append(("response_serialization", turns, lambda response=response: json.dumps(main.get_response_parts(response))))
+
+    for tool_count in TOOL_COUNTS:
+        tools = make_tools(tool_count)
+        cases.append(("tool_declarations", tool_count, lambda tools=tools: main.build_generate_request("Which region sold the most?", tools=tools)))
+
+    rng = numpy.random.default_rng(0)
+    for bank_size in EXAMPLE_BANK_SIZES:
+        bank = normalize(rng.standard_normal((bank_size, example_embedding_dimensions)))
+        query = normalize(rng.standard_normal(example_embedding_dimensions))
+        cases.append(("example_top_k", bank_size, lambda bank=bank, query=query: top_k(bank, query, EXAMPLE_COUNT)))
+
+    return cases
+
+
+def measure(fn, min_seconds, repeats):
+    """
+    Returns the median and the minimum time per call in microseconds, over repeats timings of a loop
+    long enough to take at least min_seconds.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(min_seconds / elapsed) + 1)
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        timings.append((time.perf_counter() - start) / loops * 1e6)
+    return statistics.median(timings), min(timings)
+
+
+def find_regressions(results, baseline, threshold):
+    baseline_cases = {(case["name"], case["size"]): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        baseline_case = baseline_cases.get((case["name"], case["size"]))
+        if baseline_case is None:
+            continue
+        ratio = case["median_us"] / baseline_case["median_us"]
+        case["baseline_median_us"] = baseline_case["median_us"]
+        case["change"] = ratio - 1
+        if ratio > 1 + threshold:
+            regressions.append(case)
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="shortest timing loop")
+    parser.add_argument("--repeats", type=int, default=5, help="timing loops per case")
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = {"python": sys.version.split()[0], "cases": []}
+    for name, size, fn in get_cases():
+        if args.filter and args.filter not in name:
+            continue
+        median_us, min_us = measure(fn, args.min_seconds, args.repeats)
+        results["cases"].append({"name": name, "size": size, "median_us": median_us, "min_us": min_us})
+        print(f"{name:<24} {size:>6}  {median_us:>12.1f} us", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for case in regressions:
+            print(f"Regression: {case['name']} at {case['size']} is {case['change']:.0%} slower than the baseline", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    run()
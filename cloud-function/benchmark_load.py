@@ -0,0 +1,333 @@
+"""
+Load test for /generate_content against the offline Vertex AI stand-in in fake_vertex.py.
+
+Starts the stand-in and the backend as separate processes, drives the backend with a mix of
+realistic requests at several concurrency levels, and reports throughput, latency percentiles,
+backend CPU time per request and backend memory as JSON:
+
+    python benchmark_load.py --target flask --concurrency 1,4,16 --requests 200 --output flask.json
+    python benchmark_load.py --target functions_framework --output cf.json
+
+CPU and memory are read from /proc, so they are only reported on Linux.
+"""
+import argparse
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+
+AUTH_TOKEN = "benchmark"
+# The backend and the stand-in are started from the directory of this file
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LARGE_HISTORY = [
+    {"role": "user", "parts": ["Tell me a joke."]},
+    {"role": "model", "parts": ["Why did the scarecrow win an award? Because he was outstanding in his field!"]},
+    {"role": "user", "parts": ["Haha, that's great! Got another one?"]},
+    {"role": "model", "parts": ["Why don’t skeletons fight each other? They don’t have the guts."]},
+    {"role": "user", "parts": ["Thanks, that's enough for now."]},
+]
+
+TOOLS = [
+    {
+        "name": "find_movies",
+        "description": "Find movie titles currently playing in theaters based on any description, genre, title words, etc.",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "location": {"type": "STRING", "description": "The city and state, e.g. San Francisco, CA or a zip code e.g. 95616"},
+                "description": {"type": "STRING", "description": "Any kind of description including category or genre, title words, attributes, etc."},
+            },
+            "required": ["description"],
+        },
+    },
+    {
+        "name": "find_theaters",
+        "description": "Find theaters based on location and optionally movie title which is currently playing in theaters.",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "location": {"type": "STRING", "description": "The city and state, e.g. San Francisco, CA or a zip code e.g. 95616"},
+                "movie": {"type": "STRING", "description": "Any movie title"},
+            },
+            "required": ["location"],
+        },
+    },
+]
+
+RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "recipe_name": {"type": "string", "description": "The name of the recipe."},
+            "ingredients": {"type": "array", "items": {"type": "string"}, "description": "A list of ingredients used in the recipe."},
+        },
+        "required": ["recipe_name", "ingredients"],
+    },
+}
+
+
+def short_prompt(index):
+    return {"contents": f"How are you doing? ({index})", "parameters": {"max_output_tokens": 1000}}
+
+
+def large_history(index):
+    return {"contents": f"Summarize our conversation so far. ({index})", "history": LARGE_HISTORY, "parameters": {"max_output_tokens": 1000}}
+
+
+def tool_declarations(index):
+    return {"contents": f"Find action movies currently playing in theaters in San Francisco, CA. ({index})", "tools": TOOLS}
+
+
+def response_schema(index):
+    return {"contents": f"Make me a list of recipes. ({index})", "parameters": {"max_output_tokens": 500, "temperature": 0.3}, "response_schema": RESPONSE_SCHEMA}
+
+
+# Share of each kind of request in the load
+PAYLOAD_MIX = [
+    (short_prompt, 4),
+    (large_history, 3),
+    (tool_declarations, 2),
+    (response_schema, 1),
+]
+
+
+def get_payload(index):
+    """
+    Returns the index-th request of the mix. Every request is different, so nothing is served from the cache.
+    """
+    kinds = [kind for kind, weight in PAYLOAD_MIX for _ in range(weight)]
+    return kinds[index % len(kinds)](index)
+
+
+def sign(body):
+    return hmac.new(AUTH_TOKEN.encode(), body, "sha256").hexdigest()
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def get_process_tree(pid):
+    """
+    Returns the pid and the pids of all its descendants, e.g. gunicorn workers.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+
+    pids = [pid]
+    for current in pids:
+        pids.extend(children.get(current, []))
+    return pids
+
+
+def get_cpu_seconds(pid):
+    total = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime, in clock ticks
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def get_rss_mb(pid):
+    total = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def start_fake_vertex(port, latency, seed):
+    env = {**os.environ, "FAKE_VERTEX_PORT": str(port), "FAKE_VERTEX_LATENCY": latency, "FAKE_VERTEX_SEED": str(seed)}
+    return subprocess.Popen([sys.executable, "fake_vertex.py"], env=env, cwd=SOURCE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_backend(target, port, vertex_port, extra_env=None):
+    env = {
+        **os.environ,
+        "VERTEX_BASE_URL": f"http://127.0.0.1:{vertex_port}",
+        "PROJECT": "benchmark",
+        "VERTEX_CF_AUTH_TOKEN": AUTH_TOKEN,
+        "PORT": str(port),
+        # Measure the full pipeline on every request
+        "RESPONSE_CACHE_MODE": os.environ.get("RESPONSE_CACHE_MODE", "off"),
+        "COALESCE_REQUESTS": os.environ.get("COALESCE_REQUESTS", "0"),
+        **(extra_env or {}),
+    }
+    if target == "flask":
+        command = [sys.executable, "-c", f"from main import create_flask_app; create_flask_app().run(host='127.0.0.1', port={port}, threaded=True)"]
+    elif target == "functions_framework":
+        command = [sys.executable, "-m", "functions_framework", "--target", "cloud_function_entrypoint", "--source", "main.py", "--host", "127.0.0.1", "--port", str(port)]
+    else:
+        raise ValueError(f"Unknown target: {target}")
+    # The access log of every request would only slow the backend down
+    return subprocess.Popen(command, env=env, cwd=SOURCE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_level(url, concurrency, request_count, offset):
+    """
+    Sends request_count requests from concurrency workers, each sending its next request as soon as the last one is answered.
+    """
+    latencies = []
+    statuses = {}
+
+    def worker(worker_index):
+        with httpx.Client(timeout=120) as client:
+            for index in range(worker_index, request_count, concurrency):
+                body = json.dumps(get_payload(offset + index)).encode()
+                start = time.perf_counter()
+                try:
+                    status = client.post(url, content=body, headers={"Content-Type": "application/json", "X-Signature": sign(body)}).status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": request_count,
+        "statuses": statuses,
+        "duration_seconds": elapsed,
+        "throughput_rps": request_count / elapsed,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies),
+            "p50": 1000 * percentile(latencies, 50),
+            "p95": 1000 * percentile(latencies, 95),
+            "p99": 1000 * percentile(latencies, 99),
+            "max": 1000 * latencies[-1],
+        },
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=SOURCE_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(target, concurrency_levels, request_count, warmup_count, latency, seed):
+    vertex_port = get_free_port()
+    backend_port = get_free_port()
+    fake_vertex = start_fake_vertex(vertex_port, latency, seed)
+    backend = None
+    try:
+        wait_for_port(vertex_port)
+        backend = start_backend(target, backend_port, vertex_port)
+        wait_for_port(backend_port)
+        url = f"http://127.0.0.1:{backend_port}/generate_content"
+        has_proc = os.path.exists(f"/proc/{backend.pid}/stat")
+
+        run_level(url, 1, warmup_count, 0)
+        results = {
+            "target": target,
+            "git_commit": get_git_commit(),
+            "vertex_latency": latency,
+            "seed": seed,
+            "rss_mb_after_warmup": get_rss_mb(backend.pid) if has_proc else None,
+            "levels": [],
+        }
+
+        offset = warmup_count
+        for concurrency in concurrency_levels:
+            cpu_before = get_cpu_seconds(backend.pid) if has_proc else None
+            level = run_level(url, concurrency, request_count, offset)
+            offset += request_count
+            if has_proc:
+                level["cpu_ms_per_request"] = 1000 * (get_cpu_seconds(backend.pid) - cpu_before) / request_count
+                level["rss_mb"] = get_rss_mb(backend.pid)
+            results["levels"].append(level)
+            print(
+                f"{target} concurrency={concurrency}: {level['throughput_rps']:.1f} req/s, "
+                f"p50={level['latency_ms']['p50']:.0f}ms p95={level['latency_ms']['p95']:.0f}ms p99={level['latency_ms']['p99']:.0f}ms, "
+                f"statuses={level['statuses']}",
+                file=sys.stderr,
+            )
+        return results
+    finally:
+        for process in (backend, fake_vertex):
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["flask", "functions_framework"], default="flask")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--vertex-latency", default="lognormal:400:0.4", help="latency of the stand-in, see fake_vertex.py")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.target,
+        [int(level) for level in args.concurrency.split(",")],
+        args.requests,
+        args.warmup,
+        args.vertex_latency,
+        args.seed,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
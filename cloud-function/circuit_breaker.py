@@ -0,0 +1,212 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from retry import is_retriable
+
+
+# Calls in the rolling window are used to decide whether to open the circuit
+circuit_window_seconds = float(os.environ.get("CIRCUIT_WINDOW_SECONDS", 60))
+circuit_min_calls = int(os.environ.get("CIRCUIT_MIN_CALLS", 10))
+circuit_error_rate = float(os.environ.get("CIRCUIT_ERROR_RATE", 0.5))
+# Calls slower than this count as failures
+circuit_slow_call_seconds = float(os.environ.get("CIRCUIT_SLOW_CALL_SECONDS", 30))
+# How long the circuit stays open before a trial call is let through
+circuit_open_seconds = float(os.environ.get("CIRCUIT_OPEN_SECONDS", 30))
+circuit_half_open_calls = int(os.environ.get("CIRCUIT_HALF_OPEN_CALLS", 1))
+# Region to send a model's calls to while its circuit in the primary region is open
+circuit_fallback_location = os.environ.get("CIRCUIT_FALLBACK_REGION")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a model and region whose circuit is open.
+    """
+
+    status_code = 503
+
+    def __init__(self, model_name, location, retry_after):
+        super().__init__(f"Model {model_name} in {location} is unavailable, try again later")
+        self.model_name = model_name
+        self.location = location
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of recent calls to one model in one region:
+    - closed: calls go through. Opens when the error rate over the window reaches circuit_error_rate.
+    - open: calls fail fast. After circuit_open_seconds a few trial calls are let through.
+    - half open: closes again if the trial calls succeed, opens again if one fails.
+    """
+
+    def __init__(self, model_name, location):
+        self.model_name = model_name
+        self.location = location
+        self.state = CLOSED
+        self.transitions = collections.Counter()
+        self._calls = collections.deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < circuit_open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self._half_open_calls >= circuit_half_open_calls:
+                    return False
+                self._half_open_calls += 1
+
+            return True
+
+    def is_open(self):
+        """
+        Whether calls fail fast, as opposed to an open circuit that is due for a trial call.
+        """
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self._opened_at < circuit_open_seconds
+
+    def retry_after(self):
+        return max(1, int(circuit_open_seconds - (time.monotonic() - self._opened_at)) + 1)
+
+    def record(self, failed):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._half_open_calls -= 1
+                self._transition(OPEN if failed else CLOSED)
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] < now - circuit_window_seconds:
+                _, old_failed = self._calls.popleft()
+                self._failures -= old_failed
+
+            if len(self._calls) >= circuit_min_calls and self._failures / len(self._calls) >= circuit_error_rate:
+                self._transition(OPEN)
+
+    def release(self):
+        """
+        Gives back a trial call that never reached the model.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+
+        logging.warning(f"Circuit for {self.model_name} in {self.location} changed from {self.state} to {state}")
+        self.transitions[f"{self.state}_to_{state}"] += 1
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._half_open_calls = 0
+        self._calls.clear()
+        self._failures = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls_in_window": len(self._calls),
+                "failures_in_window": self._failures,
+                "transitions": dict(self.transitions),
+            }
+
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def get_breaker(model_name, location):
+    key = (model_name, location)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = _breakers[key] = CircuitBreaker(model_name, location)
+    return breaker
+
+
+def is_failure(error):
+    # Only upstream failures count; a bad request says nothing about the health of the model
+    return is_retriable(error)
+
+
+def get_location(model_name, location):
+    """
+    Returns the region to call, moving to the fallback region while the primary circuit is open.
+    Once the primary circuit is due for a trial call, the call goes there again, so the circuit can close.
+    """
+    if circuit_fallback_location and circuit_fallback_location != location and get_breaker(model_name, location).is_open():
+        return circuit_fallback_location
+    return location
+
+
+def call_with_circuit_breaker(model_name, location, fn):
+    """
+    Calls fn(location) unless the circuit for the model and region is open, and records the outcome.
+    """
+    location = get_location(model_name, location)
+    breaker = get_breaker(model_name, location)
+    if not breaker.allow():
+        raise CircuitOpen(model_name, location, breaker.retry_after())
+
+    start = time.monotonic()
+    try:
+        result = fn(location)
+    except Exception as e:
+        if is_failure(e):
+            breaker.record(True)
+        else:
+            breaker.release()
+        raise
+
+    breaker.record(time.monotonic() - start >= circuit_slow_call_seconds)
+    return result
+
+
+async def call_with_circuit_breaker_async(model_name, location, coroutine_fn):
+    """
+    Async version of call_with_circuit_breaker.
+    """
+    location = get_location(model_name, location)
+    breaker = get_breaker(model_name, location)
+    if not breaker.allow():
+        raise CircuitOpen(model_name, location, breaker.retry_after())
+
+    start = time.monotonic()
+    try:
+        result = await coroutine_fn(location)
+    except BaseException as e:
+        if isinstance(e, Exception) and is_failure(e):
+            breaker.record(True)
+        else:
+            breaker.release()
+        raise
+
+    breaker.record(time.monotonic() - start >= circuit_slow_call_seconds)
+    return result
+
+
+def circuit_stats():
+    return {
+        f"{model_name}/{location}": breaker.stats()
+        for (model_name, location), breaker in list(_breakers.items())
+    }
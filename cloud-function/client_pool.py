@@ -0,0 +1,284 @@
+import asyncio
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from lazy import lazy_import
+
+# The SDKs are imported on first use, or by the warm-up, rather than when the function is loaded
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
+google_auth = lazy_import("google.auth")
+google_auth_exceptions = lazy_import("google.auth.exceptions")
+google_auth_requests = lazy_import("google.auth.transport.requests")
+google_oauth2_credentials = lazy_import("google.oauth2.credentials")
+httpx = lazy_import("httpx")
+
+
+# Connection pool sizing. The default matches max_instance_request_concurrency in terraform.
+max_connections = int(os.environ.get("CLIENT_MAX_CONNECTIONS", 20))
+keepalive_expiry = float(os.environ.get("CLIENT_KEEPALIVE_SECONDS", 60))
+# Refresh the access token this many seconds before it expires
+credential_refresh_margin = int(os.environ.get("CREDENTIAL_REFRESH_MARGIN_SECONDS", 300))
+# Sends every call to this URL instead of Vertex AI, e.g. the offline stand-in in fake_vertex.py
+vertex_base_url = os.environ.get("VERTEX_BASE_URL")
+# A failed warm-up is started again by a readiness check at most this often
+warm_up_retry_seconds = float(os.environ.get("WARM_UP_RETRY_SECONDS", 30))
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+_clients = {}
+_lock = threading.Lock()
+_credentials = None
+_refresher = None
+_stop_refresher = threading.Event()
+_warm_up_args = None
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+_warm_up_status = {"state": "not_started", "seconds": None, "error": None}
+_warm_up_retry_at = 0.0
+
+
+def _utcnow():
+    # google.auth stores expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _seconds_until_refresh(credentials):
+    if credentials.expiry is None:
+        return credential_refresh_margin
+    remaining = (credentials.expiry - _utcnow()).total_seconds()
+    return remaining - credential_refresh_margin
+
+
+def _refresh_credentials_loop():
+    """
+    Keeps the shared credentials fresh so the request path never blocks on a token refresh.
+    """
+    auth_request = google_auth_requests.Request()
+    while not _stop_refresher.is_set():
+        wait_seconds = 30
+        try:
+            if not _credentials.token or _seconds_until_refresh(_credentials) <= 0:
+                _credentials.refresh(auth_request)
+                logging.info("Refreshed Vertex AI credentials")
+            wait_seconds = max(1, _seconds_until_refresh(_credentials))
+        except Exception as e:
+            logging.warning(f"Error refreshing Vertex AI credentials: {str(e)}")
+        _stop_refresher.wait(wait_seconds)
+
+
+def _get_credentials():
+    global _credentials, _refresher
+
+    if vertex_base_url:
+        # The stand-in doesn't check tokens, and a token that never expires is never refreshed
+        return google_oauth2_credentials.Credentials(token="offline")
+
+    if _credentials is None:
+        try:
+            _credentials, _ = google_auth.default(scopes=SCOPES)
+        except google_auth_exceptions.DefaultCredentialsError as e:
+            # Let the SDK fall back to its own credential discovery
+            logging.warning(f"Could not load default credentials: {str(e)}")
+            return None
+
+        _stop_refresher.clear()
+        _refresher = threading.Thread(target=_refresh_credentials_loop, name="credential-refresher", daemon=True)
+        _refresher.start()
+
+    return _credentials
+
+
+def _http_options():
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return types.HttpOptions(
+        base_url=vertex_base_url,
+        client_args={"limits": limits},
+        async_client_args={"limits": limits},
+    )
+
+
+def get_client(project, location):
+    """
+    Returns the process-wide client for (project, location), creating it on first use.
+    Clients share one set of credentials and keep their HTTP connections alive between requests.
+    """
+    key = (project, location)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = genai.Client(
+                vertexai=True,
+                project=project,
+                location=location,
+                credentials=_get_credentials(),
+                http_options=_http_options(),
+            )
+            _clients[key] = client
+            logging.info(f"Created Vertex AI client for project={project} location={location}")
+    return client
+
+
+async def get_client_async(project, location):
+    """
+    Same as get_client for the async paths. The first client loads the credentials and the SDK,
+    which blocks, so a client that doesn't exist yet is created on a thread rather than on the event loop.
+    """
+    client = _clients.get((project, location))
+    if client is not None:
+        return client
+    return await asyncio.to_thread(get_client, project, location)
+
+
+def warm_up(project, location, probe_model=None):
+    """
+    Imports the SDK, fetches an access token and creates the client for the primary region,
+    so the first request doesn't wait on them. With probe_model, also counts the tokens of a one word
+    prompt, which opens the connection to Vertex AI that the first request then reuses.
+    Does nothing once a warm-up has succeeded. Returns the warm-up status.
+    """
+    with _warm_up_lock:
+        if _warm_up_status["state"] == "ready":
+            return warm_up_status()
+
+        _warm_up_status.update(state="running", error=None)
+        start = time.monotonic()
+        try:
+            client = get_client(project, location)
+            if _credentials is not None and not _credentials.token:
+                _credentials.refresh(google_auth_requests.Request())
+            # Request content is built from the types module, which the client doesn't import
+            types.Content
+            if probe_model:
+                client.models.count_tokens(model=probe_model, contents="ping")
+            _warm_up_status.update(state="ready", seconds=time.monotonic() - start)
+            logging.info(f"Warmed up in {_warm_up_status['seconds']:.2f}s")
+        except Exception as e:
+            _warm_up_status.update(state="failed", seconds=time.monotonic() - start, error=str(e))
+            logging.warning(f"Error warming up: {str(e)}")
+        return warm_up_status()
+
+
+def warm_up_status():
+    """
+    Returns the state of the warm-up (not_started, running, ready or failed), how long it took and its error.
+    """
+    return dict(_warm_up_status)
+
+
+def start_warm_up(project, location, probe_model=None):
+    """
+    Runs warm_up on a background thread, so the server can start listening in the meantime.
+    """
+    global _warm_up_args, _warm_up_thread
+    _warm_up_args = (project, location, probe_model)
+    _warm_up_thread = threading.Thread(target=warm_up, args=_warm_up_args, name="warm-up", daemon=True)
+    _warm_up_thread.start()
+
+
+def retry_failed_warm_up(project, location, probe_model=None):
+    """
+    Starts the warm-up again on a background thread if the last one failed, e.g. on a transient error fetching
+    the access token, so the instance doesn't stay unready until it is restarted. Does nothing if a retry
+    was started less than warm_up_retry_seconds ago.
+    """
+    global _warm_up_retry_at
+    with _lock:
+        if _warm_up_status["state"] != "failed" or time.monotonic() < _warm_up_retry_at:
+            return
+        _warm_up_retry_at = time.monotonic() + warm_up_retry_seconds
+        logging.info("Retrying the failed warm-up")
+        start_warm_up(project, location, probe_model)
+
+
+def defer_warm_up(project, location, probe_model=None):
+    """
+    Records the warm-up to run in each worker once it is forked, instead of in the process that loads main.py
+    and forks the workers, so the fork never waits on it.
+    """
+    global _warm_up_args
+    _warm_up_args = (project, location, probe_model)
+
+
+def start_deferred_warm_up():
+    """
+    Starts the deferred warm-up in a process that was never forked, e.g. under functions_framework --debug.
+    Does nothing once a warm-up was started in this process.
+    """
+    with _lock:
+        if _warm_up_args is not None and _warm_up_thread is None:
+            start_warm_up(*_warm_up_args)
+
+
+def _before_fork():
+    # gunicorn forks its workers after functions_framework has loaded main.py. A fork in the middle of the
+    # warm-up would copy half-imported modules and their held import locks into the worker, without the thread.
+    if _warm_up_thread is not None:
+        _warm_up_thread.join()
+
+
+def _after_fork_in_child():
+    global _refresher, _warm_up_retry_at
+    # Connections can't be shared with the parent, so the worker opens its own. The credentials are kept,
+    # but the thread refreshing them doesn't survive the fork.
+    _clients.clear()
+    if _refresher is not None:
+        _refresher = threading.Thread(target=_refresh_credentials_loop, name="credential-refresher", daemon=True)
+        _refresher.start()
+    _warm_up_status.update(state="not_started", seconds=None, error=None)
+    _warm_up_retry_at = 0.0
+    if _warm_up_args is not None:
+        start_warm_up(*_warm_up_args)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+
+def close_clients():
+    """
+    Stops the credential refresher and closes every pooled client.
+    """
+    global _credentials, _refresher
+
+    with _lock:
+        _stop_refresher.set()
+        if _refresher is not None:
+            _refresher.join(timeout=5)
+            _refresher = None
+        _credentials = None
+
+        for key, client in list(_clients.items()):
+            try:
+                client.close()
+            except Exception as e:
+                logging.warning(f"Error closing Vertex AI client for {key}: {str(e)}")
+        _clients.clear()
+
+
+async def aclose_clients():
+    """
+    Closes the async transports of every pooled client, then the clients themselves.
+    Used by the ASGI app, which owns the event loop the async transports are bound to.
+    """
+    for key, client in list(_clients.items()):
+        try:
+            await client.aio.aclose()
+        except Exception as e:
+            logging.warning(f"Error closing async Vertex AI client for {key}: {str(e)}")
+    close_clients()
+
+
+atexit.register(close_clients)
@@ -0,0 +1,370 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from history_window import CHARACTERS_PER_TOKEN, estimate_tokens, is_turn_start
+from lazy import lazy_import
+
+errors = lazy_import("google.genai.errors")
+types = lazy_import("google.genai.types")
+
+
+# "auto" moves large prefixes that repeat across requests into Vertex cached content, "off" always sends them
+context_cache_mode = os.environ.get("CONTEXT_CACHE_MODE", "auto")
+# Vertex rejects caches below its minimum size, which is 32768 tokens for gemini-1.5 models
+context_cache_min_tokens = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", 32768))
+# A prefix is only cached once this many requests were sent with it, so one-off prompts don't pay for cache storage
+context_cache_min_requests = int(os.environ.get("CONTEXT_CACHE_MIN_REQUESTS", 2))
+# Vertex deletes a cache this many seconds after it was created or last refreshed
+context_cache_ttl_seconds = int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", 3600))
+context_cache_max_entries = int(os.environ.get("CONTEXT_CACHE_MAX_ENTRIES", 100))
+
+# Caches are not used in the last minute before they expire, so a request never races the expiry
+EXPIRY_MARGIN_SECONDS = 60
+# Prefixes that could not be cached are not tried again for this long
+CREATE_RETRY_SECONDS = 300
+# Prefixes seen by requests, counted until they are seen often enough to be cached
+MAX_TRACKED_PREFIXES = 10000
+# Vertex answers with a 404 when a cache expired or was deleted, and sometimes with one of these,
+# whose message then names the cached content
+CACHE_GONE_STATUS_CODES = {400, 403}
+
+
+class Prefix:
+    """
+    The start of a request that can be cached: the system instruction, the tools, and the contents before content_count.
+    """
+
+    def __init__(self, key, model_name, location, content_count, token_count):
+        self.key = key
+        self.model_name = model_name
+        self.location = location
+        self.content_count = content_count
+        self.token_count = token_count
+
+
+class CacheHandle:
+    """
+    A Vertex cached content holding a prefix, and when it expires, on the monotonic clock.
+    """
+
+    def __init__(self, name, prefix, expires_at):
+        self.name = name
+        self.prefix = prefix
+        self.expires_at = expires_at
+        self.refreshing = False
+
+
+def _dump(value):
+    if isinstance(value, list):
+        return [_dump(item) for item in value]
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    return value
+
+
+def hash_prefixes(config, contents, min_tokens):
+    """
+    Returns (digest, content_count, token_count) for the prefixes of the request of at least min_tokens estimated
+    tokens, longest first. A prefix ends before a user turn, and never holds the last turn, so the request still sends
+    contents of its own. The contents are hashed once, incrementally, so every attempt of a request reuses the digests.
+    """
+    head = json.dumps(_dump([config.system_instruction, config.tools, config.tool_config]), sort_keys=True)
+    token_count = len(head) // CHARACTERS_PER_TOKEN
+    content_tokens = [estimate_tokens(content) for content in contents]
+    # Most requests are far below the minimum, and are not hashed at all
+    if token_count + sum(content_tokens) - (content_tokens[-1] if content_tokens else 0) < min_tokens:
+        return []
+
+    prefix_hash = hashlib.sha256(head.encode("utf-8"))
+    prefix_hashes = []
+    for index, content in enumerate(contents):
+        if token_count >= min_tokens and (index == 0 or is_turn_start(content)):
+            prefix_hashes.append((prefix_hash.hexdigest(), index, token_count))
+        prefix_hash.update(content.model_dump_json(exclude_none=True).encode("utf-8"))
+        token_count += content_tokens[index]
+    prefix_hashes.reverse()
+    return prefix_hashes
+
+
+def get_prefixes(model_name, location, prefix_hashes):
+    """
+    Returns the prefixes of hash_prefixes for one model and region.
+    Caches live in one region for one model, so both are part of the key.
+    """
+    return [
+        Prefix(f"{digest}:{model_name}:{location}", model_name, location, content_count, token_count)
+        for digest, content_count, token_count in prefix_hashes
+    ]
+
+
+def get_cached_request(handle, contents, config):
+    """
+    Returns the contents and config of the request with its prefix replaced by the cached content.
+    Vertex rejects a request that sets the system instruction or tools along with a cache.
+    """
+    cached_config = config.model_copy(update={"cached_content": handle.name, "system_instruction": None, "tools": None, "tool_config": None})
+    return contents[handle.prefix.content_count:], cached_config
+
+
+class ContextCacheRegistry:
+    """
+    Thread safe registry of the Vertex cached contents created for repeated prefixes, keyed by prefix hash.
+    Caches are created, refreshed and deleted in the background, so a request never waits on them: the request
+    that makes a prefix worth caching is sent uncached, and the ones after it use the cache.
+    The least recently used cache is deleted beyond max_entries.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, min_tokens, min_requests):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.min_requests = min_requests
+        self._handles = collections.OrderedDict()
+        self._request_counts = collections.OrderedDict()
+        self._creating = set()
+        self._create_retry_at = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.creations = 0
+        self.failures = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def hash_prefixes(self, config, contents):
+        """
+        Hashes the prefixes of a request that are large enough to be cached, once for every attempt of the request.
+        """
+        return hash_prefixes(config, contents, self.min_tokens)
+
+    def use(self, client, model_name, location, config, contents, prefix_hashes):
+        """
+        Returns the handle of the longest cached prefix of the request, or None to send it uncached.
+        Counts the request towards caching its prefixes, and starts creating or refreshing a cache when one is due.
+        """
+        prefixes = get_prefixes(model_name, location, prefix_hashes)
+        if not prefixes:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            handle = self._get_live_handle(prefixes, now)
+            if handle is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            to_create = self._count_request(prefixes, handle, now)
+            if to_create is not None:
+                self._creating.add(to_create.key)
+            # Refresh a cache that is in use once half of the time it can be used for has passed
+            to_refresh = (
+                handle is not None
+                and not handle.refreshing
+                and handle.expires_at - EXPIRY_MARGIN_SECONDS - now < (self.ttl_seconds - EXPIRY_MARGIN_SECONDS) / 2
+            )
+            if to_refresh:
+                handle.refreshing = True
+
+        if to_create is not None:
+            self._start(self._create, client, to_create, config, contents[:to_create.content_count])
+        if to_refresh:
+            self._start(self._refresh, client, handle)
+        return handle
+
+    def invalidate(self, handle):
+        """
+        Forgets a cache that Vertex no longer has, e.g. one deleted by hand.
+        """
+        with self._lock:
+            if self._handles.get(handle.prefix.key) is handle:
+                del self._handles[handle.prefix.key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+            self._request_counts.clear()
+            self._create_retry_at.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "creations": self.creations,
+                "failures": self.failures,
+                "refreshes": self.refreshes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._handles),
+            }
+
+    def _get_live_handle(self, prefixes, now):
+        for prefix in prefixes:
+            handle = self._handles.get(prefix.key)
+            if handle is None:
+                continue
+            if handle.expires_at - EXPIRY_MARGIN_SECONDS <= now:
+                # Vertex deletes it on its own
+                del self._handles[prefix.key]
+                continue
+            self._handles.move_to_end(prefix.key)
+            return handle
+        return None
+
+    def _count_request(self, prefixes, handle, now):
+        """
+        Returns the longest prefix that was sent often enough to be cached, when it is worth a cache of its own:
+        without a cache for the request, or when it holds at least min_tokens more than the one in use.
+        """
+        to_create = None
+        for prefix in prefixes:
+            request_count = self._request_counts.pop(prefix.key, 0) + 1
+            self._request_counts[prefix.key] = request_count
+            if (
+                to_create is None
+                and request_count >= self.min_requests
+                and prefix.key not in self._handles
+                and prefix.key not in self._creating
+                and self._create_retry_at.get(prefix.key, 0) <= now
+                and (handle is None or prefix.token_count - handle.prefix.token_count >= self.min_tokens)
+            ):
+                to_create = prefix
+        while len(self._request_counts) > MAX_TRACKED_PREFIXES:
+            self._request_counts.popitem(last=False)
+        return to_create
+
+    def _start(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def _create(self, client, prefix, config, prefix_contents):
+        try:
+            cached_content = client.caches.create(
+                model=prefix.model_name,
+                config=types.CreateCachedContentConfig(
+                    contents=prefix_contents or None,
+                    system_instruction=config.system_instruction,
+                    tools=config.tools,
+                    tool_config=config.tool_config,
+                    ttl=f"{self.ttl_seconds}s",
+                    display_name=f"gemini-backend-{prefix.key[:16]}",
+                ),
+            )
+        except Exception as e:
+            logging.warning(f"Error caching a prefix of {prefix.token_count} tokens for {prefix.model_name} in {prefix.location}: {str(e)}")
+            with self._lock:
+                self._creating.discard(prefix.key)
+                self._create_retry_at[prefix.key] = time.monotonic() + CREATE_RETRY_SECONDS
+                self.failures += 1
+            return
+
+        logging.info(f"Cached a prefix of {prefix.token_count} tokens for {prefix.model_name} in {prefix.location} as {cached_content.name}")
+        evicted = []
+        with self._lock:
+            self._creating.discard(prefix.key)
+            self._create_retry_at.pop(prefix.key, None)
+            self._handles[prefix.key] = CacheHandle(cached_content.name, prefix, time.monotonic() + self.ttl_seconds)
+            self.creations += 1
+            while len(self._handles) > self.max_entries:
+                evicted.append(self._handles.popitem(last=False)[1])
+                self.evictions += 1
+
+        # Stop paying for the storage of evicted caches instead of waiting for them to expire
+        for handle in evicted:
+            try:
+                client.caches.delete(name=handle.name)
+            except Exception as e:
+                logging.warning(f"Error deleting the evicted cache {handle.name}: {str(e)}")
+
+    def _refresh(self, client, handle):
+        try:
+            client.caches.update(name=handle.name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except Exception as e:
+            logging.warning(f"Error refreshing the cache {handle.name}: {str(e)}")
+            if is_cache_gone_error(e):
+                self.invalidate(handle)
+            with self._lock:
+                handle.refreshing = False
+            return
+
+        with self._lock:
+            handle.expires_at = time.monotonic() + self.ttl_seconds
+            handle.refreshing = False
+            self.refreshes += 1
+
+
+context_cache = ContextCacheRegistry(context_cache_max_entries, context_cache_ttl_seconds, context_cache_min_tokens, context_cache_min_requests)
+
+
+def get_prefix_hashes(config, contents):
+    """
+    Returns the prefix hashes to pass to every call_with_context_cache of a request, empty when caching is off.
+    """
+    if context_cache_mode != "auto":
+        return []
+    return context_cache.hash_prefixes(config, contents)
+
+
+def is_cache_gone_error(error):
+    if not isinstance(error, errors.ClientError):
+        return False
+    if error.code == 404:
+        return True
+    # Other client errors are about the request itself, and would fail uncached too
+    return error.code in CACHE_GONE_STATUS_CODES and re.search(r"cached ?content", error.message or "", re.IGNORECASE) is not None
+
+
+def _use_cache(client, model_name, location, config, contents, prefix_hashes):
+    if not prefix_hashes:
+        return None
+    return context_cache.use(client, model_name, location, config, contents, prefix_hashes)
+
+
+def _is_cache_gone(error, handle):
+    if not is_cache_gone_error(error):
+        return False
+    logging.warning(f"Sending the request uncached, the cache {handle.name} can't be used: {str(error)}")
+    context_cache.invalidate(handle)
+    return True
+
+
+def call_with_context_cache(client, model_name, location, config, contents, prefix_hashes, fn):
+    """
+    Calls fn(contents, config) with the longest cached prefix of the request taken out of it and replaced by its cache,
+    or with the request as is when none of its prefixes is cached. prefix_hashes come from get_prefix_hashes.
+    When the cache is gone, calls it again uncached.
+    """
+    handle = _use_cache(client, model_name, location, config, contents, prefix_hashes)
+    if handle is None:
+        return fn(contents, config)
+
+    try:
+        return fn(*get_cached_request(handle, contents, config))
+    except Exception as e:
+        if not _is_cache_gone(e, handle):
+            raise
+    return fn(contents, config)
+
+
+async def call_with_context_cache_async(client, model_name, location, config, contents, prefix_hashes, coroutine_fn):
+    """
+    Same as call_with_context_cache, awaiting coroutine_fn(contents, config).
+    """
+    handle = _use_cache(client, model_name, location, config, contents, prefix_hashes)
+    if handle is None:
+        return await coroutine_fn(contents, config)
+
+    try:
+        return await coroutine_fn(*get_cached_request(handle, contents, config))
+    except Exception as e:
+        if not _is_cache_gone(e, handle):
+            raise
+    return await coroutine_fn(contents, config)
@@ -0,0 +1,198 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+types = lazy_import("google.genai.types")
+
+
+example_embedding_model = os.environ.get("EXAMPLE_EMBEDDING_MODEL", "text-embedding-005")
+# Fewer dimensions make the selection faster: a bank of 20,000 examples is scanned in about half a millisecond at 128
+example_embedding_dimensions = int(os.environ.get("EXAMPLE_EMBEDDING_DIMENSIONS", 128))
+# Texts embedded per call when a bank is built
+example_embedding_batch_size = int(os.environ.get("EXAMPLE_EMBEDDING_BATCH_SIZE", 100))
+# Directory the embeddings of example banks are saved to and memory-mapped from, so they are only computed once.
+# Banks are only kept in memory when it isn't set.
+example_embeddings_dir = os.environ.get("EXAMPLE_EMBEDDINGS_DIR")
+example_query_cache_max_entries = int(os.environ.get("EXAMPLE_QUERY_CACHE_MAX_ENTRIES", 10000))
+
+# The example inputs are questions like the requests, so both sides are embedded for similarity
+EMBEDDING_TASK_TYPE = "SEMANTIC_SIMILARITY"
+# Banks that could not be built are not tried again for this long
+BUILD_RETRY_SECONDS = 300
+
+
+def get_embedding_config():
+    return types.EmbedContentConfig(output_dimensionality=example_embedding_dimensions, task_type=EMBEDDING_TASK_TYPE)
+
+
+def normalize(vectors):
+    """
+    Scales vectors to unit length, so their dot product is their cosine similarity.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_inputs(example_contents):
+    return [content.parts[0].text for content in example_contents[::2]]
+
+
+def get_inputs_digest(inputs):
+    # Covers everything the embeddings depend on, so a changed example set never gets stale ones
+    return hashlib.sha256(json.dumps([example_embedding_model, example_embedding_dimensions, EMBEDDING_TASK_TYPE, inputs]).encode("utf-8")).hexdigest()
+
+
+def top_k(matrix, query, k):
+    """
+    Returns the indices of the k rows of matrix most similar to query, least similar first, so that the most
+    similar example ends up next to the request's own message. Rows and query are normalized.
+    """
+    scores = matrix @ query
+    if k >= len(scores):
+        return np.argsort(scores)
+    # Only the k best are sorted
+    best = np.argpartition(scores, -k)[-k:]
+    return best[np.argsort(scores[best])]
+
+
+class ExampleSelector:
+    """
+    Thread safe store of example banks: the embeddings of the inputs of an example set, as a normalized
+    float32 matrix with one row per example, optionally memory-mapped from EXAMPLE_EMBEDDINGS_DIR.
+    Banks are built in the background the first time an example set is used, and requests use all of the
+    examples until it is ready. The embeddings of recent request messages are kept in an LRU cache.
+    """
+
+    def __init__(self, embeddings_dir, query_cache_max_entries):
+        self.embeddings_dir = embeddings_dir
+        self.query_cache_max_entries = query_cache_max_entries
+        self._banks = {}
+        # The digest of the inputs of each example set version, and the example contents it was computed from
+        self._digests = {}
+        self._building = set()
+        self._build_retry_at = {}
+        self._queries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.query_hits = 0
+        self.query_misses = 0
+        self.failures = 0
+
+    def get_bank(self, client, example_set_id, version, example_contents):
+        """
+        Returns the bank of an example set version, whose examples are example_contents as alternating
+        user and model turns, or None while it is being built. Banks are keyed by the hash of their inputs,
+        so examples that changed without a new version, e.g. ones reloaded from BigQuery, get a bank of their own.
+        """
+        digest = self._get_digest(example_set_id, version, example_contents)
+        with self._lock:
+            bank = self._banks.get(digest)
+            if bank is not None or digest in self._building or self._build_retry_at.get(digest, 0) > time.monotonic():
+                return bank
+            self._building.add(digest)
+
+        threading.Thread(target=self._build, args=(client, example_set_id, version, digest, example_contents), name="example-bank", daemon=True).start()
+        return None
+
+    def get_query_embedding(self, text):
+        with self._lock:
+            query = self._queries.get(text)
+            if query is None:
+                self.query_misses += 1
+                return None
+            self._queries.move_to_end(text)
+            self.query_hits += 1
+            return query
+
+    def put_query_embedding(self, text, values):
+        query = normalize(values)
+        with self._lock:
+            self._queries[text] = query
+            while len(self._queries) > self.query_cache_max_entries:
+                self._queries.popitem(last=False)
+        return query
+
+    def clear(self):
+        with self._lock:
+            self._banks.clear()
+            self._digests.clear()
+            self._queries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "banks": len(self._banks),
+                "examples": sum(len(bank) for bank in self._banks.values()),
+                "query_hits": self.query_hits,
+                "query_misses": self.query_misses,
+                "failures": self.failures,
+            }
+
+    def _get_digest(self, example_set_id, version, example_contents):
+        # The registry hands out the same example contents until it is reloaded, so they are hashed once per load
+        with self._lock:
+            digested = self._digests.get((example_set_id, version))
+        if digested is not None and digested[0] is example_contents:
+            return digested[1]
+
+        digest = get_inputs_digest(get_inputs(example_contents))
+        with self._lock:
+            self._digests[(example_set_id, version)] = (example_contents, digest)
+        return digest
+
+    def _get_path(self, digest):
+        return os.path.join(self.embeddings_dir, f"{digest[:32]}.npy")
+
+    def _embed(self, client, inputs):
+        vectors = []
+        for start in range(0, len(inputs), example_embedding_batch_size):
+            response = client.models.embed_content(
+                model=example_embedding_model,
+                contents=inputs[start:start + example_embedding_batch_size],
+                config=get_embedding_config(),
+            )
+            vectors.extend(embedding.values for embedding in response.embeddings)
+        return normalize(vectors)
+
+    def _build(self, client, example_set_id, version, digest, example_contents):
+        inputs = get_inputs(example_contents)
+        try:
+            path = self._get_path(digest) if self.embeddings_dir else None
+            if path and os.path.exists(path):
+                bank = np.load(path, mmap_mode="r")
+            else:
+                bank = self._embed(client, inputs)
+                if path:
+                    os.makedirs(self.embeddings_dir, exist_ok=True)
+                    # Written under another name first, so another process never maps a partial file
+                    temporary_path = f"{path}.{os.getpid()}.tmp"
+                    with open(temporary_path, "wb") as f:
+                        np.save(f, bank)
+                    os.replace(temporary_path, path)
+                    bank = np.load(path, mmap_mode="r")
+        except Exception as e:
+            logging.warning(f"Error embedding the {len(inputs)} examples of {example_set_id} version {version}: {str(e)}")
+            with self._lock:
+                self._building.discard(digest)
+                self._build_retry_at[digest] = time.monotonic() + BUILD_RETRY_SECONDS
+                self.failures += 1
+            return
+
+        logging.info(f"Embedded the {len(inputs)} examples of {example_set_id} version {version}")
+        with self._lock:
+            self._banks[digest] = bank
+            self._building.discard(digest)
+            # The bank of the examples this version held before is no longer used
+            digests = {digested[1] for digested in self._digests.values()}
+            for stale_digest in [stale_digest for stale_digest in self._banks if stale_digest not in digests]:
+                del self._banks[stale_digest]
+
+
+example_selector = ExampleSelector(example_embeddings_dir, example_query_cache_max_entries)
@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+# Offline stand-in for the Vertex AI generateContent, streamGenerateContent, countTokens, predict (embeddings)
+# and cachedContents endpoints.
+# Point the backend at it with VERTEX_BASE_URL=http://127.0.0.1:8090 and run it with `python fake_vertex.py`.
+
+WORDS = (
+    "the revenue sales order customer region month total average count explore dimension measure "
+    "filter query dashboard trend increase decrease product category year quarter growth report "
+    "top bottom share compare rate value user segment week daily store channel margin forecast"
+).split()
+
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution in milliseconds:
+    - "fixed:200"
+    - "uniform:100:400"
+    - "lognormal:300:0.5", with the median and the sigma of the underlying normal distribution
+    Returns a function that draws a latency in seconds from a random.Random.
+    """
+    kind, *args = spec.split(":")
+    args = [float(arg) for arg in args]
+    if kind == "fixed":
+        return lambda rng: args[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1]) / 1000
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeVertexConfig:
+    """
+    Behaviour of the fake backend. Every setting defaults to an environment variable.
+    """
+
+    def __init__(
+        self,
+        seed=None,
+        latency=None,
+        chunk_latency=None,
+        output_tokens=None,
+        error_rate=None,
+        rate_limit_rate=None,
+        fail_requests=None,
+    ):
+        # Outputs only depend on the seed and the request body, latencies and errors on the seed and the order of requests
+        self.seed = seed if seed is not None else int(os.environ.get("FAKE_VERTEX_SEED", 0))
+        # Time to the full response, or to the first chunk of a stream
+        self.latency = parse_latency(latency or os.environ.get("FAKE_VERTEX_LATENCY", "lognormal:400:0.4"))
+        # Time between the chunks of a stream
+        self.chunk_latency = parse_latency(chunk_latency or os.environ.get("FAKE_VERTEX_CHUNK_LATENCY", "fixed:30"))
+        # Words in a text answer, capped by maxOutputTokens
+        self.output_tokens = output_tokens if output_tokens is not None else int(os.environ.get("FAKE_VERTEX_OUTPUT_TOKENS", 60))
+        # Fraction of requests that fail with a 500, and that are turned away with a 429
+        self.error_rate = error_rate if error_rate is not None else float(os.environ.get("FAKE_VERTEX_ERROR_RATE", 0))
+        self.rate_limit_rate = rate_limit_rate if rate_limit_rate is not None else float(os.environ.get("FAKE_VERTEX_RATE_LIMIT_RATE", 0))
+        # The next this many generations fail with a 503 whatever the seed, e.g. so that a test's first attempt is retried
+        self.fail_requests = fail_requests if fail_requests is not None else int(os.environ.get("FAKE_VERTEX_FAIL_REQUESTS", 0))
+
+
+def count_tokens(value):
+    # Roughly four characters per token, like the real tokenizer on English text
+    return max(1, len(json.dumps(value)) // 4)
+
+
+def get_embedding(text, dimensions):
+    """
+    Returns a normalized bag of words embedding, so texts sharing words are similar, like with a real embedding model.
+    """
+    values = [0.0] * dimensions
+    for word in text.lower().replace("?", " ").replace(".", " ").replace(",", " ").split():
+        digest = hashlib.sha256(word.encode("utf-8")).digest()
+        values[int.from_bytes(digest[:4], "big") % dimensions] += 1 if digest[4] % 2 else -1
+    norm = math.sqrt(sum(value * value for value in values)) or 1
+    return [value / norm for value in values]
+
+
+def get_last_user_text(contents):
+    for content in reversed(contents):
+        if content.get("role", "user") == "user":
+            return " ".join(part["text"] for part in content.get("parts", []) if "text" in part)
+    return ""
+
+
+def is_function_response_turn(contents):
+    return bool(contents) and any("functionResponse" in part for part in contents[-1].get("parts", []))
+
+
+def choose_tool(body):
+    """
+    Calls the first declared function whose name is mentioned in the last user turn,
+    e.g. find_movies for "find action movies in San Francisco".
+    """
+    contents = body.get("contents", [])
+    if is_function_response_turn(contents):
+        return None
+
+    words = set(get_last_user_text(contents).lower().replace("?", " ").replace(".", " ").split())
+    for tool in body.get("tools", []):
+        for declaration in tool.get("functionDeclarations", []):
+            if set(declaration["name"].lower().split("_")) <= words:
+                return declaration
+    return None
+
+
+def get_mentions(body):
+    """
+    Returns what a real model would repeat from the request: the name the system instruction gives it,
+    e.g. Bob for "You are a helpful assistant named Bob.", and the texts of the latest function responses.
+    """
+    system_text = " ".join(part.get("text", "") for part in (body.get("systemInstruction") or {}).get("parts", []))
+    mentions = re.findall(r"\b(?:named|called) ([A-Z]\w*)", system_text)
+
+    def add_texts(value):
+        if isinstance(value, dict):
+            for item in value.values():
+                add_texts(item)
+        elif isinstance(value, list):
+            for item in value:
+                add_texts(item)
+        elif isinstance(value, str):
+            mentions.append(value)
+
+    # The last turn with function responses, which can be followed by a question about them
+    for content in reversed(body.get("contents", [])):
+        responses = [part["functionResponse"].get("response") for part in content.get("parts", []) if "functionResponse" in part]
+        if responses:
+            add_texts(responses)
+            break
+    return mentions
+
+
+def get_location(text):
+    """
+    Returns the place the text mentions after "in", e.g. San Francisco, CA for "movies in San Francisco, CA.", or None.
+    """
+    match = re.search(r"\bin ([A-Z][\w ]*?(?:, [A-Z]{2})?)(?=[.?!,]|$)", text)
+    return match.group(1) if match else None
+
+
+def generate_args(declaration, text, rng):
+    """
+    Returns the arguments of a function call, with a location taken from the user's message when it has one.
+    """
+    args = generate_value(declaration.get("parameters", {}), rng)
+    location = get_location(text)
+    if location and "location" in declaration.get("parameters", {}).get("properties", {}):
+        args["location"] = location
+    return args
+
+
+def generate_value(schema, rng, depth=0):
+    """
+    Returns a value matching an OpenAPI schema as sent by the SDK.
+    """
+    schema_type = (schema.get("type") or "STRING").upper()
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if schema_type == "OBJECT":
+        return {name: generate_value(property_schema, rng, depth + 1) for name, property_schema in schema.get("properties", {}).items()}
+    if schema_type == "ARRAY":
+        return [generate_value(schema.get("items", {}), rng, depth + 1) for _ in range(rng.randint(1, 3) if depth < 3 else 0)]
+    if schema_type == "INTEGER":
+        return rng.randint(0, 1000)
+    if schema_type == "NUMBER":
+        return round(rng.uniform(0, 1000), 2)
+    if schema_type == "BOOLEAN":
+        return rng.random() < 0.5
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def generate_text(rng, token_count, mentions=()):
+    text = " ".join(rng.choice(WORDS) for _ in range(token_count)).capitalize() + "."
+    if mentions:
+        return f"{', '.join(mentions)}. {text}"
+    return text
+
+
+def generate_parts(body, config, rng):
+    """
+    Returns the parts of the answer: a function call, a JSON document for a response schema, or text.
+    """
+    generation_config = body.get("generationConfig", {})
+    declaration = choose_tool(body)
+    if declaration is not None:
+        return [{"functionCall": {"name": declaration["name"], "args": generate_args(declaration, get_last_user_text(body.get("contents", [])), rng)}}]
+
+    if "responseSchema" in generation_config:
+        return [{"text": json.dumps(generate_value(generation_config["responseSchema"], rng))}]
+
+    token_count = min(config.output_tokens, int(generation_config.get("maxOutputTokens", config.output_tokens)))
+    return [{"text": generate_text(rng, max(1, token_count), get_mentions(body))}]
+
+
+def get_usage_metadata(body, parts, cached_content=None):
+    prompt_token_count = count_tokens(body.get("contents", [])) + count_tokens(body.get("systemInstruction", ""))
+    candidates_token_count = count_tokens(parts)
+    usage_metadata = {
+        "promptTokenCount": prompt_token_count,
+        "candidatesTokenCount": candidates_token_count,
+        "totalTokenCount": prompt_token_count + candidates_token_count,
+    }
+    # Like Vertex, the prompt tokens include the cached ones
+    if cached_content is not None:
+        usage_metadata["cachedContentTokenCount"] = cached_content["usageMetadata"]["totalTokenCount"]
+    return usage_metadata
+
+
+def parse_ttl(ttl):
+    # Durations are sent as strings of seconds, e.g. "3600s"
+    return float(ttl.rstrip("s"))
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def get_response(parts, usage_metadata, model_name):
+    response = {
+        "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP", "index": 0}],
+        "modelVersion": model_name,
+    }
+    if usage_metadata is not None:
+        response["usageMetadata"] = usage_metadata
+    return response
+
+
+def split_parts(parts, chunk_count):
+    """
+    Splits the text of the answer into chunk_count pieces, the way a stream delivers it.
+    Function calls are sent whole in the last chunk.
+    """
+    text = "".join(part["text"] for part in parts if "text" in part)
+    chunk_size = max(1, math.ceil(len(text) / chunk_count))
+    chunks = [[{"text": text[start:start + chunk_size]}] for start in range(0, len(text), chunk_size)]
+    function_calls = [part for part in parts if "functionCall" in part]
+    if function_calls:
+        chunks.append(function_calls)
+    return chunks
+
+
+def get_error(code, status, message):
+    return JSONResponse({"error": {"code": code, "message": message, "status": status}}, code)
+
+
+def create_fake_vertex_app(config=None):
+    config = config or FakeVertexConfig()
+    # Draws latencies and injected errors, in the order requests arrive
+    request_rng = random.Random(config.seed)
+
+    # Cached contents by name, with their expiry on the wall clock
+    cached_contents = {}
+    cache_ids = itertools.count(1)
+
+    def get_cached_content(name):
+        cached_content = cached_contents.get(name)
+        if cached_content is None or cached_content["expires_at"] <= time.time():
+            cached_contents.pop(name, None)
+            return None
+        return cached_content
+
+    def get_cached_content_response(cached_content):
+        return JSONResponse({
+            **{field: value for field, value in cached_content.items() if field not in ("contents", "systemInstruction", "tools", "toolConfig", "expires_at")},
+            "expireTime": format_time(cached_content["expires_at"]),
+        })
+
+    async def create_cached_content(request: Request):
+        body = await request.json()
+        if not body.get("model"):
+            return get_error(400, "INVALID_ARGUMENT", "model is required.")
+        name = f"projects/{request.path_params['project']}/locations/{request.path_params['location']}/cachedContents/{next(cache_ids)}"
+        cached_content = {
+            **body,
+            "name": name,
+            "createTime": format_time(time.time()),
+            "expires_at": time.time() + parse_ttl(body.get("ttl", "3600s")),
+            "usageMetadata": {"totalTokenCount": count_tokens(body.get("contents", [])) + count_tokens(body.get("systemInstruction", ""))},
+        }
+        cached_content.pop("ttl", None)
+        cached_contents[name] = cached_content
+        return get_cached_content_response(cached_content)
+
+    async def handle_cached_content(request: Request):
+        name = f"projects/{request.path_params['project']}/locations/{request.path_params['location']}/cachedContents/{request.path_params['cache_id']}"
+        existing = get_cached_content(name)
+        if existing is None:
+            return get_error(404, "NOT_FOUND", f"Cached content {name} not found.")
+        if request.method == "DELETE":
+            del cached_contents[name]
+            return JSONResponse({})
+        if request.method == "PATCH":
+            body = await request.json()
+            if "ttl" in body:
+                existing["expires_at"] = time.time() + parse_ttl(body["ttl"])
+        return get_cached_content_response(existing)
+
+    async def generate(request: Request):
+        model_name, _, method = request.path_params["model"].partition(":")
+        if method not in ("generateContent", "streamGenerateContent", "countTokens", "predict"):
+            return get_error(404, "NOT_FOUND", f"Unknown method: {method}")
+
+        raw_body = await request.body()
+        try:
+            body = json.loads(raw_body)
+        except ValueError:
+            return get_error(400, "INVALID_ARGUMENT", "Invalid JSON payload")
+
+        if method == "countTokens":
+            # Counting tokens doesn't run the model, so it answers right away
+            return JSONResponse({"totalTokens": count_tokens(body.get("contents", []))})
+
+        if method == "predict":
+            # Embeddings are much faster than generations
+            await asyncio.sleep(config.latency(request_rng) / 10)
+            dimensions = body.get("parameters", {}).get("outputDimensionality", 768)
+            return JSONResponse({"predictions": [
+                {"embeddings": {"values": get_embedding(instance["content"], dimensions), "statistics": {"token_count": count_tokens(instance["content"]), "truncated": False}}}
+                for instance in body.get("instances", [])
+            ]})
+
+        await asyncio.sleep(config.latency(request_rng))
+        if config.fail_requests > 0:
+            config.fail_requests -= 1
+            return get_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+        failure = request_rng.random()
+        if failure < config.rate_limit_rate:
+            return get_error(429, "RESOURCE_EXHAUSTED", "Resource exhausted. Please try again later.")
+        if failure < config.rate_limit_rate + config.error_rate:
+            return get_error(500, "INTERNAL", "Internal error encountered.")
+
+        cached_content = None
+        if "cachedContent" in body:
+            if any(field in body for field in ("systemInstruction", "tools", "toolConfig")):
+                return get_error(400, "INVALID_ARGUMENT", "CachedContent can not be used with GenerateContent request setting system_instruction, tools or tool_config.")
+            cached_content = get_cached_content(body["cachedContent"])
+            if cached_content is None:
+                return get_error(404, "NOT_FOUND", f"Cached content {body['cachedContent']} not found.")
+            # The cache is the start of the request
+            body = {
+                **{field: cached_content[field] for field in ("systemInstruction", "tools", "toolConfig") if field in cached_content},
+                **body,
+                "contents": [*cached_content.get("contents", []), *body.get("contents", [])],
+            }
+
+        # The same request always gets the same answer for a given seed
+        output_rng = random.Random(f"{config.seed}:{hashlib.sha256(raw_body).hexdigest()}")
+        parts = generate_parts(body, config, output_rng)
+        usage_metadata = get_usage_metadata(body, parts, cached_content)
+
+        if method == "generateContent":
+            return JSONResponse(get_response(parts, usage_metadata, model_name))
+
+        chunks = split_parts(parts, output_rng.randint(2, 6))
+
+        async def events():
+            for index, chunk_parts in enumerate(chunks):
+                if index > 0:
+                    await asyncio.sleep(config.chunk_latency(request_rng))
+                # Usage is only complete on the last chunk
+                is_last = index == len(chunks) - 1
+                yield f"data: {json.dumps(get_response(chunk_parts, usage_metadata if is_last else None, model_name))}\r\n\r\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return Starlette(routes=[
+        Route("/{version}/projects/{project}/locations/{location}/publishers/google/models/{model}", generate, methods=["POST"]),
+        Route("/{version}/projects/{project}/locations/{location}/cachedContents", create_cached_content, methods=["POST"]),
+        Route("/{version}/projects/{project}/locations/{location}/cachedContents/{cache_id}", handle_cached_content, methods=["GET", "PATCH", "DELETE"]),
+    ])
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(create_fake_vertex_app(), host="127.0.0.1", port=int(os.environ.get("FAKE_VERTEX_PORT", 8090)), log_level="warning")
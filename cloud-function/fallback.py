@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+
+from admission import AdmissionRejected
+from circuit_breaker import CircuitOpen
+from retry import RetriesExhausted, is_retriable, remaining_seconds
+
+
+# Models to try, in order, when a model fails, as "model=fallback|fallback,model=fallback"
+model_fallbacks_config = os.environ.get("MODEL_FALLBACKS", "")
+# Time kept back from a model for the models after it in the chain
+fallback_reserve_seconds = float(os.environ.get("FALLBACK_RESERVE_SECONDS", 15))
+# A fallback isn't started with less time than this left
+fallback_min_seconds = float(os.environ.get("FALLBACK_MIN_SECONDS", 2))
+
+
+def parse_model_fallbacks(config):
+    fallbacks = {}
+    for item in config.split(","):
+        if "=" not in item:
+            continue
+        name, chain = item.split("=", 1)
+        fallbacks[name.strip()] = [model.strip() for model in chain.split("|") if model.strip()]
+    return fallbacks
+
+
+model_fallbacks = parse_model_fallbacks(model_fallbacks_config)
+
+
+class UnusableResponse(Exception):
+    """
+    Raised when the model answered, but with no candidate or one that can't be parsed.
+    """
+
+
+def get_model_chain(model_name):
+    return [model_name] + [model for model in model_fallbacks.get(model_name, []) if model != model_name]
+
+
+def should_fall_back(error):
+    """
+    Timeouts, quota and capacity errors, upstream failures and unusable answers move on to the next model.
+    An invalid request would fail on every model, so it doesn't.
+    """
+    if isinstance(error, (AdmissionRejected, CircuitOpen, RetriesExhausted, UnusableResponse)):
+        return True
+    return is_retriable(error)
+
+
+def get_model_deadline(deadline, models_left):
+    """
+    Returns the deadline for one model in the chain, keeping time back for the models after it
+    unless that would leave this model with too little.
+    """
+    if models_left == 0:
+        return deadline
+    model_deadline = deadline - fallback_reserve_seconds
+    if model_deadline - time.monotonic() < fallback_min_seconds:
+        return deadline
+    return model_deadline
+
+
+def _can_fall_back(error, index, chain, deadline):
+    if index == len(chain) - 1 or not should_fall_back(error):
+        return False
+    if remaining_seconds(deadline) < fallback_min_seconds:
+        return False
+
+    logging.warning(f"Falling back from {chain[index]} to {chain[index + 1]}: {str(error)}")
+    return True
+
+
+def call_with_fallback(model_name, deadline, fn):
+    """
+    Calls fn(model, model_deadline) for each model in the chain of model_name until one succeeds.
+    Returns the result and the model that produced it.
+    """
+    chain = get_model_chain(model_name)
+    for index, model in enumerate(chain):
+        try:
+            return fn(model, get_model_deadline(deadline, len(chain) - index - 1)), model
+        except Exception as e:
+            if not _can_fall_back(e, index, chain, deadline):
+                raise
+
+
+async def call_with_fallback_async(model_name, deadline, coroutine_fn):
+    """
+    Async version of call_with_fallback.
+    """
+    chain = get_model_chain(model_name)
+    for index, model in enumerate(chain):
+        try:
+            return await coroutine_fn(model, get_model_deadline(deadline, len(chain) - index - 1)), model
+        except Exception as e:
+            if not _can_fall_back(e, index, chain, deadline):
+                raise
@@ -0,0 +1,194 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+hedging_enabled = os.environ.get("HEDGE_REQUESTS", "0") == "1"
+# Start the hedge once the primary call is slower than this percentile of recent calls to the model
+hedge_percentile = float(os.environ.get("HEDGE_PERCENTILE", 95))
+# Don't hedge until there are enough recent calls to estimate the percentile
+hedge_min_samples = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+# Fraction of calls that may be hedged, to keep the extra spend bounded
+hedge_max_rate = float(os.environ.get("HEDGE_MAX_RATE", 0.05))
+# Region the hedge is sent to; defaults to the primary region
+hedge_location = os.environ.get("HEDGE_REGION")
+hedge_max_workers = int(os.environ.get("HEDGE_MAX_WORKERS", 40))
+
+LATENCY_WINDOW = 200
+RATE_WINDOW = 1000
+
+
+class LatencyTracker:
+    """
+    Keeps the latency of the most recent successful calls per model.
+    """
+
+    def __init__(self, window):
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, model_name, latency_seconds):
+        with self._lock:
+            self._latencies[model_name].append(latency_seconds)
+
+    def percentile(self, model_name, percentile):
+        with self._lock:
+            latencies = sorted(self._latencies[model_name])
+        if len(latencies) < hedge_min_samples:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class HedgeBudget:
+    """
+    Allows a hedge only while the fraction of hedged calls among the most recent calls stays under max_rate.
+    """
+
+    def __init__(self, max_rate, window):
+        self.max_rate = max_rate
+        self._decisions = collections.deque(maxlen=window)
+        self._hedged = 0
+        self._lock = threading.Lock()
+
+    def record(self, hedged):
+        with self._lock:
+            self._append(1 if hedged else 0)
+
+    def try_hedge(self):
+        with self._lock:
+            allowed = self._hedged + 1 <= self.max_rate * (len(self._decisions) + 1)
+            self._append(1 if allowed else 0)
+            return allowed
+
+    def _append(self, decision):
+        if len(self._decisions) == self._decisions.maxlen:
+            self._hedged -= self._decisions[0]
+        self._decisions.append(decision)
+        self._hedged += decision
+
+
+latency_tracker = LatencyTracker(LATENCY_WINDOW)
+hedge_budget = HedgeBudget(hedge_max_rate, RATE_WINDOW)
+_executor = ThreadPoolExecutor(max_workers=hedge_max_workers, thread_name_prefix="hedge")
+
+_stats = {
+    "hedged": 0,
+    "hedge_wins": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_hedge_delay(model_name):
+    if not hedging_enabled:
+        return None
+    return latency_tracker.percentile(model_name, hedge_percentile)
+
+
+def _timed(fn, model_name):
+    start = time.monotonic()
+    result = fn()
+    latency_tracker.record(model_name, time.monotonic() - start)
+    return result
+
+
+async def _timed_async(coroutine_fn, model_name):
+    start = time.monotonic()
+    result = await coroutine_fn()
+    latency_tracker.record(model_name, time.monotonic() - start)
+    return result
+
+
+def call_hedged(primary_fn, hedge_fn, model_name):
+    """
+    Calls primary_fn, and if it hasn't returned within the hedge delay, calls hedge_fn as well.
+    The first successful result wins. The sync SDK can't abort a request in flight,
+    so the slower call is left to finish in the background and its result is discarded.
+    """
+    hedge_delay = get_hedge_delay(model_name)
+    if hedge_delay is None:
+        hedge_budget.record(False)
+        return _timed(primary_fn, model_name)
+
+    primary = _executor.submit(contextvars.copy_context().run, _timed, primary_fn, model_name)
+    done, _ = wait([primary], timeout=hedge_delay)
+    if done:
+        hedge_budget.record(False)
+        return primary.result()
+    if not hedge_budget.try_hedge():
+        return primary.result()
+
+    logging.info(f"Hedging call to {model_name} after {hedge_delay:.2f}s")
+    _count("hedged")
+    hedge = _executor.submit(contextvars.copy_context().run, _timed, hedge_fn, model_name)
+
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.cancel()
+                if future is hedge:
+                    _count("hedge_wins")
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def call_hedged_async(primary_fn, hedge_fn, model_name):
+    """
+    Async version of call_hedged. The slower call is cancelled.
+    """
+    hedge_delay = get_hedge_delay(model_name)
+    if hedge_delay is None:
+        hedge_budget.record(False)
+        return await _timed_async(primary_fn, model_name)
+
+    primary = asyncio.ensure_future(_timed_async(primary_fn, model_name))
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            hedge_budget.record(False)
+            return await primary
+        if not hedge_budget.try_hedge():
+            return await primary
+
+        logging.info(f"Hedging call to {model_name} after {hedge_delay:.2f}s")
+        _count("hedged")
+        hedge = asyncio.ensure_future(_timed_async(hedge_fn, model_name))
+        tasks.append(hedge)
+
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        _count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # Also when the caller is cancelled while waiting, so no call is left running without an owner
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def hedge_stats():
+    with _stats_lock:
+        return dict(_stats)
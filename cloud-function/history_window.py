@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+
+from lazy import lazy_import
+from response_cache import ResponseCache
+
+types = lazy_import("google.genai.types")
+
+
+# "off" sends the whole history, "turns" keeps the last history_max_turns turns,
+# "tokens" keeps the most recent turns that fit in history_token_budget
+history_policy = os.environ.get("HISTORY_POLICY", "off")
+history_max_turns = int(os.environ.get("HISTORY_MAX_TURNS", 20))
+history_token_budget = int(os.environ.get("HISTORY_TOKEN_BUDGET", 30000))
+# Replace the turns that are left out with a summary written by history_summary_model, instead of dropping them
+history_summarize = os.environ.get("HISTORY_SUMMARIZE", "0") == "1"
+history_summary_model = os.environ.get("HISTORY_SUMMARY_MODEL", "gemini-1.5-flash")
+history_summary_max_tokens = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", 1024))
+
+POLICY_MODES = ("off", "turns", "tokens")
+# Roughly four characters per token on English text, plus the framing of every turn
+CHARACTERS_PER_TOKEN = 4
+TOKENS_PER_TURN = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an assistant, so that the assistant can continue it "
+    "without the original. Keep every fact, name, number, decision and function result that may be needed later. "
+    "Answer with the summary only.\n\n"
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# Summaries are kept, so the same earlier turns are only summarized once
+summary_cache = ResponseCache(1000, 16 * 1024 * 1024, 3600)
+
+
+def get_history_policy(overrides=None):
+    """
+    Returns the policy from the environment, with the fields of a request's "history_policy" object applied:
+    {"mode": "off" | "turns" | "tokens", "max_turns": int, "token_budget": int, "summarize": bool}
+    """
+    policy = {
+        "mode": history_policy,
+        "max_turns": history_max_turns,
+        "token_budget": history_token_budget,
+        "summarize": history_summarize,
+    }
+    if overrides:
+        policy.update(overrides)
+    return policy
+
+
+def is_invalid_history_policy(overrides):
+    if overrides is None:
+        return None
+    if not isinstance(overrides, dict):
+        return "history_policy must be an object"
+    if set(overrides) - {"mode", "max_turns", "token_budget", "summarize"}:
+        return "history_policy can only contain mode, max_turns, token_budget and summarize"
+    if "mode" in overrides and overrides["mode"] not in POLICY_MODES:
+        return f"history_policy mode must be one of {', '.join(POLICY_MODES)}"
+    for field in ("max_turns", "token_budget"):
+        if field in overrides and (type(overrides[field]) is not int or overrides[field] < 1):
+            return f"history_policy {field} must be a positive integer"
+    if "summarize" in overrides and not isinstance(overrides["summarize"], bool):
+        return "history_policy summarize must be a boolean"
+    return None
+
+
+def estimate_tokens(content):
+    """
+    Estimates the tokens of a turn from its length, without a call to count_tokens.
+    """
+    characters = 0
+    for part in content.parts or []:
+        if part.text:
+            characters += len(part.text)
+        elif part.function_call:
+            characters += len(part.function_call.name or "") + len(json.dumps(part.function_call.args, default=str))
+        elif part.function_response:
+            characters += len(part.function_response.name or "") + len(json.dumps(part.function_response.response, default=str))
+    return characters // CHARACTERS_PER_TOKEN + TOKENS_PER_TURN
+
+
+def is_turn_start(content):
+    # A turn starts with a user message. Function responses belong to the turn of the function call they answer.
+    return content.role == "user" and not any(part.function_response for part in content.parts or [])
+
+
+def window_contents(contents, policy):
+    """
+    Splits the contents into the turns that are dropped and the most recent turns that are kept under the policy.
+    A turn is a user message with everything that follows it up to the next user message: the model's answer,
+    and any function calls and their responses, which are kept or dropped together. The last turn, which holds
+    the request's own message, is always kept.
+    Walks back from the end, so only the kept turns are looked at. Returns (kept, dropped).
+    """
+    if policy["mode"] == "off" or not contents:
+        return contents, []
+
+    kept_from = len(contents)
+    turn_count = 0
+    token_count = 0
+    for index in range(len(contents) - 1, -1, -1):
+        if index > 0 and not is_turn_start(contents[index]):
+            continue
+
+        turn_tokens = sum(estimate_tokens(content) for content in contents[index:kept_from]) if policy["mode"] == "tokens" else 0
+        if kept_from < len(contents):
+            if policy["mode"] == "turns" and turn_count >= policy["max_turns"]:
+                break
+            if policy["mode"] == "tokens" and token_count + turn_tokens > policy["token_budget"]:
+                break
+
+        turn_count += 1
+        token_count += turn_tokens
+        kept_from = index
+
+    return contents[kept_from:], contents[:kept_from]
+
+
+def get_transcript(contents):
+    """
+    Writes turns out as plain text, so they can be summarized whatever their roles and parts.
+    """
+    lines = []
+    for content in contents:
+        for part in content.parts or []:
+            if part.text:
+                lines.append(f"{content.role}: {part.text}")
+            elif part.function_call:
+                lines.append(f"{content.role} called {part.function_call.name}({json.dumps(part.function_call.args, default=str)})")
+            elif part.function_response:
+                lines.append(f"{part.function_response.name} returned {json.dumps(part.function_response.response, default=str)}")
+    return "\n".join(lines)
+
+
+def get_summary_request(dropped):
+    """
+    Returns the summary cache key, and the contents and config of the request that summarizes the dropped turns.
+    """
+    transcript = get_transcript(dropped)
+    key = hashlib.sha256(f"{history_summary_model}:{transcript}".encode("utf-8")).hexdigest()
+    contents = [types.Content(role="user", parts=[types.Part(text=SUMMARY_PROMPT + transcript)])]
+    config = types.GenerateContentConfig(temperature=0, max_output_tokens=history_summary_max_tokens, candidate_count=1)
+    return key, contents, config
+
+
+def add_summary(kept, summary):
+    """
+    Puts the summary in front of the oldest kept turn, which is always a user message,
+    so the roles of the conversation still alternate.
+    """
+    first = kept[0]
+    summarized = types.Content(role=first.role, parts=[types.Part(text=SUMMARY_PREFIX + summary), *(first.parts or [])])
+    return [summarized, *kept[1:]]
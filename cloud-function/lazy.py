@@ -0,0 +1,28 @@
+import importlib
+import threading
+
+
+# Held while a lazy module is imported. When two threads import packages with circular imports at once,
+# Python's import locks can hand one of them a partially initialized module instead of deadlocking.
+_lock = threading.RLock()
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used.
+    Keeps the SDKs that take most of the import time off the cold start path.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        with _lock:
+            module = importlib.import_module(self._name)
+        # Later lookups find the module's attributes directly, without going through __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    return LazyModule(name)
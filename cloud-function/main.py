@@ -1,21 +1,105 @@
 import json
 import os
 import hmac
+import contextlib
+import contextvars
+import functools
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, Response
 from flask_cors import CORS
 import functions_framework
-from google import genai
-from google.genai import types
 import logging
+from admission import AdmissionRejected, admission_stats, admit, admit_async
+from circuit_breaker import CircuitOpen, call_with_circuit_breaker, call_with_circuit_breaker_async, circuit_stats
+from client_pool import defer_warm_up, get_client, get_client_async, retry_failed_warm_up, start_deferred_warm_up, start_warm_up, warm_up, warm_up_status
+from context_cache import call_with_context_cache, call_with_context_cache_async, get_prefix_hashes
+from example_selector import example_embedding_model, example_selector, get_embedding_config, top_k
+from fallback import UnusableResponse, call_with_fallback, call_with_fallback_async
+from hedging import call_hedged, call_hedged_async, hedge_location
+from history_window import (
+    add_summary,
+    get_history_policy,
+    get_summary_request,
+    history_summary_model,
+    is_invalid_history_policy,
+    summary_cache,
+    window_contents,
+)
+from lazy import lazy_import
+from metrics import get_metrics, instrument_route, record_usage, time_stage, time_upstream
+from prompt_registry import PromptTemplateError, is_invalid_template_reference, prompt_registry
+from region_router import choose_region, observe, region_stats
+from response_cache import is_cacheable, request_hash, response_cache
+from retry import RetriesExhausted, call_with_retry, call_with_retry_async, get_deadline, remaining_seconds
+from sessions import SessionError, is_valid_session_id, session_store
+from singleflight import async_inflight_requests, inflight_requests
+from tracing import get_request_attributes, get_usage_attributes, set_span_attributes, start_span, trace_route, traced
 
 logging.basicConfig(level=logging.INFO)
 
+# google.genai takes most of the import time, so it is loaded by the warm-up or on first use
+types = lazy_import("google.genai.types")
+
 
 # Initialize the Vertex AI
 project = os.environ.get("PROJECT")
 location = os.environ.get("REGION", "us-central1")
 vertex_cf_auth_token = os.environ.get("VERTEX_CF_AUTH_TOKEN")
 model_name = os.environ.get("MODEL_NAME", "gemini-1.5-flash")
+# Seconds of silence after which a streaming response sends a heartbeat comment
+stream_heartbeat_seconds = float(os.environ.get("STREAM_HEARTBEAT_SECONDS", 10))
+# Share one upstream call between concurrent identical requests
+coalesce_requests = os.environ.get("COALESCE_REQUESTS", "1") == "1"
+# Largest request body accepted, checked before the body is read
+max_request_bytes = int(os.environ.get("MAX_REQUEST_BYTES", 8 * 1024 * 1024))
+# Limits for /batch_generate_content
+batch_max_requests = int(os.environ.get("BATCH_MAX_REQUESTS", 20))
+batch_max_parallelism = int(os.environ.get("BATCH_MAX_PARALLELISM", 5))
+# Load the SDK and create the Vertex AI client on a background thread as soon as the instance starts
+warm_up_on_start = os.environ.get("WARM_UP_ON_START", "1") == "1"
+# Count the tokens of a one word prompt during the warm-up, which opens the connection to Vertex AI
+warm_up_probe = os.environ.get("WARM_UP_PROBE", "1") == "1"
+
+# Errors that turn a request away with their own status code
+REJECTED_ERRORS = (AdmissionRejected, CircuitOpen, RetriesExhausted, SessionError, PromptTemplateError)
+# Paths served by the Cloud Function, each counted under its own label in the request metrics
+SERVED_PATHS = (
+    "/generate_content",
+    "/stream_generate_content",
+    "/batch_generate_content",
+    "/admission_stats",
+    "/circuit_stats",
+    "/region_stats",
+    "/cache_stats",
+    "/metrics",
+    "/warmup",
+    "/readiness",
+    "/liveness",
+)
+# Routes without a JSON body that still need a signature, over their raw body, which is empty for a GET.
+# They expose the internals of the backend, or start calls to Vertex AI that are billed to the project.
+SIGNED_STATUS_PATHS = (
+    "/admission_stats",
+    "/circuit_stats",
+    "/region_stats",
+    "/cache_stats",
+    "/metrics",
+    "/warmup",
+)
+# Events a streaming response holds for a client that reads slower than the model writes
+STREAM_QUEUE_MAX_EVENTS = 64
+# How often a producer blocked on a full stream queue checks whether the client went away
+STREAM_CANCEL_CHECK_SECONDS = 0.1
+
+if warm_up_on_start:
+    if os.environ.get("FUNCTION_TARGET"):
+        # functions_framework forks its gunicorn worker after loading this module, and each worker warms up on its own
+        defer_warm_up(project, location, model_name if warm_up_probe else None)
+    else:
+        start_warm_up(project, location, model_name if warm_up_probe else None)
 
 
 def is_invalid_history(history):
@@ -45,198 +129,1318 @@ def get_response_headers(request):
     headers = {
         "Access-Control-Allow-Origin": "*",
         "Access-Control-Allow-Methods": "POST, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, X-Signature"
+        "Access-Control-Allow-Headers": "Content-Type, X-Signature",
+        "Access-Control-Expose-Headers": "X-Model-Name, X-Session-Id, X-Prompt-Token-Count, X-Cached-Token-Count, Retry-After"
     }
     return headers
 
 
-def has_valid_signature(request):
-    signature = request.headers.get("X-Signature")
+def get_model_response_headers(request, answered_model, session_id=None, usage=None):
+    headers = get_response_headers(request)
+    # The model that answered, which differs from the requested one after a fallback
+    headers["X-Model-Name"] = answered_model
+    if session_id:
+        headers["X-Session-Id"] = session_id
+    # The tokens the model was sent, after the history policy was applied
+    if usage and usage.get("prompt_token_count") is not None:
+        headers["X-Prompt-Token-Count"] = str(usage["prompt_token_count"])
+    if usage and usage.get("cached_content_token_count") is not None:
+        headers["X-Cached-Token-Count"] = str(usage["cached_content_token_count"])
+    return headers
+
+
+def get_rejected_response(request, error):
+    headers = get_response_headers(request)
+    if error.retry_after is not None:
+        headers["Retry-After"] = str(error.retry_after)
+    return {"error": str(error)}, error.status_code, headers
+
+
+def is_valid_signature(signature, request_data):
     if signature is None:
         return False
 
     # Validate the signature
     secret = vertex_cf_auth_token.encode("utf-8")
-    request_data = request.get_data()
     hmac_obj = hmac.new(secret, request_data, "sha256")
     expected_signature = hmac_obj.hexdigest()
 
     return hmac.compare_digest(signature, expected_signature)
 
 
-def gemini_generate(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None):
+def has_valid_signature(request):
+    return is_valid_signature(request.headers.get("X-Signature"), request.get_data())
+
+
+# Length of a hex encoded HMAC-SHA256 signature
+SIGNATURE_LENGTH = 64
+
+
+def check_request_preconditions(signature, content_length):
+    """
+    Rejects requests that can be turned away without reading the body:
+    a missing or malformed signature, or a declared body size over max_request_bytes.
+    """
+    if signature is None or len(signature) != SIGNATURE_LENGTH:
+        return {"error": "Invalid signature"}, 403
+
+    if content_length is not None and content_length > max_request_bytes:
+        return {"error": "Request body too large"}, 413
+
+    return None
+
+
+def check_signed_body(signature, request_data):
+    """
+    Checks the signature over the raw body. Returns an error response tuple, or None.
+    """
+    if len(request_data) > max_request_bytes:
+        return {"error": "Request body too large"}, 413
+
+    with time_stage("signature"), start_span("signature"):
+        valid_signature = is_valid_signature(signature, request_data)
+    if not valid_signature:
+        return {"error": "Invalid signature"}, 403
+
+    return None
+
+
+def parse_signed_body(signature, request_data):
+    """
+    Checks the signature over the raw body, and only then parses the JSON from the same bytes.
+    """
+    error_response = check_signed_body(signature, request_data)
+    if error_response:
+        return None, error_response
+
     try:
-        # Define default parameters
-        default_parameters = {
-            "temperature": 1,
-            "max_output_tokens": 8192,
-            "top_p": 0.95,
-        }
+        return json.loads(request_data), None
+    except ValueError:
+        return None, ({"error": "Invalid JSON body"}, 400)
 
-        # Override default parameters with any provided in the request
-        if parameters:
-            default_parameters.update(parameters)
-
-        # Instantiate Gemini model for prediction
-        client = genai.Client(vertexai=True, project=project, location=location)
-        content_list = []
-        for x in history:
-            role = x["role"]
-            one_content_list = []
-            for part in x["parts"]:
-                if isinstance(part, dict):  # Handle structured parts (function calls or function responses)
-                    if "functionCall" in part:
-                        one_content_list.append(
-                            types.Part(
-                                function_call=types.FunctionCall(
-                                    name=part["functionCall"]["name"],
-                                    args=part["functionCall"]["args"]
-                                )
+
+def read_body(request):
+    """
+    Reads the raw body of a Flask request once, at most max_request_bytes of it,
+    unless the request can be turned away without it. Returns the body, or an error response tuple.
+    """
+    error_response = check_request_preconditions(request.headers.get("X-Signature"), request.content_length)
+    if error_response:
+        return None, error_response
+
+    # Read one byte past the limit so that oversized bodies without a Content-Length are detected
+    with time_stage("ingest"):
+        return request.stream.read(max_request_bytes + 1), None
+
+
+def ingest_request(request):
+    """
+    Reads the raw body of a Flask request and returns the parsed JSON only if the signature matches.
+    """
+    request_data, error_response = read_body(request)
+    if error_response:
+        return None, error_response
+    return parse_signed_body(request.headers.get("X-Signature"), request_data)
+
+
+def check_signature(request):
+    """
+    Checks the signature of a Flask request to one of SIGNED_STATUS_PATHS. Returns an error response tuple, or None.
+    """
+    request_data, error_response = read_body(request)
+    if error_response:
+        return error_response
+    return check_signed_body(request.headers.get("X-Signature"), request_data)
+
+
+def signature_required(view):
+    """
+    Answers a Flask request to a route without a JSON body only if it is signed.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        error_response = check_signature(request)
+        if error_response:
+            return error_response
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def build_generate_request(contents, parameters=None, response_schema=None, history=[], tools=[], system_instruction=None):
+    # Define default parameters
+    default_parameters = {
+        "temperature": 1,
+        "max_output_tokens": 8192,
+        "top_p": 0.95,
+    }
+
+    # Override default parameters with any provided in the request
+    if parameters:
+        default_parameters.update(parameters)
+
+    content_list = []
+    for x in history:
+        role = x["role"]
+        one_content_list = []
+        for part in x["parts"]:
+            if isinstance(part, dict):  # Handle structured parts (function calls or function responses)
+                if "functionCall" in part:
+                    one_content_list.append(
+                        types.Part(
+                            function_call=types.FunctionCall(
+                                name=part["functionCall"]["name"],
+                                args=part["functionCall"]["args"]
                             )
                         )
-                    elif "functionResponse" in part:
-                        one_content_list.append(
-                            types.Part(
-                                function_response=types.FunctionResponse(
-                                    name=part["functionResponse"]["name"],
-                                    response=part["functionResponse"]["response"]
-                                )
+                    )
+                elif "functionResponse" in part:
+                    one_content_list.append(
+                        types.Part(
+                            function_response=types.FunctionResponse(
+                                name=part["functionResponse"]["name"],
+                                response=part["functionResponse"]["response"]
                             )
                         )
-                else:  # Handle plain text parts
-                    one_content_list.append(types.Part(text=part))
-            content_list.append(types.Content(parts=one_content_list, role=role))
-
-        if contents:
-            content_list.append(types.Content(parts=[types.Part(text=contents)], role="user"))
-
-        config = types.GenerateContentConfig(
-            temperature=default_parameters["temperature"],
-            top_p=default_parameters["top_p"],
-            max_output_tokens=default_parameters["max_output_tokens"],
-            candidate_count=1,
-            response_schema=response_schema,
-            response_mime_type=response_schema and "application/json" or 'text/plain'
+                    )
+            else:  # Handle plain text parts
+                one_content_list.append(types.Part(text=part))
+        content_list.append(types.Content(parts=one_content_list, role=role))
+
+    if contents:
+        content_list.append(types.Content(parts=[types.Part(text=contents)], role="user"))
+
+    config = types.GenerateContentConfig(
+        temperature=default_parameters["temperature"],
+        top_p=default_parameters["top_p"],
+        max_output_tokens=default_parameters["max_output_tokens"],
+        candidate_count=1,
+        response_schema=response_schema,
+        response_mime_type=response_schema and "application/json" or 'text/plain'
+    )
+
+    if system_instruction:
+        config.system_instruction = system_instruction
+
+    if tools and type(tools) == list and len(tools) > 0:
+        config.tool_config = types.ToolConfig(
+            function_calling_config=types.FunctionCallingConfig(
+                mode='AUTO',
+            )
         )
+        config.tools = []
+        for tool in tools:
+            config.tools.append(types.Tool(
+                function_declarations=[
+                    types.FunctionDeclaration(
+                        name=tool['name'],
+                        description=tool['description'],
+                        parameters=tool['parameters']
+                    )
+                ]
+            ))
+
+    return content_list, config
+
+
+def get_response_parts(response, response_schema=None):
+    # return the function call or the text response
+    condidate = response.candidates[0]
+
+    response_parts = []
+    for part in condidate.content.parts:
+        if part.function_call:
+            response_parts.append({"functionCall": {
+                "name": part.function_call.name,
+                "args": part.function_call.args
+            }})
+        elif response_schema:
+            response_parts.append({"object": json.loads(part.text)})
+        else:
+            response_parts.append({"text": part.text})
+
+    return response_parts
+
+
+def get_usage(response):
+    usage_metadata = response.usage_metadata
+    if usage_metadata is None:
+        return {}
+
+    usage = {
+        "prompt_token_count": usage_metadata.prompt_token_count,
+        "candidates_token_count": usage_metadata.candidates_token_count,
+        "total_token_count": usage_metadata.total_token_count,
+    }
+    # The part of the prompt read from a context cache, billed at a lower rate
+    if usage_metadata.cached_content_token_count:
+        usage["cached_content_token_count"] = usage_metadata.cached_content_token_count
+    return usage
+
+
+def set_request_timeout(config, deadline):
+    # Don't let a single attempt outlive the request's time budget
+    config.http_options = types.HttpOptions(timeout=max(1, int(remaining_seconds(deadline) * 1000)))
+
+
+def get_chunk_events(chunk):
+    if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+        return
+
+    for part in chunk.candidates[0].content.parts:
+        if part.function_call:
+            yield "functionCall", {
+                "name": part.function_call.name,
+                "args": part.function_call.args
+            }
+        elif part.text:
+            yield "text", {"text": part.text}
+
+
+def get_streamed_part(event, data):
+    # The part as get_response_parts returns it, so a streamed answer is kept in a session like any other
+    return {"functionCall": data} if event == "functionCall" else data
+
+
+def get_usable_response_parts(response, response_schema=None):
+    try:
+        with time_stage("response_parsing"), start_span("response_parsing"):
+            response_parts = get_response_parts(response, response_schema)
+    except (AttributeError, IndexError, TypeError, ValueError) as e:
+        raise UnusableResponse(f"Unusable response: {str(e)}") from e
+
+    if not response_parts:
+        raise UnusableResponse("Unusable response: no parts in candidate")
+    return response_parts
+
+
+def window_history(content_list, policy, deadline):
+    """
+    Applies the history policy to the contents sent to the model. The turns it leaves out are dropped,
+    or replaced by a summary when the policy asks for one and the summary could be written.
+    """
+    kept, dropped = window_contents(content_list, policy)
+    if not dropped or not policy["summarize"]:
+        return kept
+
+    key, summary_contents, config = get_summary_request(dropped)
+    summary = summary_cache.get(key)
+    if summary is None:
+        try:
+            set_request_timeout(config, deadline)
+            client = get_client(project, location)
+            with (
+                admit(history_summary_model),
+                time_upstream(history_summary_model, location),
+                start_span("history_summary", {"gen_ai.request.model": history_summary_model, "gemini.summarized_turns": len(dropped)}),
+            ):
+                response = client.models.generate_content(model=history_summary_model, contents=summary_contents, config=config)
+            record_usage(history_summary_model, get_usage(response))
+            summary = response.text
+        except Exception as e:
+            logging.warning(f"Error summarizing the history, dropping {len(dropped)} earlier contents instead: {str(e)}")
+            return kept
+        if summary:
+            summary_cache.put(key, summary)
+
+    return add_summary(kept, summary) if summary else kept
+
+
+async def window_history_async(content_list, policy, deadline):
+    """
+    Same as window_history, using the SDK's async client for the summary.
+    """
+    kept, dropped = window_contents(content_list, policy)
+    if not dropped or not policy["summarize"]:
+        return kept
+
+    key, summary_contents, config = get_summary_request(dropped)
+    summary = summary_cache.get(key)
+    if summary is None:
+        try:
+            set_request_timeout(config, deadline)
+            client = await get_client_async(project, location)
+            async with admit_async(history_summary_model):
+                with (
+                    time_upstream(history_summary_model, location),
+                    start_span("history_summary", {"gen_ai.request.model": history_summary_model, "gemini.summarized_turns": len(dropped)}),
+                ):
+                    response = await client.aio.models.generate_content(model=history_summary_model, contents=summary_contents, config=config)
+            record_usage(history_summary_model, get_usage(response))
+            summary = response.text
+        except Exception as e:
+            logging.warning(f"Error summarizing the history, dropping {len(dropped)} earlier contents instead: {str(e)}")
+            return kept
+        if summary:
+            summary_cache.put(key, summary)
+
+    return add_summary(kept, summary) if summary else kept
+
+
+def apply_template(template, contents, system_instruction):
+    """
+    Returns the user message, the system instruction and the example turns of a request, rendered from the prompt template
+    it references. The request's own contents and system instruction take precedence over the template's.
+    """
+    if template is None:
+        return contents, system_instruction, []
+
+    prompt = prompt_registry.render(template)
+    message = contents if contents is not None else prompt.contents
+    return message, system_instruction or prompt.system_instruction, prompt.example_contents
+
+
+def is_selecting_examples(template, message, example_contents):
+    example_count = template and template.get("example_count")
+    return bool(example_count and message and len(example_contents) > 2 * example_count)
+
+
+def get_query_embedding_config(deadline):
+    config = get_embedding_config()
+    set_request_timeout(config, deadline)
+    return config
+
+
+@contextlib.contextmanager
+def message_embedding(bank):
+    """
+    Times and traces the call embedding the request's message in the block. When it fails, the error is logged
+    and swallowed, and all the examples are sent.
+    """
+    try:
+        with time_upstream(example_embedding_model, location), start_span("example_embedding", {"gen_ai.request.model": example_embedding_model}):
+            yield
+    except Exception as e:
+        logging.warning(f"Error embedding the message, sending all {len(bank)} examples: {str(e)}")
+
+
+def get_selected_examples(template, example_contents, bank, query):
+    """
+    Returns the template's example_count examples whose inputs are the most similar to the query,
+    or all of them without a bank or a query.
+    """
+    if bank is None or query is None:
+        return example_contents
+
+    example_count = template["example_count"]
+    with time_stage("example_selection"), start_span("example_selection", {"gemini.example_bank_size": len(bank), "gemini.example_count": example_count}):
+        indices = top_k(bank, query, example_count)
+        return [content for index in indices for content in example_contents[2 * index:2 * index + 2]]
+
+
+def select_examples(template, message, example_contents, deadline):
+    """
+    Keeps the template's example_count examples whose inputs are the most similar to the request's message.
+    All of the examples are sent while the example bank is being embedded, or when the message can't be embedded
+    before the deadline.
+    """
+    if not is_selecting_examples(template, message, example_contents):
+        return example_contents
+
+    client = get_client(project, location)
+    bank = example_selector.get_bank(client, template["examples"], template["examples_version"], example_contents)
+    query = example_selector.get_query_embedding(message) if bank is not None else None
+    if bank is not None and query is None:
+        with message_embedding(bank):
+            response = client.models.embed_content(model=example_embedding_model, contents=[message], config=get_query_embedding_config(deadline))
+            query = example_selector.put_query_embedding(message, response.embeddings[0].values)
+
+    return get_selected_examples(template, example_contents, bank, query)
+
+
+async def select_examples_async(template, message, example_contents, deadline):
+    """
+    Same as select_examples, using the SDK's async client to embed the message.
+    """
+    if not is_selecting_examples(template, message, example_contents):
+        return example_contents
+
+    client = await get_client_async(project, location)
+    bank = example_selector.get_bank(client, template["examples"], template["examples_version"], example_contents)
+    query = example_selector.get_query_embedding(message) if bank is not None else None
+    if bank is not None and query is None:
+        with message_embedding(bank):
+            response = await client.aio.models.embed_content(model=example_embedding_model, contents=[message], config=get_query_embedding_config(deadline))
+            query = example_selector.put_query_embedding(message, response.embeddings[0].values)
+
+    return get_selected_examples(template, example_contents, bank, query)
 
-        if system_instruction:
-            config.system_instruction = system_instruction
 
-        if tools and type(tools) == list and len(tools) > 0:
-            config.tool_config = types.ToolConfig(
-                function_calling_config=types.FunctionCallingConfig(
-                    mode='AUTO',
-                )
+def open_session(session_id, tools, system_instruction):
+    """
+    Returns the session a turn continues, or None without a session_id, along with the tools and
+    system instruction of the turn, which default to the ones the session was last sent.
+    """
+    if not session_id:
+        return None, tools, system_instruction
+
+    session = session_store.get(session_id)
+    return session, tools or session.tools, system_instruction or session.system_instruction
+
+
+def build_content_list(template, contents, parameters, response_schema, history, tools, system_instruction, session):
+    """
+    Renders the template and converts the message and the history, ahead of the example selection and the history
+    window, which have their own sync and async versions.
+    Returns the message, the template's examples, the new turns, every turn to send and the config.
+    """
+    with time_stage("history_conversion"), start_span("content_building"):
+        message, instruction, example_contents = apply_template(template, contents, system_instruction)
+        new_contents, config = build_generate_request(message, parameters, response_schema, history, tools, instruction)
+        # Only the new turns are converted, the session's turns already are
+        content_list = [*session.contents, *new_contents] if session is not None else new_contents
+    return message, example_contents, new_contents, content_list, config
+
+
+@traced("gemini_generate")
+def gemini_generate_with_model(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None, deadline=None):
+    """
+    Same as gemini_generate, also returning the model that answered, which can be a fallback of model_name,
+    and the token usage. The request has until deadline, a time.monotonic() value that defaults to get_deadline().
+    """
+    try:
+        deadline = get_deadline() if deadline is None else deadline
+        session, tools, system_instruction = open_session(session_id, tools, system_instruction)
+        policy = get_history_policy(history_policy)
+        generate_args = {
+            "contents": contents,
+            "parameters": parameters,
+            "model_name": model_name,
+            "response_schema": response_schema,
+            "history": history,
+            "tools": tools,
+            "system_instruction": system_instruction,
+            "history_policy": history_policy,
+            "template": template,
+        }
+        # A session turn depends on the session and changes it, so it is neither cached nor shared with another request
+        cacheable = session is None and is_cacheable(generate_args)
+        coalesce = session is None and coalesce_requests
+        request_key = request_hash(generate_args) if cacheable or coalesce else None
+        if cacheable:
+            with start_span("response_cache") as span:
+                cached_response = response_cache.get(request_key)
+                span.set_attribute("gemini.response_cache.hit", cached_response is not None)
+            if cached_response is not None:
+                return cached_response
+
+        # Identical requests that arrive while this one is in flight wait for its result
+        def call_model():
+            message, example_contents, new_contents, content_list, config = build_content_list(
+                template, contents, parameters, response_schema, history, tools, system_instruction, session
             )
-            config.tools = []
-            for tool in tools:
-                config.tools.append(types.Tool(
-                    function_declarations=[
-                        types.FunctionDeclaration(
-                            name=tool['name'],
-                            description=tool['description'],
-                            parameters=tool['parameters']
+
+            example_contents = select_examples(template, message, example_contents, deadline)
+
+            with time_stage("history_window"), start_span("history_window") as span:
+                # The template's examples are part of the prompt rather than of the conversation, so they are never windowed
+                content_list = [*example_contents, *window_history(content_list, policy, deadline)]
+                span.set_attributes(get_request_attributes(model_name, history, content_list))
+            # Hashed once for every attempt, whatever its model and region
+            prefix_hashes = get_prefix_hashes(config, content_list)
+
+            def generate(candidate_model, model_deadline):
+                def call_location(region):
+                    set_request_timeout(config, model_deadline)
+                    # Reuse the pooled client for this project and region
+                    client = get_client(project, region)
+                    with (
+                        admit(candidate_model),
+                        observe(candidate_model, region),
+                        time_upstream(candidate_model, region),
+                        start_span("upstream", {"gen_ai.request.model": candidate_model, "cloud.region": region}),
+                    ):
+                        return call_with_context_cache(
+                            client, candidate_model, region, config, content_list, prefix_hashes,
+                            lambda request_contents, request_config: client.models.generate_content(
+                                model=candidate_model,
+                                contents=request_contents,
+                                config=request_config
+                            )
                         )
-                    ]
-                ))
 
-        response = client.models.generate_content(
-            model=model_name,
-            contents=content_list,
-            config=config
-        )
+                def call_region(region):
+                    return call_with_circuit_breaker(candidate_model, region, call_location)
+
+                def attempt():
+                    region = choose_region(candidate_model, location)
+                    return call_hedged(
+                        lambda: call_region(region),
+                        lambda: call_region(hedge_location or choose_region(candidate_model, location, exclude=region)),
+                        candidate_model
+                    )
+
+                response = call_with_retry(attempt, model_deadline, f"generate_content on {candidate_model}")
+                usage = get_usage(response)
+                record_usage(candidate_model, usage)
+                set_span_attributes(get_usage_attributes(usage))
+                return get_usable_response_parts(response, response_schema), usage
 
-        # return the function call or the text response
-        condidate = response.candidates[0]
-
-        response_parts = []
-        for part in condidate.content.parts:
-            if part.function_call:
-                response_parts.append({"functionCall": {
-                    "name": part.function_call.name,
-                    "args": part.function_call.args
-                }})
-            elif response_schema:
-                response_parts.append({"object": json.loads(part.text)})
-            else:
-                response_parts.append({"text": part.text})
-
-        return response_parts
+            (response_parts, usage), answered_model = call_with_fallback(model_name, deadline, generate)
+            result = (response_parts, answered_model, usage)
+            set_span_attributes({"gen_ai.response.model": answered_model})
+            # A fallback model's answer isn't cached under the requested model's key, so the requested model
+            # answers the request again once it recovers
+            if cacheable and answered_model == model_name:
+                response_cache.put(request_key, result)
+            if session is not None:
+                session_store.append(session_id, session, new_contents, response_parts, tools, system_instruction)
+
+            return result
+
+        if coalesce:
+            return inflight_requests.do(request_key, call_model)
+        return call_model()
+    except REJECTED_ERRORS:
+        raise
     except Exception as e:
         # Log the exception
         logging.error(f"Error in gemini_generate: {str(e)}", exc_info=True)
         raise RuntimeError(f"Gemini model error: {str(e)}") from e
 
 
+def gemini_generate(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None):
+    response_parts, _, _ = gemini_generate_with_model(contents, parameters, model_name, response_schema, history, tools, system_instruction, session_id, history_policy, template)
+    return response_parts
+
+
+def gemini_generate_stream(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None, deadline=None):
+    """
+    Yields (event, data) tuples as the model streams its answer:
+    - ("text", {"text": ...}) for every text delta. With a response_schema the deltas are pieces of the JSON document.
+    - ("functionCall", {"name": ..., "args": ...}) for every function call.
+    - ("usage", {...}) once the stream is complete, with the model that answered.
+    """
+    try:
+        deadline = get_deadline() if deadline is None else deadline
+        session, tools, system_instruction = open_session(session_id, tools, system_instruction)
+        policy = get_history_policy(history_policy)
+        message, example_contents, new_contents, content_list, config = build_content_list(
+            template, contents, parameters, response_schema, history, tools, system_instruction, session
+        )
+
+        example_contents = select_examples(template, message, example_contents, deadline)
+
+        with time_stage("history_window"), start_span("history_window") as span:
+            # The template's examples are part of the prompt rather than of the conversation, so they are never windowed
+            content_list = [*example_contents, *window_history(content_list, policy, deadline)]
+            span.set_attributes(get_request_attributes(model_name, history, content_list))
+        # Hashed once for every attempt, whatever its model and region
+        prefix_hashes = get_prefix_hashes(config, content_list)
+
+        with contextlib.ExitStack() as stream_stack:
+            def open_model_stream(candidate_model, model_deadline):
+                def open_location_stream(region):
+                    set_request_timeout(config, model_deadline)
+                    client = get_client(project, region)
+                    with (
+                        observe(candidate_model, region),
+                        time_upstream(candidate_model, region),
+                        start_span("upstream", {"gen_ai.request.model": candidate_model, "cloud.region": region}),
+                    ):
+                        def open_request_stream(request_contents, request_config):
+                            stream = client.models.generate_content_stream(
+                                model=candidate_model,
+                                contents=request_contents,
+                                config=request_config
+                            )
+                            # Upstream errors surface on the first chunk, so it is read as part of the attempt.
+                            # Once a chunk has been sent to the client the stream can't be retried.
+                            return stream, next(stream, None)
+
+                        return call_with_context_cache(client, candidate_model, region, config, content_list, prefix_hashes, open_request_stream)
+
+                def open_stream():
+                    return call_with_circuit_breaker(candidate_model, choose_region(candidate_model, location), open_location_stream)
+
+                with contextlib.ExitStack() as model_stack:
+                    model_stack.enter_context(admit(candidate_model))
+                    opened_stream = call_with_retry(open_stream, model_deadline, f"generate_content_stream on {candidate_model}")
+                    # Hold the model's slot until the stream is done
+                    stream_stack.enter_context(model_stack.pop_all())
+                    return opened_stream
+
+            (stream, first_chunk), answered_model = call_with_fallback(model_name, deadline, open_model_stream)
+            # Closed before the model's slot is given back, also when the caller stops reading early
+            stream_stack.enter_context(contextlib.closing(stream))
+
+            usage = {}
+            streamed_parts = []
+            for chunk in itertools.chain([first_chunk] if first_chunk else [], stream):
+                if chunk.usage_metadata:
+                    usage = get_usage(chunk)
+                for event, data in get_chunk_events(chunk):
+                    if session is not None:
+                        streamed_parts.append(get_streamed_part(event, data))
+                    yield event, data
+
+            if session is not None:
+                session_store.append(session_id, session, new_contents, streamed_parts, tools, system_instruction)
+            record_usage(answered_model, usage)
+            yield "usage", {**usage, "model_name": answered_model}
+    except REJECTED_ERRORS:
+        raise
+    except Exception as e:
+        # Log the exception
+        logging.error(f"Error in gemini_generate_stream: {str(e)}", exc_info=True)
+        raise RuntimeError(f"Gemini model error: {str(e)}") from e
+
+
+@traced("gemini_generate")
+async def gemini_generate_async_with_model(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None, deadline=None):
+    """
+    Same as gemini_generate_with_model, using the SDK's async client so the caller doesn't hold a thread while waiting on Vertex.
+    """
+    try:
+        deadline = get_deadline() if deadline is None else deadline
+        session, tools, system_instruction = open_session(session_id, tools, system_instruction)
+        policy = get_history_policy(history_policy)
+        generate_args = {
+            "contents": contents,
+            "parameters": parameters,
+            "model_name": model_name,
+            "response_schema": response_schema,
+            "history": history,
+            "tools": tools,
+            "system_instruction": system_instruction,
+            "history_policy": history_policy,
+            "template": template,
+        }
+        # A session turn depends on the session and changes it, so it is neither cached nor shared with another request
+        cacheable = session is None and is_cacheable(generate_args)
+        coalesce = session is None and coalesce_requests
+        request_key = request_hash(generate_args) if cacheable or coalesce else None
+        if cacheable:
+            with start_span("response_cache") as span:
+                cached_response = response_cache.get(request_key)
+                span.set_attribute("gemini.response_cache.hit", cached_response is not None)
+            if cached_response is not None:
+                return cached_response
+
+        # Identical requests that arrive while this one is in flight wait for its result
+        async def call_model():
+            message, example_contents, new_contents, content_list, config = build_content_list(
+                template, contents, parameters, response_schema, history, tools, system_instruction, session
+            )
+
+            example_contents = await select_examples_async(template, message, example_contents, deadline)
+
+            with time_stage("history_window"), start_span("history_window") as span:
+                # The template's examples are part of the prompt rather than of the conversation, so they are never windowed
+                content_list = [*example_contents, *await window_history_async(content_list, policy, deadline)]
+                span.set_attributes(get_request_attributes(model_name, history, content_list))
+            # Hashed once for every attempt, whatever its model and region
+            prefix_hashes = get_prefix_hashes(config, content_list)
+
+            async def generate(candidate_model, model_deadline):
+                async def call_location(region):
+                    set_request_timeout(config, model_deadline)
+                    client = await get_client_async(project, region)
+                    async with admit_async(candidate_model):
+                        with (
+                            observe(candidate_model, region),
+                            time_upstream(candidate_model, region),
+                            start_span("upstream", {"gen_ai.request.model": candidate_model, "cloud.region": region}),
+                        ):
+                            return await call_with_context_cache_async(
+                                client, candidate_model, region, config, content_list, prefix_hashes,
+                                lambda request_contents, request_config: client.aio.models.generate_content(
+                                    model=candidate_model,
+                                    contents=request_contents,
+                                    config=request_config
+                                )
+                            )
+
+                async def call_region(region):
+                    return await call_with_circuit_breaker_async(candidate_model, region, call_location)
+
+                async def attempt():
+                    region = choose_region(candidate_model, location)
+                    return await call_hedged_async(
+                        lambda: call_region(region),
+                        lambda: call_region(hedge_location or choose_region(candidate_model, location, exclude=region)),
+                        candidate_model
+                    )
+
+                response = await call_with_retry_async(attempt, model_deadline, f"generate_content on {candidate_model}")
+                usage = get_usage(response)
+                record_usage(candidate_model, usage)
+                set_span_attributes(get_usage_attributes(usage))
+                return get_usable_response_parts(response, response_schema), usage
+
+            (response_parts, usage), answered_model = await call_with_fallback_async(model_name, deadline, generate)
+            result = (response_parts, answered_model, usage)
+            set_span_attributes({"gen_ai.response.model": answered_model})
+            # A fallback model's answer isn't cached under the requested model's key, so the requested model
+            # answers the request again once it recovers
+            if cacheable and answered_model == model_name:
+                response_cache.put(request_key, result)
+            if session is not None:
+                session_store.append(session_id, session, new_contents, response_parts, tools, system_instruction)
+
+            return result
+
+        if coalesce:
+            return await async_inflight_requests.do(request_key, call_model)
+        return await call_model()
+    except REJECTED_ERRORS:
+        raise
+    except Exception as e:
+        # Log the exception
+        logging.error(f"Error in gemini_generate_async: {str(e)}", exc_info=True)
+        raise RuntimeError(f"Gemini model error: {str(e)}") from e
+
+
+async def gemini_generate_async(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None):
+    """
+    Same as gemini_generate, using the SDK's async client so the caller doesn't hold a thread while waiting on Vertex.
+    """
+    response_parts, _, _ = await gemini_generate_async_with_model(contents, parameters, model_name, response_schema, history, tools, system_instruction, session_id, history_policy, template)
+    return response_parts
+
+
+async def gemini_generate_stream_async(contents, parameters=None, model_name="gemini-2.0-flash-exp", response_schema=None, history=[], tools=[], system_instruction=None, session_id=None, history_policy=None, template=None, deadline=None):
+    """
+    Same as gemini_generate_stream, as an async generator.
+    """
+    try:
+        deadline = get_deadline() if deadline is None else deadline
+        session, tools, system_instruction = open_session(session_id, tools, system_instruction)
+        policy = get_history_policy(history_policy)
+        message, example_contents, new_contents, content_list, config = build_content_list(
+            template, contents, parameters, response_schema, history, tools, system_instruction, session
+        )
+
+        example_contents = await select_examples_async(template, message, example_contents, deadline)
+
+        with time_stage("history_window"), start_span("history_window") as span:
+            # The template's examples are part of the prompt rather than of the conversation, so they are never windowed
+            content_list = [*example_contents, *await window_history_async(content_list, policy, deadline)]
+            span.set_attributes(get_request_attributes(model_name, history, content_list))
+        # Hashed once for every attempt, whatever its model and region
+        prefix_hashes = get_prefix_hashes(config, content_list)
+
+        async with contextlib.AsyncExitStack() as stream_stack:
+            async def open_model_stream(candidate_model, model_deadline):
+                async def open_location_stream(region):
+                    set_request_timeout(config, model_deadline)
+                    client = await get_client_async(project, region)
+                    with (
+                        observe(candidate_model, region),
+                        time_upstream(candidate_model, region),
+                        start_span("upstream", {"gen_ai.request.model": candidate_model, "cloud.region": region}),
+                    ):
+                        async def open_request_stream(request_contents, request_config):
+                            stream = await client.aio.models.generate_content_stream(
+                                model=candidate_model,
+                                contents=request_contents,
+                                config=request_config
+                            )
+                            # Upstream errors surface on the first chunk, so it is read as part of the attempt
+                            return stream, await anext(stream, None)
+
+                        return await call_with_context_cache_async(client, candidate_model, region, config, content_list, prefix_hashes, open_request_stream)
+
+                async def open_stream():
+                    return await call_with_circuit_breaker_async(candidate_model, choose_region(candidate_model, location), open_location_stream)
+
+                async with contextlib.AsyncExitStack() as model_stack:
+                    await model_stack.enter_async_context(admit_async(candidate_model))
+                    opened_stream = await call_with_retry_async(open_stream, model_deadline, f"generate_content_stream on {candidate_model}")
+                    # Hold the model's slot until the stream is done
+                    await stream_stack.enter_async_context(model_stack.pop_all())
+                    return opened_stream
+
+            (stream, first_chunk), answered_model = await call_with_fallback_async(model_name, deadline, open_model_stream)
+            # Closed before the model's slot is given back, also when the caller stops reading early
+            stream_stack.push_async_callback(stream.aclose)
+
+            usage = {}
+            streamed_parts = []
+            if first_chunk:
+                if first_chunk.usage_metadata:
+                    usage = get_usage(first_chunk)
+                for event, data in get_chunk_events(first_chunk):
+                    if session is not None:
+                        streamed_parts.append(get_streamed_part(event, data))
+                    yield event, data
+
+            async for chunk in stream:
+                if chunk.usage_metadata:
+                    usage = get_usage(chunk)
+                for event, data in get_chunk_events(chunk):
+                    if session is not None:
+                        streamed_parts.append(get_streamed_part(event, data))
+                    yield event, data
+
+            if session is not None:
+                session_store.append(session_id, session, new_contents, streamed_parts, tools, system_instruction)
+            record_usage(answered_model, usage)
+            yield "usage", {**usage, "model_name": answered_model}
+    except REJECTED_ERRORS:
+        raise
+    except Exception as e:
+        # Log the exception
+        logging.error(f"Error in gemini_generate_stream_async: {str(e)}", exc_info=True)
+        raise RuntimeError(f"Gemini model error: {str(e)}") from e
+
+
+def format_sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(events):
+    """
+    Formats the generator from gemini_generate_stream as Server-Sent Events.
+    The model is read on a background thread so that a heartbeat comment can be sent
+    whenever no event has been produced for stream_heartbeat_seconds.
+    Returns once the first event is ready, raising the error the generator failed with before it, e.g. AdmissionRejected
+    or SessionError, so the route can still answer with its status rather than with an error event in a 200 stream.
+    """
+    # Flask reads the stream after the view has returned, so the request's context is captured now
+    body = _stream_events(events, contextvars.copy_context())
+    next(body)
+    return body
+
+
+def _stream_events(events, context):
+    event_queue = queue.Queue(maxsize=STREAM_QUEUE_MAX_EVENTS)
+    done = object()
+    # Set once the response is over, e.g. when the client disconnected, so the producer stops reading from the model
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                event_queue.put(item, timeout=STREAM_CANCEL_CHECK_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for event in events:
+                if not put(event):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            # Closes the model's stream and gives its admission slot back, even when the client left mid-stream
+            events.close()
+        put(done)
+
+    # The producer runs in the request's context, so its spans belong to the request's trace
+    threading.Thread(target=context.run, args=(produce,), daemon=True).start()
+
+    try:
+        item = event_queue.get()
+        if isinstance(item, Exception):
+            raise item
+        # The first event is ready, so stream_events returns
+        yield None
+
+        while item is not done:
+            # Once the response has started, an error can only be sent as an event
+            yield format_sse_event("error", {"error": str(item)}) if isinstance(item, Exception) else format_sse_event(*item)
+            while True:
+                try:
+                    item = event_queue.get(timeout=stream_heartbeat_seconds)
+                    break
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+    finally:
+        cancelled.set()
+
+
+def get_stream_headers(request, session_id=None):
+    headers = get_response_headers(request)
+    if session_id:
+        headers["X-Session-Id"] = session_id
+    headers["Cache-Control"] = "no-cache"
+    headers["X-Accel-Buffering"] = "no"
+    return headers
+
+
+def validate_generate_request(incoming_request, default_model_name):
+    """
+    Validates a /generate_content style request body.
+    Returns the gemini_generate keyword arguments, or an error response tuple.
+    """
+    if not isinstance(incoming_request, dict):
+        return None, ({"error": "Request body must be a JSON object"}, 400)
+
+    contents = incoming_request.get("contents")
+    parameters = incoming_request.get("parameters")
+    model_name = incoming_request.get("model_name", default_model_name)
+    response_schema = incoming_request.get("response_schema", None)
+    history = incoming_request.get("history", [])
+    tools = incoming_request.get("tools", [])
+    system_instruction = incoming_request.get("system_instruction", None)
+    session_id = incoming_request.get("session_id")
+    history_policy = incoming_request.get("history_policy")
+    template = incoming_request.get("template")
+
+    if is_invalid_history(history):
+        return None, ({"error": "Invalid history format"}, 400)
+
+    history_policy_error = is_invalid_history_policy(history_policy)
+    if history_policy_error:
+        return None, ({"error": history_policy_error}, 400)
+
+    template_error = is_invalid_template_reference(template)
+    if template_error:
+        return None, ({"error": template_error}, 400)
+
+    if contents is None and len(history) == 0 and template is None:
+        return None, ({"error": "Missing 'contents' or history must be provided"}, 400)
+
+    # The versions of the template and its examples are filled in, so the response cache key names the exact prompt
+    if template is not None:
+        try:
+            template = prompt_registry.resolve(template)
+        except PromptTemplateError as e:
+            return None, ({"error": str(e)}, 400)
+
+    if session_id is not None and not is_valid_session_id(session_id):
+        return None, ({"error": "Invalid session_id"}, 400)
+
+    # The first turn of a session sends the full history, later turns send the session_id and only their new turns
+    if incoming_request.get("new_session") and session_id is None:
+        session_id = session_store.create()
+
+    return {
+        "contents": contents,
+        "parameters": parameters,
+        "model_name": model_name,
+        "response_schema": response_schema,
+        "history": history,
+        "tools": tools,
+        "system_instruction": system_instruction,
+        "session_id": session_id,
+        "history_policy": history_policy,
+        "template": template,
+    }, None
+
+
+def read_generate_request(request, default_model_name):
+    """
+    Checks the signature of a /generate_content style Flask request, then parses and validates it.
+    Returns the gemini_generate keyword arguments, or an error response tuple.
+    """
+    incoming_request, error_response = ingest_request(request)
+    if error_response:
+        return None, error_response
+
+    with start_span("validation"):
+        return validate_generate_request(incoming_request, default_model_name)
+
+
+def validate_batch_request(incoming_request, default_model_name):
+    """
+    Validates a /batch_generate_content request body.
+    Returns a list with a (generate_args, error_response) pair for every request in the batch,
+    or an error response tuple when the batch itself is invalid.
+    """
+    requests = incoming_request.get("requests") if isinstance(incoming_request, dict) else None
+    if not isinstance(requests, list) or not requests:
+        return None, ({"error": "'requests' must be a non-empty list"}, 400)
+
+    if len(requests) > batch_max_requests:
+        return None, ({"error": f"A batch can contain at most {batch_max_requests} requests"}, 400)
+
+    batch_items = []
+    for item in requests:
+        if not isinstance(item, dict):
+            batch_items.append((None, ({"error": "Each request in the batch must be a dictionary"}, 400)))
+        else:
+            batch_items.append(validate_generate_request(item, default_model_name))
+
+    return batch_items, None
+
+
+def read_batch_request(request, default_model_name):
+    """
+    Checks the signature of a /batch_generate_content Flask request, then parses and validates it.
+    One signature covers the whole batch.
+    """
+    incoming_request, error_response = ingest_request(request)
+    if error_response:
+        return None, error_response
+
+    with start_span("validation"):
+        return validate_batch_request(incoming_request, default_model_name)
+
+
+def get_batch_item_error(error_response):
+    error, status = error_response
+    return {"status": status, "error": error["error"]}
+
+
+def get_batch_item_result(response_parts, answered_model, usage, session_id):
+    result = {"status": 200, "response": response_parts, "model_name": answered_model, "usage": usage}
+    if session_id:
+        result["session_id"] = session_id
+    return result
+
+
+def get_batch_item_rejection(error):
+    return {"status": error.status_code, "error": str(error), "retry_after": error.retry_after}
+
+
+def get_batch_item_timeout():
+    return {"status": 504, "error": "The batch ran out of time before this request started"}
+
+
+def generate_batch_item(batch_item, deadline):
+    generate_args, error_response = batch_item
+    if error_response:
+        return get_batch_item_error(error_response)
+    if remaining_seconds(deadline) == 0:
+        return get_batch_item_timeout()
+
+    try:
+        response_parts, answered_model, usage = gemini_generate_with_model(**generate_args, deadline=deadline)
+        return get_batch_item_result(response_parts, answered_model, usage, generate_args["session_id"])
+    except REJECTED_ERRORS as e:
+        return get_batch_item_rejection(e)
+    except Exception as e:
+        return {"status": 500, "error": str(e)}
+
+
+def gemini_generate_batch(batch_items):
+    """
+    Runs the batch with at most batch_max_parallelism concurrent generations,
+    returning one result per request in the order of the batch.
+    The requests share the time budget of the HTTP request, so the ones that start after it ran out fail with a 504.
+    """
+    deadline = get_deadline()
+    with ThreadPoolExecutor(max_workers=min(batch_max_parallelism, len(batch_items))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, generate_batch_item, batch_item, deadline) for batch_item in batch_items]
+        return [future.result() for future in futures]
+
+
+def run_warm_up():
+    """
+    Warms the instance up if it isn't yet, and returns the warm-up status with 200 once it is ready, or 503.
+    """
+    status = warm_up(project, location, model_name if warm_up_probe else None)
+    return status, 200 if status["state"] == "ready" else 503
+
+
+def get_readiness():
+    """
+    Returns the warm-up status with 200 when the instance can take traffic without paying for the setup, or 503.
+    With the warm-up turned off there is nothing to wait for, unless /warmup was called.
+    A failed warm-up is started again in the background, so a later check can find the instance ready.
+    """
+    status = warm_up_status()
+    if status["state"] == "failed":
+        retry_failed_warm_up(project, location, model_name if warm_up_probe else None)
+    is_ready = status["state"] == "ready" or (not warm_up_on_start and status["state"] == "not_started")
+    return status, 200 if is_ready else 503
+
+
+def get_liveness():
+    # The process answers, so it is alive, whether or not it is warmed up
+    return {"status": "alive", "warm_up": warm_up_status()["state"]}, 200
+
+
 # Flask app for running as a web server
 def create_flask_app():
     app = Flask(__name__)
     CORS(app)
 
     @app.route("/generate_content", methods=["POST", "OPTIONS"])
+    @trace_route("/generate_content")
+    @instrument_route("/generate_content")
     def generate_content():
         if request.method == "OPTIONS":
             return handle_options_request(request)
 
         try:
-            incoming_request = request.get_json()
-            contents = incoming_request.get("contents")
-            parameters = incoming_request.get("parameters")
-            model_name = incoming_request.get("model_name", "gemini-2.0-flash-exp")
-            response_schema = incoming_request.get("response_schema", None)
-            history = incoming_request.get("history", [])
-            tools = incoming_request.get("tools", [])
-            system_instruction = incoming_request.get("system_instruction", None)
-            if is_invalid_history(history):
-                return {"error": "Invalid history format"}, 400
-
-            if contents is None and len(history) == 0:
-                return {"error": "Missing 'contents' or history must be provided"}, 400
-
-            if not has_valid_signature(request):
-                return {"error": "Invalid signature"}, 403
-
-            response_text = gemini_generate(contents, parameters, model_name, response_schema, history, tools, system_instruction)
-            return response_text, 200, get_response_headers(request)
+            generate_args, error_response = read_generate_request(request, "gemini-2.0-flash-exp")
+            if error_response:
+                return error_response
+
+            response_text, answered_model, usage = gemini_generate_with_model(**generate_args)
+            return response_text, 200, get_model_response_headers(request, answered_model, generate_args["session_id"], usage)
+        except REJECTED_ERRORS as e:
+            return get_rejected_response(request, e)
         except Exception as e:
             logging.error(f"Error in generate_content route: {str(e)}", exc_info=True)
             return {"error": str(e)}, 500, get_response_headers(request)
 
+    @app.route("/stream_generate_content", methods=["POST", "OPTIONS"])
+    @trace_route("/stream_generate_content")
+    @instrument_route("/stream_generate_content")
+    def stream_generate_content():
+        if request.method == "OPTIONS":
+            return handle_options_request(request)
+
+        try:
+            generate_args, error_response = read_generate_request(request, "gemini-2.0-flash-exp")
+            if error_response:
+                return error_response
+
+            events = gemini_generate_stream(**generate_args)
+            return Response(stream_events(events), 200, get_stream_headers(request, generate_args["session_id"]), mimetype="text/event-stream")
+        except REJECTED_ERRORS as e:
+            return get_rejected_response(request, e)
+        except Exception as e:
+            logging.error(f"Error in stream_generate_content route: {str(e)}", exc_info=True)
+            return {"error": str(e)}, 500, get_response_headers(request)
+
+    @app.route("/batch_generate_content", methods=["POST", "OPTIONS"])
+    @trace_route("/batch_generate_content")
+    @instrument_route("/batch_generate_content")
+    def batch_generate_content():
+        if request.method == "OPTIONS":
+            return handle_options_request(request)
+
+        try:
+            batch_items, error_response = read_batch_request(request, "gemini-2.0-flash-exp")
+            if error_response:
+                return error_response
+
+            return gemini_generate_batch(batch_items), 200, get_response_headers(request)
+        except REJECTED_ERRORS as e:
+            return get_rejected_response(request, e)
+        except Exception as e:
+            logging.error(f"Error in batch_generate_content route: {str(e)}", exc_info=True)
+            return {"error": str(e)}, 500, get_response_headers(request)
+
+    @app.route("/admission_stats", methods=["GET"])
+    @signature_required
+    def get_admission_stats():
+        return admission_stats(), 200, get_response_headers(request)
+
+    @app.route("/circuit_stats", methods=["GET"])
+    @signature_required
+    def get_circuit_stats():
+        return circuit_stats(), 200, get_response_headers(request)
+
+    @app.route("/region_stats", methods=["GET"])
+    @signature_required
+    def get_region_stats():
+        return region_stats(), 200, get_response_headers(request)
+
+    @app.route("/cache_stats", methods=["GET"])
+    @signature_required
+    def cache_stats():
+        return response_cache.stats(), 200, get_response_headers(request)
+
+    @app.route("/metrics", methods=["GET"])
+    @signature_required
+    def metrics():
+        body, content_type = get_metrics()
+        return Response(body, 200, content_type=content_type)
+
+    @app.route("/warmup", methods=["GET", "POST"])
+    @signature_required
+    def warmup():
+        status, status_code = run_warm_up()
+        return status, status_code, get_response_headers(request)
+
+    @app.route("/readiness", methods=["GET"])
+    def readiness():
+        status, status_code = get_readiness()
+        return status, status_code, get_response_headers(request)
+
+    @app.route("/liveness", methods=["GET"])
+    def liveness():
+        status, status_code = get_liveness()
+        return status, status_code, get_response_headers(request)
+
     return app
 
 
+def get_route(request):
+    # Unsupported paths share one label, so they can't add series to the metrics
+    return request.path if request.path in SERVED_PATHS else "unsupported"
+
+
 # Function for Google Cloud Function
 @functions_framework.http
+@trace_route(get_route)
+@instrument_route(get_route)
 def cloud_function_entrypoint(request):
+    # Without a fork, nothing started the deferred warm-up yet
+    start_deferred_warm_up()
     if request.method == "OPTIONS":
         return handle_options_request(request)
 
     try:
         # Handle the `/generate_content` path
         if request.path == "/generate_content":
-            incoming_request = request.get_json()
-            contents = incoming_request.get("contents")
-            parameters = incoming_request.get("parameters")
-            model_name = incoming_request.get("model_name", "gemini-1.5-flash")
-            response_schema = incoming_request.get("response_schema", None)
-            history = incoming_request.get("history", [])
-            tools = incoming_request.get("tools", [])
-            system_instruction = incoming_request.get("system_instruction", None)
+            generate_args, error_response = read_generate_request(request, "gemini-1.5-flash")
+            if error_response:
+                return error_response
+
+            response_text, answered_model, usage = gemini_generate_with_model(**generate_args)
+            return response_text, 200, get_model_response_headers(request, answered_model, generate_args["session_id"], usage)
+
+        # Handle the `/stream_generate_content` path
+        if request.path == "/stream_generate_content":
+            generate_args, error_response = read_generate_request(request, "gemini-1.5-flash")
+            if error_response:
+                return error_response
+
+            events = gemini_generate_stream(**generate_args)
+            return Response(stream_events(events), 200, get_stream_headers(request, generate_args["session_id"]), mimetype="text/event-stream")
+
+        # Handle the `/batch_generate_content` path
+        if request.path == "/batch_generate_content":
+            batch_items, error_response = read_batch_request(request, "gemini-1.5-flash")
+            if error_response:
+                return error_response
+
+            return gemini_generate_batch(batch_items), 200, get_response_headers(request)
+
+        if request.path in SIGNED_STATUS_PATHS:
+            error_response = check_signature(request)
+            if error_response:
+                return error_response
+
+        # Handle the `/admission_stats` path
+        if request.path == "/admission_stats":
+            return admission_stats(), 200, get_response_headers(request)
+
+        # Handle the `/circuit_stats` path
+        if request.path == "/circuit_stats":
+            return circuit_stats(), 200, get_response_headers(request)
+
+        # Handle the `/region_stats` path
+        if request.path == "/region_stats":
+            return region_stats(), 200, get_response_headers(request)
+
+        # Handle the `/cache_stats` path
+        if request.path == "/cache_stats":
+            return response_cache.stats(), 200, get_response_headers(request)
 
-            if is_invalid_history(history):
-                return {"error": "Invalid history format"}, 400
+        # Handle the `/metrics` path
+        if request.path == "/metrics":
+            body, content_type = get_metrics()
+            return Response(body, 200, content_type=content_type)
 
-            if contents is None and len(history) == 0:
-                return {"error": "Missing 'contents' or history must be provided"}, 400
+        # Handle the `/warmup` path
+        if request.path == "/warmup":
+            status, status_code = run_warm_up()
+            return status, status_code, get_response_headers(request)
 
-            if not has_valid_signature(request):
-                return {"error": "Invalid signature"}, 403
+        # Handle the `/readiness` path
+        if request.path == "/readiness":
+            status, status_code = get_readiness()
+            return status, status_code, get_response_headers(request)
 
-            response_text = gemini_generate(contents, parameters, model_name, response_schema, history, tools, system_instruction)
-            return response_text, 200, get_response_headers(request)
+        # Handle the `/liveness` path
+        if request.path == "/liveness":
+            status, status_code = get_liveness()
+            return status, status_code, get_response_headers(request)
 
         # Default response for unsupported paths
         return {"error": "Unsupported path"}, 404, get_response_headers(request)
+    except REJECTED_ERRORS as e:
+        return get_rejected_response(request, e)
     except Exception as e:
         logging.error(f"Error in cloud_function_entrypoint: {str(e)}", exc_info=True)
         return {"error": str(e)}, 500, get_response_headers(request)
@@ -0,0 +1,210 @@
+import contextlib
+import functools
+import time
+
+from flask import make_response, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from admission import admission_stats
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, circuit_stats
+from context_cache import context_cache
+from example_selector import example_selector
+from hedging import hedge_stats
+from prompt_registry import prompt_registry
+from region_router import region_stats
+from response_cache import response_cache
+from retry import retry_stats
+from sessions import session_store
+from singleflight import async_inflight_requests, inflight_requests
+
+
+# Upstream calls can take up to the 60s function timeout
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REQUESTS = Counter(
+    "gemini_backend_requests_total",
+    "Requests handled, by route, status code and the model that answered",
+    ["route", "status", "model"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "gemini_backend_requests_in_flight",
+    "Requests currently being handled, by route",
+    ["route"],
+)
+STAGE_SECONDS = Histogram(
+    "gemini_backend_stage_seconds",
+    "Time spent in each stage of the request pipeline",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_SECONDS = Histogram(
+    "gemini_backend_upstream_seconds",
+    "Time spent in calls to Vertex AI, by model and region",
+    ["model", "region"],
+    buckets=LATENCY_BUCKETS,
+)
+TOKENS = Counter(
+    "gemini_backend_tokens_total",
+    "Tokens used, by model and type",
+    ["model", "type"],
+)
+
+
+@contextlib.contextmanager
+def time_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def time_upstream(model_name, region):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels("upstream").observe(elapsed)
+        UPSTREAM_SECONDS.labels(model_name, region).observe(elapsed)
+
+
+def record_usage(model_name, usage):
+    for token_type in ("prompt", "candidates", "cached_content"):
+        token_count = usage.get(f"{token_type}_token_count")
+        if token_count:
+            TOKENS.labels(model_name, token_type).inc(token_count)
+
+
+def _record_response(route, response):
+    REQUESTS.labels(route, str(response.status_code), response.headers.get("X-Model-Name", "none")).inc()
+
+
+def instrument_route(route):
+    """
+    Counts the requests handled by a Flask view and tracks how many are in flight.
+    route is the label to use, or a function returning it from the request.
+    The view's return value is turned into a response here, so JSON encoding is timed as serialization.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            route_label = route(request) if callable(route) else route
+            with REQUESTS_IN_FLIGHT.labels(route_label).track_inprogress():
+                result = view(*args, **kwargs)
+                with time_stage("serialization"):
+                    response = make_response(result)
+            _record_response(route_label, response)
+            return response
+        return wrapper
+    return decorator
+
+
+def instrument_route_async(route):
+    """
+    Counts the requests handled by an ASGI endpoint and tracks how many are in flight.
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            with REQUESTS_IN_FLIGHT.labels(route).track_inprogress():
+                response = await endpoint(*args, **kwargs)
+            _record_response(route, response)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_metrics():
+    """
+    Returns the body and content type of the Prometheus exposition.
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class StatsCollector:
+    """
+    Exports the counters kept by the cache, the session store, the context cache, the prompt registry, the example
+    selector, admission control, circuit breakers, retries, hedging, request coalescing and region routing.
+    """
+
+    def collect(self):
+        cache = response_cache.stats()
+        for name in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(f"gemini_backend_cache_{name}", f"Response cache {name}", value=cache[name])
+        yield GaugeMetricFamily("gemini_backend_cache_entries", "Responses in the cache", value=cache["entries"])
+        yield GaugeMetricFamily("gemini_backend_cache_bytes", "Size of the responses in the cache", value=cache["bytes"])
+
+        sessions = session_store.stats()
+        for name in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(f"gemini_backend_session_{name}", f"Session store {name}", value=sessions[name])
+        yield GaugeMetricFamily("gemini_backend_session_entries", "Sessions in the store", value=sessions["entries"])
+        yield GaugeMetricFamily("gemini_backend_session_bytes", "Size of the turns kept in sessions", value=sessions["bytes"])
+
+        cached_contents = context_cache.stats()
+        for name in ("hits", "misses", "creations", "failures", "refreshes", "evictions", "invalidations"):
+            yield CounterMetricFamily(f"gemini_backend_context_cache_{name}", f"Context cache {name}", value=cached_contents[name])
+        yield GaugeMetricFamily("gemini_backend_context_cache_entries", "Vertex cached contents in use", value=cached_contents["entries"])
+
+        prompts = prompt_registry.stats()
+        for name in ("hits", "misses"):
+            yield CounterMetricFamily(f"gemini_backend_prompt_cache_{name}", f"Rendered prompt cache {name}", value=prompts[name])
+        yield GaugeMetricFamily("gemini_backend_prompt_cache_entries", "Rendered prompts in the cache", value=prompts["entries"])
+        yield GaugeMetricFamily("gemini_backend_prompt_templates", "Prompt template versions in the registry", value=prompts["templates"])
+        yield GaugeMetricFamily("gemini_backend_prompt_example_sets", "Example set versions in the registry", value=prompts["example_sets"])
+
+        examples = example_selector.stats()
+        yield GaugeMetricFamily("gemini_backend_example_banks", "Embedded example banks", value=examples["banks"])
+        yield GaugeMetricFamily("gemini_backend_example_bank_examples", "Examples in the embedded example banks", value=examples["examples"])
+        yield CounterMetricFamily("gemini_backend_example_query_cache_hits", "Request messages whose embedding was cached", value=examples["query_hits"])
+        yield CounterMetricFamily("gemini_backend_example_query_cache_misses", "Request messages that were embedded", value=examples["query_misses"])
+        yield CounterMetricFamily("gemini_backend_example_bank_failures", "Example banks that could not be embedded", value=examples["failures"])
+
+        coalesced = CounterMetricFamily("gemini_backend_coalesced_requests", "Requests that waited on an identical request in flight")
+        coalesced.add_metric([], inflight_requests.coalesced + async_inflight_requests.coalesced)
+        yield coalesced
+
+        queue_depth = GaugeMetricFamily("gemini_backend_admission_queue_depth", "Requests waiting for a model slot", labels=["model"])
+        upstream_in_flight = GaugeMetricFamily("gemini_backend_admission_in_flight", "Calls in flight per model", labels=["model"])
+        wait_seconds = CounterMetricFamily("gemini_backend_admission_wait_seconds", "Time admitted requests waited for a slot", labels=["model"])
+        admission = CounterMetricFamily("gemini_backend_admission", "Admission decisions per model", labels=["model", "outcome"])
+        for model_name, stats in admission_stats().items():
+            queue_depth.add_metric([model_name], stats["queue_depth"])
+            upstream_in_flight.add_metric([model_name], stats["in_flight"])
+            wait_seconds.add_metric([model_name], stats["wait_seconds_total"])
+            for outcome in ("admitted", "rejected", "timed_out"):
+                admission.add_metric([model_name, outcome], stats[outcome])
+        yield from (queue_depth, upstream_in_flight, wait_seconds, admission)
+
+        circuit_state = GaugeMetricFamily("gemini_backend_circuit_state", "Circuit state per model and region, 1 for the current state", labels=["model", "region", "state"])
+        transitions = CounterMetricFamily("gemini_backend_circuit_transitions", "Circuit state changes per model and region", labels=["model", "region", "transition"])
+        for key, stats in circuit_stats().items():
+            model_name, region = key.split("/", 1)
+            for state in (CLOSED, OPEN, HALF_OPEN):
+                circuit_state.add_metric([model_name, region, state], 1 if stats["state"] == state else 0)
+            for transition, count in stats["transitions"].items():
+                transitions.add_metric([model_name, region, transition], count)
+        yield from (circuit_state, transitions)
+
+        retries = retry_stats()
+        yield CounterMetricFamily("gemini_backend_retries", "Retried upstream calls", value=retries["retries"])
+        yield CounterMetricFamily("gemini_backend_retries_exhausted", "Upstream calls that failed after running out of retries", value=retries["exhausted"])
+        yield CounterMetricFamily("gemini_backend_retry_backoff_seconds", "Time spent backing off before retries", value=retries["backoff_seconds_total"])
+
+        hedges = hedge_stats()
+        yield CounterMetricFamily("gemini_backend_hedges", "Hedged upstream calls", value=hedges["hedged"])
+        yield CounterMetricFamily("gemini_backend_hedge_wins", "Hedged calls where the hedge answered first", value=hedges["hedge_wins"])
+
+        region_latency = GaugeMetricFamily("gemini_backend_region_latency_ewma_seconds", "Moving average latency per model and region", labels=["model", "region"])
+        region_errors = GaugeMetricFamily("gemini_backend_region_error_rate_ewma", "Moving average error rate per model and region", labels=["model", "region"])
+        for key, stats in region_stats().items():
+            model_name, region = key.split("/", 1)
+            if stats["latency_ewma_seconds"] is not None:
+                region_latency.add_metric([model_name, region], stats["latency_ewma_seconds"])
+            region_errors.add_metric([model_name, region], stats["error_rate_ewma"])
+        yield from (region_latency, region_errors)
+
+
+REGISTRY.register(StatsCollector())
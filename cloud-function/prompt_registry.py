@@ -0,0 +1,331 @@
+import collections
+import glob
+import json
+import logging
+import os
+import string
+import threading
+import time
+
+from lazy import lazy_import
+
+types = lazy_import("google.genai.types")
+
+
+# Where templates and example sets are loaded from: a comma separated list of the loaders in LOADERS
+prompt_registry_loaders = os.environ.get("PROMPT_REGISTRY_LOADERS", "files")
+# Directory of the JSON files read by the "files" loader
+prompt_registry_dir = os.environ.get("PROMPT_REGISTRY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts"))
+# Table of example sets read by the "bigquery" loader, e.g. "my-project.explore_assistant.explore_assistant_examples"
+prompt_registry_bigquery_table = os.environ.get("PROMPT_REGISTRY_BIGQUERY_TABLE")
+# The registry is loaded again in the background once it is this old
+prompt_registry_reload_seconds = float(os.environ.get("PROMPT_REGISTRY_RELOAD_SECONDS", 300))
+prompt_cache_max_entries = int(os.environ.get("PROMPT_CACHE_MAX_ENTRIES", 1000))
+project = os.environ.get("PROJECT")
+
+
+class PromptTemplateError(Exception):
+    """
+    Raised for a template reference that can't be rendered: an unknown template or example set, or a missing variable.
+    """
+
+    status_code = 400
+    retry_after = None
+
+
+class FileLoader:
+    """
+    Loads every *.json file of a directory, each holding {"templates": [...], "example_sets": [...]}.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or prompt_registry_dir
+
+    def load(self):
+        templates = []
+        example_sets = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.json"))):
+            with open(path) as f:
+                definitions = json.load(f)
+            templates.extend(definitions.get("templates", []))
+            example_sets.extend(definitions.get("example_sets", []))
+        return {"templates": templates, "example_sets": example_sets}
+
+
+class BigQueryLoader:
+    """
+    Loads example sets from the Explore Assistant examples table, with an explore_id and an examples column
+    holding a JSON list of {"input": ..., "output": ...}. Each explore's examples are an example set named after it.
+    Needs google-cloud-bigquery, which isn't in requirements.txt.
+    """
+
+    def __init__(self, table=None):
+        self.table = table or prompt_registry_bigquery_table
+
+    def load(self):
+        from google.cloud import bigquery
+
+        if not self.table:
+            raise ValueError("PROMPT_REGISTRY_BIGQUERY_TABLE isn't set")
+        client = bigquery.Client(project=project)
+        rows = client.query(f"SELECT explore_id, examples FROM `{self.table}`").result()
+        example_sets = [{"id": row["explore_id"], "version": 1, "examples": json.loads(row["examples"])} for row in rows]
+        return {"templates": [], "example_sets": example_sets}
+
+
+# Loaders by name. Other sources can be added here, as any object with a load() method returning the same dict as FileLoader.
+LOADERS = {
+    "files": FileLoader,
+    "bigquery": BigQueryLoader,
+}
+
+
+class RenderedPrompt:
+    """
+    A template rendered with its variables: the system instruction, the user message, and the examples
+    converted to alternating user and model turns, which go in front of the request's history.
+    """
+
+    def __init__(self, system_instruction, contents, example_contents):
+        self.system_instruction = system_instruction
+        self.contents = contents
+        self.example_contents = example_contents
+
+
+def get_example_contents(examples):
+    contents = []
+    for example in examples:
+        contents.append(types.Content(role="user", parts=[types.Part(text=example["input"])]))
+        contents.append(types.Content(role="model", parts=[types.Part(text=example["output"])]))
+    return contents
+
+
+def is_invalid_template_reference(reference):
+    if reference is None:
+        return None
+    if not isinstance(reference, dict):
+        return "template must be an object"
+    if set(reference) - {"id", "version", "variables", "examples", "example_count"}:
+        return "template can only contain id, version, variables, examples and example_count"
+    if not isinstance(reference.get("id"), str):
+        return "template id must be a string"
+    if "version" in reference and type(reference["version"]) is not int:
+        return "template version must be an integer"
+    if "examples" in reference and not isinstance(reference["examples"], str):
+        return "template examples must be the id of an example set"
+    if "example_count" in reference and (type(reference["example_count"]) is not int or reference["example_count"] < 1):
+        return "template example_count must be a positive integer"
+    variables = reference.get("variables", {})
+    if not isinstance(variables, dict) or not all(isinstance(value, (str, int, float)) for value in variables.values()):
+        return "template variables must be an object of strings and numbers"
+    return None
+
+
+def get_identifiers(text_template):
+    """
+    Returns the names of the variables a string.Template uses, like Template.get_identifiers, which needs Python 3.11.
+    """
+    names = []
+    for match in text_template.pattern.finditer(text_template.template):
+        name = match.group("named") or match.group("braced")
+        if name is not None and name not in names:
+            names.append(name)
+    return names
+
+
+def _by_version(definitions):
+    entries = {}
+    for definition in definitions:
+        entries.setdefault(definition["id"], {})[definition.get("version", 1)] = definition
+    return entries
+
+
+class PromptRegistry:
+    """
+    Thread safe registry of named, versioned prompt templates and example sets.
+
+    A template has a system_instruction and a contents string, where $name is replaced by a variable, and can
+    name the example set to put in front of the history, and an example_count to only send the examples most
+    similar to the request's message. Requests reference a template by id, and get its latest
+    version unless they ask for one. Rendered texts and converted example sets are kept in an LRU cache, so a
+    template is only rendered once for the same variables, and an example set converted to types.Content once.
+    """
+
+    def __init__(self, loaders, reload_seconds, max_entries):
+        self.loaders = loaders
+        self.reload_seconds = reload_seconds
+        self.max_entries = max_entries
+        self._templates = {}
+        self._example_sets = {}
+        self._loaded_at = None
+        self._reloading = False
+        self._rendered = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Loads the templates and example sets from every loader. When a loader fails, the registry keeps what was loaded last time.
+        """
+        with self._load_lock:
+            self._load()
+
+    def load_once(self):
+        """
+        Loads the registry unless it was loaded already.
+        """
+        with self._load_lock:
+            # Another request may have loaded it while this one waited
+            if self._loaded_at is None:
+                self._load()
+
+    def is_loaded(self):
+        with self._lock:
+            return self._loaded_at is not None
+
+    def _load(self):
+        templates = []
+        example_sets = []
+        failed = False
+        for loader in self.loaders:
+            try:
+                definitions = loader.load()
+            except Exception as e:
+                logging.warning(f"Error loading prompt templates with {type(loader).__name__}: {str(e)}")
+                failed = True
+                continue
+            templates.extend(definitions.get("templates", []))
+            example_sets.extend(definitions.get("example_sets", []))
+
+        with self._lock:
+            self._loaded_at = time.monotonic()
+            self._reloading = False
+            if failed and (self._templates or self._example_sets):
+                return
+            self._templates = _by_version(templates)
+            self._example_sets = _by_version(example_sets)
+            # Versions can be replaced in place, so nothing rendered from the last load is kept
+            self._rendered.clear()
+        logging.info(f"Loaded {len(templates)} prompt templates and {len(example_sets)} example sets")
+
+    def resolve(self, reference):
+        """
+        Returns the reference with the versions of its template and example set filled in, so it identifies
+        one rendered prompt, e.g. in the response cache key. Raises PromptTemplateError.
+        """
+        self._load_if_stale()
+        with self._lock:
+            template = self._get(self._templates, "template", reference["id"], reference.get("version"))
+            example_set_id = reference.get("examples", template.get("examples"))
+            example_set = self._get(self._example_sets, "example set", example_set_id, None) if example_set_id else None
+
+        variables = {**template.get("variables", {}), **reference.get("variables", {})}
+        missing = [
+            name
+            for text in (template.get("system_instruction"), template.get("contents"))
+            if text
+            for name in get_identifiers(string.Template(text))
+            if name not in variables
+        ]
+        if missing:
+            raise PromptTemplateError(f"Template {reference['id']} is missing the variables {', '.join(sorted(set(missing)))}")
+
+        return {
+            "id": reference["id"],
+            "version": template.get("version", 1),
+            "variables": reference.get("variables", {}),
+            "examples": example_set_id,
+            "examples_version": example_set.get("version", 1) if example_set else None,
+            "example_count": reference.get("example_count", template.get("example_count")),
+        }
+
+    def render(self, reference):
+        """
+        Returns the RenderedPrompt of a reference returned by resolve.
+        """
+        with self._lock:
+            template = self._get(self._templates, "template", reference["id"], reference["version"])
+        variables = {**template.get("variables", {}), **reference["variables"]}
+
+        example_contents = []
+        if reference["examples"]:
+            example_contents = self._cached(["examples", reference["examples"], reference["examples_version"]], lambda: get_example_contents(
+                self._get(self._example_sets, "example set", reference["examples"], reference["examples_version"])["examples"]
+            ))
+        return RenderedPrompt(
+            system_instruction=self._render_text(reference, template, "system_instruction", variables),
+            contents=self._render_text(reference, template, "contents", variables),
+            example_contents=example_contents,
+        )
+
+    def _render_text(self, reference, template, field, variables):
+        text = template.get(field)
+        if not text:
+            return None
+        text_template = string.Template(text)
+        # Only the variables the text uses are in the key, so a large system instruction is rendered once,
+        # whatever the variables of the user message
+        used_variables = {name: str(variables[name]) for name in get_identifiers(text_template)}
+        return self._cached([reference["id"], reference["version"], field, used_variables], lambda: text_template.substitute(used_variables))
+
+    def _cached(self, key_fields, render):
+        key = json.dumps(key_fields, sort_keys=True)
+        with self._lock:
+            rendered = self._rendered.get(key)
+            if rendered is not None:
+                self._rendered.move_to_end(key)
+                self.hits += 1
+                return rendered
+            self.misses += 1
+
+        rendered = render()
+        with self._lock:
+            self._rendered[key] = rendered
+            while len(self._rendered) > self.max_entries:
+                self._rendered.popitem(last=False)
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "templates": sum(len(versions) for versions in self._templates.values()),
+                "example_sets": sum(len(versions) for versions in self._example_sets.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._rendered),
+            }
+
+    def _get(self, entries, kind, entry_id, version):
+        versions = entries.get(entry_id)
+        if not versions:
+            raise PromptTemplateError(f"Unknown {kind} {entry_id}")
+        if version is None:
+            return versions[max(versions)]
+        if version not in versions:
+            raise PromptTemplateError(f"Unknown version {version} of {kind} {entry_id}")
+        return versions[version]
+
+    def _load_if_stale(self):
+        with self._lock:
+            if self._loaded_at is None:
+                first_load = True
+            elif not self._reloading and time.monotonic() - self._loaded_at > self.reload_seconds:
+                first_load = False
+                self._reloading = True
+            else:
+                return
+
+        if first_load:
+            self.load_once()
+        else:
+            # Requests keep using the loaded templates while the new ones load
+            threading.Thread(target=self.load, name="prompt-registry-reload", daemon=True).start()
+
+
+prompt_registry = PromptRegistry(
+    [LOADERS[name.strip()]() for name in prompt_registry_loaders.split(",") if name.strip()],
+    prompt_registry_reload_seconds,
+    prompt_cache_max_entries,
+)
@@ -0,0 +1,130 @@
+import contextlib
+import os
+import random
+import threading
+import time
+
+from circuit_breaker import get_breaker, is_failure
+
+
+# Regions every model can be served from, as "region,region", and per model overrides as "model=region|region,model=region"
+default_regions = os.environ.get("REGIONS", "")
+model_regions_overrides = os.environ.get("MODEL_REGIONS", "")
+# Weight of the newest sample in the moving averages
+region_ewma_alpha = float(os.environ.get("REGION_EWMA_ALPHA", 0.2))
+# How much a region's error rate weighs against its latency
+region_error_penalty = float(os.environ.get("REGION_ERROR_PENALTY", 10))
+# Fraction of calls sent to a random region, so the averages of the other regions stay current
+region_explore_rate = float(os.environ.get("REGION_EXPLORE_RATE", 0.05))
+
+
+def parse_model_regions(overrides):
+    regions = {}
+    for item in overrides.split(","):
+        if "=" not in item:
+            continue
+        name, model_regions = item.split("=", 1)
+        regions[name.strip()] = [region.strip() for region in model_regions.split("|") if region.strip()]
+    return regions
+
+
+model_regions = parse_model_regions(model_regions_overrides)
+
+
+class RegionStats:
+    """
+    Exponentially weighted moving averages of the latency and error rate of calls to one model in one region.
+    """
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+
+    def record(self, latency_seconds, failed):
+        self.calls += 1
+        self.error_rate += region_ewma_alpha * (float(failed) - self.error_rate)
+        if not failed:
+            if self.latency is None:
+                self.latency = latency_seconds
+            else:
+                self.latency += region_ewma_alpha * (latency_seconds - self.latency)
+
+    def score(self):
+        # Regions without a successful call yet are tried first
+        if self.latency is None:
+            return 0.0 if self.error_rate == 0 else float("inf")
+        return self.latency * (1 + region_error_penalty * self.error_rate)
+
+    def stats(self):
+        return {
+            "latency_ewma_seconds": self.latency,
+            "error_rate_ewma": self.error_rate,
+            "calls": self.calls,
+            "score": self.score(),
+        }
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_regions(model_name, primary_location):
+    regions = model_regions.get(model_name)
+    if regions:
+        return regions
+    if default_regions:
+        return [region.strip() for region in default_regions.split(",") if region.strip()]
+    return [primary_location]
+
+
+def choose_region(model_name, primary_location, exclude=None):
+    """
+    Returns the region with the best recent latency and error rate for the model,
+    skipping regions whose circuit is open and not yet due for a trial call. Falls back to the first region when none is available.
+    """
+    regions = get_regions(model_name, primary_location)
+    candidates = [
+        region for region in regions
+        if region != exclude and not get_breaker(model_name, region).is_open()
+    ]
+    if not candidates:
+        # Let the circuit breaker of the first region decide
+        return regions[0]
+
+    if len(candidates) > 1 and random.random() < region_explore_rate:
+        return random.choice(candidates)
+
+    with _lock:
+        return min(candidates, key=lambda region: _stats[(model_name, region)].score() if (model_name, region) in _stats else 0.0)
+
+
+def record(model_name, region, latency_seconds, failed):
+    with _lock:
+        stats = _stats.get((model_name, region))
+        if stats is None:
+            stats = _stats[(model_name, region)] = RegionStats()
+        stats.record(latency_seconds, failed)
+
+
+@contextlib.contextmanager
+def observe(model_name, region):
+    """
+    Records the latency and outcome of the call made in the block.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        if is_failure(e):
+            record(model_name, region, time.monotonic() - start, True)
+        raise
+    record(model_name, region, time.monotonic() - start, False)
+
+
+def region_stats():
+    with _lock:
+        return {
+            f"{model_name}/{region}": stats.stats()
+            for (model_name, region), stats in _stats.items()
+        }
@@ -0,0 +1,112 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+# "deterministic" only stores temperature 0 and response_schema requests, "all" stores everything, "off" disables the cache
+cache_mode = os.environ.get("RESPONSE_CACHE_MODE", "deterministic")
+cache_max_entries = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+cache_max_bytes = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+cache_ttl_seconds = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600))
+
+KEY_FIELDS = ["contents", "history", "parameters", "model_name", "response_schema", "tools", "system_instruction", "history_policy", "template"]
+
+
+def request_hash(generate_args):
+    """
+    Returns a stable hash of the fields that determine the model output.
+    Keys are sorted so that the same request always hashes the same, whatever the client's key order.
+    """
+    canonical = json.dumps(
+        [generate_args.get(field) for field in KEY_FIELDS],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(generate_args):
+    if cache_mode == "off":
+        return False
+    if cache_mode == "all":
+        return True
+
+    parameters = generate_args.get("parameters") or {}
+    return parameters.get("temperature") == 0 or bool(generate_args.get("response_schema"))
+
+
+class ResponseCache:
+    """
+    Thread safe LRU cache with a per entry TTL, bounded by entry count and by the size of the cached responses.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, time.monotonic() + self.ttl_seconds)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+response_cache = ResponseCache(cache_max_entries, cache_max_bytes, cache_ttl_seconds)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from lazy import lazy_import
+from tracing import start_span
+
+errors = lazy_import("google.genai.errors")
+httpx = lazy_import("httpx")
+
+
+# Time budget for a request, kept under the 60s function timeout
+request_timeout_seconds = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", 55))
+retry_max_attempts = int(os.environ.get("RETRY_MAX_ATTEMPTS", 4))
+retry_initial_backoff_seconds = float(os.environ.get("RETRY_INITIAL_BACKOFF_SECONDS", 0.5))
+retry_max_backoff_seconds = float(os.environ.get("RETRY_MAX_BACKOFF_SECONDS", 8))
+
+RETRIABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Statuses passed on to the client once the retries are exhausted, since they tell it when to come back
+PASSED_ON_STATUS_CODES = {429, 503}
+
+_stats = {
+    "retried_requests": 0,
+    "retries": 0,
+    "exhausted": 0,
+    "backoff_seconds_total": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+class RetriesExhausted(Exception):
+    """
+    Raised when an upstream call was still rate limited or overloaded on its last attempt,
+    so that the client gets the same status code, and a Retry-After.
+    """
+
+    def __init__(self, description, error, attempts, retry_after):
+        super().__init__(f"{description} failed after {attempts} attempts: {str(error)}")
+        self.status_code = error.code
+        self.attempts = attempts
+        self.retry_after = retry_after
+
+
+def get_deadline():
+    return time.monotonic() + request_timeout_seconds
+
+
+def remaining_seconds(deadline):
+    return max(0.0, deadline - time.monotonic())
+
+
+def is_retriable(error):
+    """
+    Rate limits, server errors and transport failures are retriable. Everything else,
+    such as an invalid request or a response that can't be parsed, is terminal.
+    """
+    if isinstance(error, errors.APIError):
+        return error.code in RETRIABLE_STATUS_CODES
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+def get_max_backoff_seconds(attempt):
+    return min(retry_max_backoff_seconds, retry_initial_backoff_seconds * 2 ** (attempt - 1))
+
+
+def get_backoff_seconds(attempt):
+    # Capped exponential backoff with full jitter
+    return random.uniform(0, get_max_backoff_seconds(attempt))
+
+
+def get_retry_after(error, attempt):
+    """
+    Returns the seconds a client should wait after the last attempt failed: the Retry-After of the upstream response
+    when it has one in seconds, or else the longest backoff the next attempt could have waited.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    retry_after = headers.get("Retry-After") if headers is not None else None
+    if retry_after and retry_after.isdigit():
+        return max(1, int(retry_after))
+    return max(1, math.ceil(get_max_backoff_seconds(attempt)))
+
+
+def get_exhausted_error(error, attempt, description):
+    """
+    Returns the RetriesExhausted to raise instead of the last error, or None to raise the error as is.
+    """
+    if not isinstance(error, errors.APIError) or error.code not in PASSED_ON_STATUS_CODES:
+        return None
+    return RetriesExhausted(description, error, attempt, get_retry_after(error, attempt))
+
+
+def _next_backoff(error, attempt, deadline, description):
+    """
+    Returns how long to wait before the next attempt, or None when the error should be raised.
+    """
+    if not is_retriable(error):
+        return None
+
+    backoff_seconds = get_backoff_seconds(attempt)
+    if attempt >= retry_max_attempts or backoff_seconds >= remaining_seconds(deadline):
+        with _stats_lock:
+            _stats["exhausted"] += 1
+        return None
+
+    logging.warning(f"Retrying {description} in {backoff_seconds:.2f}s after attempt {attempt} failed: {str(error)}")
+    return backoff_seconds
+
+
+def _record(attempt, backoff_seconds_total, description, error=None):
+    if attempt == 1:
+        return
+
+    if error is None:
+        logging.info(f"{description} succeeded after {attempt} attempts and {backoff_seconds_total:.2f}s of backoff")
+    else:
+        logging.warning(f"{description} failed after {attempt} attempts and {backoff_seconds_total:.2f}s of backoff: {str(error)}")
+    with _stats_lock:
+        _stats["retried_requests"] += 1
+        _stats["retries"] += attempt - 1
+        _stats["backoff_seconds_total"] += backoff_seconds_total
+
+
+def call_with_retry(fn, deadline, description):
+    """
+    Calls fn until it succeeds, a terminal error is raised, the attempts run out,
+    or the next backoff would not fit in the time left before the deadline.
+    A rate limit or an overload on the last attempt is raised as RetriesExhausted.
+    """
+    attempt = 0
+    backoff_seconds_total = 0.0
+    while True:
+        attempt += 1
+        try:
+            result = fn()
+        except Exception as e:
+            backoff_seconds = _next_backoff(e, attempt, deadline, description)
+            if backoff_seconds is None:
+                _record(attempt, backoff_seconds_total, description, e)
+                exhausted_error = get_exhausted_error(e, attempt, description)
+                if exhausted_error is None:
+                    raise
+                raise exhausted_error from e
+            with start_span("retry_backoff", {"gemini.retry.attempt": attempt, "gemini.retry.backoff_seconds": backoff_seconds}):
+                time.sleep(backoff_seconds)
+            backoff_seconds_total += backoff_seconds
+            continue
+
+        _record(attempt, backoff_seconds_total, description)
+        return result
+
+
+async def call_with_retry_async(coroutine_fn, deadline, description):
+    """
+    Async version of call_with_retry.
+    """
+    attempt = 0
+    backoff_seconds_total = 0.0
+    while True:
+        attempt += 1
+        try:
+            result = await coroutine_fn()
+        except Exception as e:
+            backoff_seconds = _next_backoff(e, attempt, deadline, description)
+            if backoff_seconds is None:
+                _record(attempt, backoff_seconds_total, description, e)
+                exhausted_error = get_exhausted_error(e, attempt, description)
+                if exhausted_error is None:
+                    raise
+                raise exhausted_error from e
+            with start_span("retry_backoff", {"gemini.retry.attempt": attempt, "gemini.retry.backoff_seconds": backoff_seconds}):
+                await asyncio.sleep(backoff_seconds)
+            backoff_seconds_total += backoff_seconds
+            continue
+
+        _record(attempt, backoff_seconds_total, description)
+        return result
+
+
+def retry_stats():
+    with _stats_lock:
+        return dict(_stats)
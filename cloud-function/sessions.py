@@ -0,0 +1,204 @@
+import collections
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+from lazy import lazy_import
+
+types = lazy_import("google.genai.types")
+
+
+# Sessions are signed with the same secret as the requests, so a session id can't be made up
+vertex_cf_auth_token = os.environ.get("VERTEX_CF_AUTH_TOKEN")
+session_max_entries = int(os.environ.get("SESSION_MAX_ENTRIES", 1000))
+session_max_bytes = int(os.environ.get("SESSION_MAX_BYTES", 256 * 1024 * 1024))
+# Sessions expire after this many seconds without a turn
+session_ttl_seconds = float(os.environ.get("SESSION_TTL_SECONDS", 1800))
+
+
+class SessionError(Exception):
+    """
+    Raised for a session that can't be continued. The client starts a new session with the full history.
+    """
+
+    retry_after = None
+
+    def __init__(self, session_id, reason):
+        super().__init__(f"Session {session_id} {reason}")
+        self.session_id = session_id
+
+
+class SessionNotFound(SessionError):
+    """
+    Raised when a session expired, was evicted, or lives on another instance.
+    """
+
+    status_code = 404
+
+    def __init__(self, session_id):
+        super().__init__(session_id, "was not found, start a new session with the full history")
+
+
+class SessionConflict(SessionError):
+    """
+    Raised when another turn was added to the session while this one was generated.
+    """
+
+    status_code = 409
+
+    def __init__(self, session_id):
+        super().__init__(session_id, "was changed by another request, start a new session with the full history")
+
+
+def sign_session_id(token):
+    return hmac.new(vertex_cf_auth_token.encode("utf-8"), token.encode("utf-8"), "sha256").hexdigest()[:32]
+
+
+def is_valid_session_id(session_id):
+    if not isinstance(session_id, str) or "." not in session_id:
+        return False
+    token, signature = session_id.rsplit(".", 1)
+    return hmac.compare_digest(signature, sign_session_id(token))
+
+
+def get_model_content(response_parts):
+    """
+    Converts the parts returned to the client back to the model's turn in the conversation.
+    Consecutive text parts, e.g. the deltas of a stream, are joined into one part.
+    """
+    parts = []
+    text = None
+    for part in response_parts:
+        if "text" in part:
+            text = (text or "") + part["text"]
+            continue
+        if text is not None:
+            parts.append(types.Part(text=text))
+            text = None
+        if "functionCall" in part:
+            parts.append(types.Part(function_call=types.FunctionCall(name=part["functionCall"]["name"], args=part["functionCall"]["args"])))
+        elif "object" in part:
+            parts.append(types.Part(text=json.dumps(part["object"])))
+    if text is not None:
+        parts.append(types.Part(text=text))
+    return types.Content(role="model", parts=parts)
+
+
+class Session:
+    """
+    A conversation kept on the server: its turns already converted to types.Content, and the tools and
+    system instruction it was last sent, which later turns don't have to repeat.
+    """
+
+    def __init__(self, contents=(), tools=None, system_instruction=None, size=0, version=0):
+        self.contents = contents
+        self.tools = tools
+        self.system_instruction = system_instruction
+        self.size = size
+        self.version = version
+
+
+class SessionStore:
+    """
+    Thread safe LRU store of sessions, bounded by session count and by the size of their turns.
+    A session expires ttl_seconds after its last use.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl_seconds):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def create(self):
+        """
+        Starts an empty session and returns its signed id.
+        """
+        token = secrets.token_urlsafe(16)
+        session_id = f"{token}.{sign_session_id(token)}"
+        with self._lock:
+            self._entries[session_id] = (Session(), time.monotonic() + self.ttl_seconds)
+            self._evict()
+        return session_id
+
+    def get(self, session_id):
+        """
+        Returns the session, which is never changed in place, so it stays a consistent snapshot
+        while the turn is generated. Raises SessionNotFound.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    self._remove(session_id)
+                self.misses += 1
+                raise SessionNotFound(session_id)
+
+            session = entry[0]
+            self._entries[session_id] = (session, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return session
+
+    def append(self, session_id, session, new_contents, response_parts, tools=None, system_instruction=None):
+        """
+        Adds the turn that was generated from session: the new contents sent by the client and the model's answer.
+        Raises SessionNotFound, or SessionConflict when another turn was added since session was read.
+        """
+        turn = [*new_contents, get_model_content(response_parts)]
+        size = sum(len(content.model_dump_json(exclude_none=True)) for content in turn)
+
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                raise SessionNotFound(session_id)
+            if entry[0].version != session.version:
+                raise SessionConflict(session_id)
+
+            updated_session = Session(
+                contents=session.contents + tuple(turn),
+                tools=tools or session.tools,
+                system_instruction=system_instruction or session.system_instruction,
+                size=session.size + size,
+                version=session.version + 1,
+            )
+            self._entries[session_id] = (updated_session, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(session_id)
+            self._bytes += size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest_session_id = next(iter(self._entries))
+            self._remove(oldest_session_id)
+            self.evictions += 1
+
+    def _remove(self, session_id):
+        session, _ = self._entries.pop(session_id)
+        self._bytes -= session.size
+
+
+session_store = SessionStore(session_max_entries, session_max_bytes, session_ttl_seconds)
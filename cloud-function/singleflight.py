@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function,
+    later callers wait for it and get the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if is_leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    Async version of SingleFlight. The shared call runs as its own task, so a cancelled caller
+    doesn't cancel it for the others; the task is only cancelled once every caller has gone away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_fn):
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(coroutine_fn())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+            # This caller was cancelled; cancel the shared call if nobody else is waiting on it
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._forget(key, task)
+                task.cancel()
+            raise
+
+    def _forget(self, key, task):
+        entry = self._calls.get(key)
+        if entry is not None and entry[0] is task:
+            del self._calls[key]
+
+
+inflight_requests = SingleFlight()
+async_inflight_requests = AsyncSingleFlight()
@@ -1,9 +1,34 @@
 import unittest
 import hmac
 import hashlib
+import io
 import json
 import requests
 import os
+import socket
+import tempfile
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import circuit_breaker
+import client_pool
+import context_cache
+import fallback
+import hedging
+import history_window
+import region_router
+import retry
+from admission import AdmissionController, AdmissionRejected, AsyncAdmissionController
+from circuit_breaker import CircuitOpen, call_with_circuit_breaker, call_with_circuit_breaker_async
+from example_selector import ExampleSelector, get_embedding_config, normalize, top_k
+from fake_vertex import FakeVertexConfig, create_fake_vertex_app
+from prompt_registry import FileLoader, PromptRegistry, PromptTemplateError, get_example_contents
+from response_cache import ResponseCache, request_hash
+from retry import RetriesExhausted, call_with_retry, call_with_retry_async, get_deadline
+from singleflight import AsyncSingleFlight, SingleFlight
 
 
 def assert_non_zero_text_parts(test_case, response):
@@ -32,6 +57,68 @@ def assert_non_zero_text_parts(test_case, response):
         )
 
 
+def wait_until(condition, timeout=5):
+    """
+    Waits for condition() to be true, e.g. for threads to reach a given point.
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the condition")
+        time.sleep(0.01)
+
+
+def start_fake_vertex(config):
+    """
+    Serves the offline stand-in for Vertex AI from a thread, on a free port.
+    Returns its URL, and the server, which stops once its should_exit is set.
+    """
+    import uvicorn
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(create_fake_vertex_app(config), log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [listener]}, daemon=True).start()
+    wait_until(lambda: server.started)
+    return f"http://127.0.0.1:{listener.getsockname()[1]}", server
+
+
+def sign(body, secret):
+    return hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class FakeVertexMixin:
+    """
+    Serves the offline stand-in for Vertex AI to the tests of a class, started once for the class.
+    start_patchers points the pooled clients at it, along with the patchers of the test.
+    """
+
+    @classmethod
+    def get_fake_vertex_config(cls):
+        return FakeVertexConfig(latency="fixed:0", chunk_latency="fixed:0")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake_vertex_config = cls.get_fake_vertex_config()
+        cls.fake_vertex_url, cls.fake_vertex = start_fake_vertex(cls.fake_vertex_config)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake_vertex.should_exit = True
+
+    @classmethod
+    def get_fake_vertex_patchers(cls):
+        return [
+            mock.patch.object(client_pool, "vertex_base_url", cls.fake_vertex_url),
+            mock.patch.dict(client_pool._clients, clear=True),
+        ]
+
+    def start_patchers(self, patchers=()):
+        for patcher in [*self.get_fake_vertex_patchers(), *patchers]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
 class LiveBackendTests(unittest.TestCase):
 
     @classmethod
@@ -40,6 +127,8 @@ class LiveBackendTests(unittest.TestCase):
         cls.backend_url = os.environ.get("BACKEND_URL", "http://127.0.0.1:8000")
         # Full path for the /generate_content endpoint
         cls.generate_content_url = f"{cls.backend_url}/generate_content"
+        cls.stream_generate_content_url = f"{cls.backend_url}/stream_generate_content"
+        cls.batch_generate_content_url = f"{cls.backend_url}/batch_generate_content"
         # Load the secret key from the file
         with open('../.vertex_cf_auth_token', 'r') as file:
             cls.secret_key = file.read().strip()  # Remove any potential newline characters
@@ -455,6 +544,1663 @@ class LiveBackendTests(unittest.TestCase):
         self.assertEqual(function_call["args"]["location"], "San Francisco, CA",
                          "Function args should include the correct location.")
 
+    def test_stream_generate_content(self):
+        # Define payload for a streamed response
+        data = {
+            "contents": "Tell me a short story about a lighthouse.",
+            "parameters": {"max_output_tokens": 500}
+        }
+        # Generate HMAC signature
+        signature = self.generate_hmac_signature(self.secret_key, data)
+
+        # Send the request to the /stream_generate_content endpoint
+        response = self.send_request(self.stream_generate_content_url, data, signature)
+
+        # Assert response
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/event-stream"))
+
+        # Collect the events, skipping heartbeat comments
+        events = []
+        for block in response.text.split("\n\n"):
+            lines = [line for line in block.split("\n") if line and not line.startswith(":")]
+            if not lines:
+                continue
+            event = lines[0][len("event: "):]
+            payload = json.loads(lines[1][len("data: "):])
+            events.append((event, payload))
+
+        text_events = [payload for event, payload in events if event == "text"]
+        self.assertGreater(len(text_events), 0, "Stream should contain text events.")
+        self.assertGreater(len("".join(payload["text"] for payload in text_events)), 0)
+        self.assertEqual(events[-1][0], "usage", "The last event should report usage.")
+        self.assertIn("total_token_count", events[-1][1])
+
+    def test_batch_generate_content(self):
+        # Define a batch with two valid requests and one with an invalid history
+        data = {
+            "requests": [
+                {"contents": "Tell me a fun fact about mars.", "parameters": {"max_output_tokens": 500}},
+                {"contents": "What is the weather like today?", "history": {"role": "user", "parts": ["Hi"]}},
+                {"contents": "Tell me a fun fact about venus.", "parameters": {"max_output_tokens": 500}}
+            ]
+        }
+        # Generate HMAC signature over the whole batch
+        signature = self.generate_hmac_signature(self.secret_key, data)
+
+        # Send the request to the /batch_generate_content endpoint
+        response = self.send_request(self.batch_generate_content_url, data, signature)
+
+        # Assert response
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(len(results), 3, "There should be one result per request.")
+        self.assertEqual([result["status"] for result in results], [200, 400, 200])
+        self.assertIn("invalid history format", results[1]["error"].lower())
+        for result in [results[0], results[2]]:
+            self.assertGreater(len(result["response"]), 0)
+            self.assertGreater(len(result["response"][0]["text"]), 0)
+
+    def test_generate_with_session(self):
+        # Start a session with the full history
+        data = {
+            "contents": "What is the capital of France?",
+            "history": [
+                {"role": "user", "parts": ["Let's talk about geography."]},
+                {"role": "model", "parts": ["Sure, what would you like to know?"]}
+            ],
+            "new_session": True
+        }
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.generate_content_url, data, signature)
+
+        self.assertEqual(response.status_code, 200)
+        session_id = response.headers.get("X-Session-Id")
+        self.assertIsNotNone(session_id, "A new session should return its id.")
+        assert_non_zero_text_parts(self, response)
+
+        # Continue it with only the new turn
+        data = {"contents": "And what is its population?", "session_id": session_id}
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.generate_content_url, data, signature)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("X-Session-Id"), session_id)
+        assert_non_zero_text_parts(self, response)
+
+    def test_stream_with_unknown_session(self):
+        # A session id signed with the secret, for a session that doesn't exist on the backend
+        token = "unknown-session"
+        session_id = f"{token}.{hmac.new(self.secret_key.encode(), token.encode(), hashlib.sha256).hexdigest()[:32]}"
+        data = {"contents": "And what is its population?", "session_id": session_id}
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.stream_generate_content_url, data, signature)
+        # Answered with the status of the error rather than an error event in a 200 stream
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("start a new session", response.json()["error"])
+
+    def test_generate_with_invalid_session(self):
+        data = {"contents": "And what is its population?", "session_id": "unknown.session"}
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.generate_content_url, data, signature)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("session_id", response.json()["error"])
+
+    def test_generate_with_history_policy(self):
+        history = []
+        for index in range(10):
+            history.append({"role": "user", "parts": [f"Tell me fact number {index} about the ocean."]})
+            history.append({"role": "model", "parts": [f"Here is ocean fact number {index}."]})
+        data = {"contents": "Which fact did you tell me last?", "history": history}
+
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        full_response = self.send_request(self.generate_content_url, data, signature)
+
+        data["history_policy"] = {"mode": "turns", "max_turns": 2}
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.generate_content_url, data, signature)
+
+        self.assertEqual(response.status_code, 200)
+        assert_non_zero_text_parts(self, response)
+        # Only the last two turns were sent
+        self.assertLess(int(response.headers["X-Prompt-Token-Count"]), int(full_response.headers["X-Prompt-Token-Count"]))
+
+    def test_generate_with_unknown_template(self):
+        data = {"template": {"id": "no_such_template", "variables": {"question": "Sales by state"}}}
+        signature = self.generate_hmac_signature(self.secret_key, data)
+        response = self.send_request(self.generate_content_url, data, signature)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("no_such_template", response.json()["error"])
+
+    def test_stats_require_signature(self):
+        # Routes without a JSON body are signed over their empty body
+        signature = hmac.new(self.secret_key.encode(), b"", hashlib.sha256).hexdigest()
+        for path in ["/admission_stats", "/circuit_stats", "/region_stats", "/cache_stats", "/metrics"]:
+            response = requests.get(f"{self.backend_url}{path}")
+            self.assertEqual(response.status_code, 403, path)
+
+            response = requests.get(f"{self.backend_url}{path}", headers={"X-Signature": signature})
+            self.assertEqual(response.status_code, 200, path)
+            if path != "/metrics":
+                self.assertIsInstance(response.json(), dict)
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def test_entry_expires_after_ttl(self):
+        cache = ResponseCache(max_entries=10, max_bytes=1024, ttl_seconds=60)
+        with mock.patch("response_cache.time.monotonic", return_value=100.0):
+            cache.put("key", [{"text": "hello"}])
+        with mock.patch("response_cache.time.monotonic", return_value=159.0):
+            self.assertEqual(cache.get("key"), [{"text": "hello"}])
+        with mock.patch("response_cache.time.monotonic", return_value=160.0):
+            self.assertIsNone(cache.get("key"))
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"], stats["bytes"]), (1, 1, 0, 0))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2, max_bytes=1024, ttl_seconds=60)
+        cache.put("a", "first")
+        cache.put("b", "second")
+        # Reading a makes b the least recently used
+        cache.get("a")
+        cache.put("c", "third")
+
+        self.assertEqual(cache.get("a"), "first")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "third")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_are_evicted_beyond_max_bytes(self):
+        # Each value is 12 bytes of JSON
+        cache = ResponseCache(max_entries=10, max_bytes=30, ttl_seconds=60)
+        for key in ("a", "b", "c"):
+            cache.put(key, "x" * 10)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.stats()["bytes"], 24)
+
+    def test_response_larger_than_max_bytes_is_not_cached(self):
+        cache = ResponseCache(max_entries=10, max_bytes=10, ttl_seconds=60)
+        cache.put("key", "x" * 10)
+
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_replacing_an_entry_keeps_the_size(self):
+        cache = ResponseCache(max_entries=10, max_bytes=1024, ttl_seconds=60)
+        cache.put("key", "x" * 10)
+        cache.put("key", "y" * 10)
+
+        self.assertEqual(cache.get("key"), "y" * 10)
+        self.assertEqual(cache.stats()["bytes"], 12)
+
+    def test_request_hash_ignores_key_order(self):
+        first = {"contents": "hi", "parameters": {"temperature": 0, "top_p": 0.5}}
+        second = {"parameters": {"top_p": 0.5, "temperature": 0}, "contents": "hi"}
+
+        self.assertEqual(request_hash(first), request_hash(second))
+        self.assertNotEqual(request_hash(first), request_hash({**first, "contents": "hello"}))
+
+
+class AdmissionControllerTests(unittest.TestCase):
+
+    def hold_slot(self, controller, release):
+        def hold():
+            with controller.admit():
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        wait_until(lambda: controller.in_flight == 1)
+        return holder
+
+    def test_request_waits_for_a_slot(self):
+        controller = AdmissionController("model", max_concurrency=1, max_queue=1)
+        release = threading.Event()
+        holder = self.hold_slot(controller, release)
+
+        def wait_for_slot():
+            with controller.admit():
+                return controller.in_flight
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiter = executor.submit(wait_for_slot)
+            wait_until(lambda: controller.queued == 1)
+            release.set()
+            self.assertEqual(waiter.result(5), 1)
+        holder.join()
+
+        stats = controller.stats()
+        self.assertEqual((stats["in_flight"], stats["queue_depth"], stats["admitted"], stats["rejected"]), (0, 0, 2, 0))
+
+    def test_request_is_rejected_when_the_queue_is_full(self):
+        controller = AdmissionController("model", max_concurrency=1, max_queue=1)
+        release = threading.Event()
+        holder = self.hold_slot(controller, release)
+
+        def wait_for_slot():
+            with controller.admit():
+                pass
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiter = executor.submit(wait_for_slot)
+            wait_until(lambda: controller.queued == 1)
+            with self.assertRaisesRegex(AdmissionRejected, "queue is full") as rejected:
+                with controller.admit():
+                    pass
+            release.set()
+            waiter.result(5)
+        holder.join()
+
+        self.assertEqual(rejected.exception.status_code, 429)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        stats = controller.stats()
+        self.assertEqual((stats["admitted"], stats["rejected"], stats["in_flight"]), (2, 1, 0))
+
+    def test_request_times_out_in_the_queue(self):
+        controller = AdmissionController("model", max_concurrency=1, max_queue=1)
+        release = threading.Event()
+        holder = self.hold_slot(controller, release)
+
+        with mock.patch("admission.queue_timeout_seconds", 0.05):
+            with self.assertRaisesRegex(AdmissionRejected, "timed out"):
+                with controller.admit():
+                    pass
+        release.set()
+        holder.join()
+
+        stats = controller.stats()
+        self.assertEqual((stats["timed_out"], stats["queue_depth"], stats["in_flight"]), (1, 0, 0))
+
+
+class AsyncAdmissionControllerTests(unittest.TestCase):
+
+    def test_queue_is_bounded(self):
+        controller = AsyncAdmissionController("model", max_concurrency=1, max_queue=1)
+
+        async def admit(release):
+            async with controller.admit():
+                await release.wait()
+
+        async def run():
+            release = asyncio.Event()
+            holder = asyncio.ensure_future(admit(release))
+            waiter = asyncio.ensure_future(admit(release))
+            await asyncio.sleep(0.01)
+            self.assertEqual((controller.in_flight, controller.queued), (1, 1))
+            with self.assertRaisesRegex(AdmissionRejected, "queue is full"):
+                await admit(release)
+            release.set()
+            await asyncio.gather(holder, waiter)
+
+        asyncio.run(run())
+        stats = controller.stats()
+        self.assertEqual((stats["admitted"], stats["rejected"], stats["in_flight"], stats["queue_depth"]), (2, 1, 0, 0))
+
+    def test_request_times_out_in_the_queue(self):
+        controller = AsyncAdmissionController("model", max_concurrency=1, max_queue=1)
+
+        async def run():
+            release = asyncio.Event()
+
+            async def hold():
+                async with controller.admit():
+                    await release.wait()
+
+            holder = asyncio.ensure_future(hold())
+            await asyncio.sleep(0)
+            with self.assertRaisesRegex(AdmissionRejected, "timed out"):
+                async with controller.admit():
+                    pass
+            release.set()
+            await holder
+
+        with mock.patch("admission.queue_timeout_seconds", 0.05):
+            asyncio.run(run())
+        stats = controller.stats()
+        self.assertEqual((stats["timed_out"], stats["queue_depth"], stats["in_flight"]), (1, 0, 0))
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_call(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(flight.do, "key", fn) for _ in range(4)]
+            wait_until(lambda: flight.leaders + flight.coalesced == 4)
+            release.set()
+            results = [future.result(5) for future in futures]
+
+        self.assertEqual(results, ["result"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flight.leaders, flight.coalesced), (1, 3))
+
+    def test_error_is_raised_to_every_caller(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait(5)
+            raise ValueError("upstream failed")
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(flight.do, "key", fn) for _ in range(3)]
+            wait_until(lambda: flight.leaders + flight.coalesced == 3)
+            release.set()
+            for future in futures:
+                with self.assertRaisesRegex(ValueError, "upstream failed"):
+                    future.result(5)
+
+    def test_later_call_runs_again(self):
+        flight = SingleFlight()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(flight.do("key", fn), 1)
+        # The first call is done, so the key is free
+        self.assertEqual(flight.do("key", fn), 2)
+        self.assertEqual(flight.do("other", fn), 3)
+        self.assertEqual(flight.coalesced, 0)
+
+
+class AsyncSingleFlightTests(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_call(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            return await asyncio.gather(*[flight.do("key", fn) for _ in range(4)])
+
+        self.assertEqual(asyncio.run(run()), ["result"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flight.leaders, flight.coalesced), (1, 3))
+
+    def test_cancelled_caller_does_not_cancel_the_others(self):
+        flight = AsyncSingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            first = asyncio.ensure_future(flight.do("key", fn))
+            second = asyncio.ensure_future(flight.do("key", fn))
+            await asyncio.sleep(0)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return await second
+
+        self.assertEqual(asyncio.run(run()), "result")
+
+    def test_call_is_cancelled_once_every_caller_is_gone(self):
+        flight = AsyncSingleFlight()
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def fast():
+            return "result"
+
+        async def run():
+            callers = [asyncio.ensure_future(flight.do("key", slow)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            for caller in callers:
+                caller.cancel()
+            await asyncio.gather(*callers, return_exceptions=True)
+            # The key is free, so the next call runs on its own
+            return await flight.do("key", fast)
+
+        self.assertEqual(asyncio.run(run()), "result")
+        self.assertEqual(cancelled, [1])
+        self.assertEqual(flight.leaders, 2)
+
+
+class RetryTests(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.multiple(retry, retry_max_attempts=3, retry_initial_backoff_seconds=0.01, retry_max_backoff_seconds=0.02)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_error(self, code, retry_after=None):
+        from google.genai import errors
+        import httpx
+
+        response = httpx.Response(code, headers={"Retry-After": retry_after} if retry_after else {})
+        error_class = errors.ClientError if code < 500 else errors.ServerError
+        return error_class(code, {"error": {"code": code, "message": "Try again later", "status": "UNAVAILABLE"}}, response)
+
+    def get_failing_fn(self, failures, result="result"):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            if len(calls) <= len(failures):
+                raise failures[len(calls) - 1]
+            return result
+        return fn, calls
+
+    def test_retriable_errors_are_retried(self):
+        fn, calls = self.get_failing_fn([self.get_error(503), self.get_error(429)])
+        self.assertEqual(call_with_retry(fn, get_deadline(), "test"), "result")
+        self.assertEqual(len(calls), 3)
+
+    def test_terminal_errors_are_not_retried(self):
+        error = self.get_error(400)
+        fn, calls = self.get_failing_fn([error])
+        with self.assertRaises(type(error)):
+            call_with_retry(fn, get_deadline(), "test")
+        self.assertEqual(len(calls), 1)
+
+    def test_exhausted_rate_limit_keeps_its_status(self):
+        fn, calls = self.get_failing_fn([self.get_error(429, "7")] * 3)
+        with self.assertRaises(RetriesExhausted) as raised:
+            call_with_retry(fn, get_deadline(), "test")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((raised.exception.status_code, raised.exception.retry_after, raised.exception.attempts), (429, 7, 3))
+
+    def test_exhausted_overload_waits_for_the_backoff(self):
+        fn, _ = self.get_failing_fn([self.get_error(503)] * 3)
+        with self.assertRaises(RetriesExhausted) as raised:
+            call_with_retry(fn, get_deadline(), "test")
+        self.assertEqual((raised.exception.status_code, raised.exception.retry_after), (503, 1))
+
+    def test_exhausted_server_error_is_raised_as_is(self):
+        error = self.get_error(500)
+        fn, _ = self.get_failing_fn([error] * 3)
+        with self.assertRaises(type(error)):
+            call_with_retry(fn, get_deadline(), "test")
+
+    def test_no_retry_past_the_deadline(self):
+        fn, calls = self.get_failing_fn([self.get_error(429)] * 3)
+        with self.assertRaises(RetriesExhausted):
+            call_with_retry(fn, time.monotonic(), "test")
+        self.assertEqual(len(calls), 1)
+
+    def test_attempts_are_recorded_on_failure(self):
+        before = retry.retry_stats()
+        fn, _ = self.get_failing_fn([self.get_error(429)] * 3)
+        with self.assertRaises(RetriesExhausted):
+            call_with_retry(fn, get_deadline(), "test")
+        after = retry.retry_stats()
+        self.assertEqual(after["retried_requests"] - before["retried_requests"], 1)
+        self.assertEqual(after["retries"] - before["retries"], 2)
+        self.assertEqual(after["exhausted"] - before["exhausted"], 1)
+
+    def test_async_exhausted_rate_limit_keeps_its_status(self):
+        fn, calls = self.get_failing_fn([self.get_error(429)] * 3)
+
+        async def coroutine_fn():
+            return fn()
+
+        with self.assertRaises(RetriesExhausted) as raised:
+            asyncio.run(call_with_retry_async(coroutine_fn, get_deadline(), "test"))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((raised.exception.status_code, raised.exception.retry_after), (429, 1))
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patchers = [
+            mock.patch.object(circuit_breaker, "time", mock.Mock(monotonic=lambda: self.now)),
+            mock.patch.multiple(
+                circuit_breaker,
+                circuit_window_seconds=60,
+                circuit_min_calls=4,
+                circuit_error_rate=0.5,
+                circuit_slow_call_seconds=30,
+                circuit_open_seconds=30,
+                circuit_half_open_calls=1,
+                circuit_fallback_location=None,
+            ),
+            mock.patch.dict(circuit_breaker._breakers, clear=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_error(self, code):
+        from google.genai import errors
+
+        return errors.ServerError(code, {"error": {"code": code, "message": "Unavailable", "status": "UNAVAILABLE"}})
+
+    def call(self, failed=False, seconds=0, location="us-central1"):
+        def fn(called_location):
+            self.now += seconds
+            if failed:
+                raise self.get_error(503)
+            return called_location
+        try:
+            return call_with_circuit_breaker("gemini", location, fn)
+        except CircuitOpen:
+            raise
+        except Exception:
+            return None
+
+    def get_state(self, location="us-central1"):
+        return circuit_breaker.get_breaker("gemini", location).state
+
+    def open_circuit(self):
+        for _ in range(2):
+            self.call()
+        for _ in range(2):
+            self.call(failed=True)
+
+    def test_opens_at_the_error_rate(self):
+        self.call()
+        self.call()
+        self.call(failed=True)
+        self.assertEqual(self.get_state(), circuit_breaker.CLOSED)
+        self.call(failed=True)
+        self.assertEqual(self.get_state(), circuit_breaker.OPEN)
+        with self.assertRaises(CircuitOpen) as raised:
+            self.call()
+        self.assertEqual((raised.exception.status_code, raised.exception.retry_after), (503, 31))
+
+    def test_failures_leave_the_window(self):
+        self.call(failed=True)
+        self.call(failed=True)
+        self.now += 61
+        self.call()
+        self.call()
+        self.call(failed=True)
+        self.assertEqual(self.get_state(), circuit_breaker.CLOSED)
+
+    def test_terminal_errors_do_not_count(self):
+        from google.genai import errors
+
+        def fn(location):
+            raise errors.ClientError(400, {"error": {"code": 400, "message": "Invalid", "status": "INVALID_ARGUMENT"}})
+
+        for _ in range(4):
+            with self.assertRaises(errors.ClientError):
+                call_with_circuit_breaker("gemini", "us-central1", fn)
+        self.assertEqual(circuit_breaker.get_breaker("gemini", "us-central1").stats()["calls_in_window"], 0)
+
+    def test_half_open_trial_closes_the_circuit(self):
+        self.open_circuit()
+        self.now += 31
+        self.assertEqual(self.call(), "us-central1")
+        self.assertEqual(self.get_state(), circuit_breaker.CLOSED)
+        self.assertEqual(
+            circuit_breaker.get_breaker("gemini", "us-central1").transitions,
+            {"closed_to_open": 1, "open_to_half_open": 1, "half_open_to_closed": 1},
+        )
+
+    def test_half_open_trial_failure_opens_the_circuit(self):
+        self.open_circuit()
+        self.now += 31
+        self.call(failed=True)
+        self.assertEqual(self.get_state(), circuit_breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.call()
+
+    def test_half_open_lets_one_trial_through(self):
+        self.open_circuit()
+        self.now += 31
+        breaker = circuit_breaker.get_breaker("gemini", "us-central1")
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # A trial call that never reached the model is given back
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+    def test_slow_calls_open_the_circuit(self):
+        self.call(seconds=30)
+        self.call(seconds=30)
+        self.call()
+        self.call()
+        self.assertEqual(self.get_state(), circuit_breaker.OPEN)
+
+    def test_open_circuit_goes_to_the_fallback_region(self):
+        circuit_breaker.circuit_fallback_location = "us-east1"
+        self.open_circuit()
+        self.assertEqual(self.call(), "us-east1")
+        self.assertEqual(self.get_state("us-east1"), circuit_breaker.CLOSED)
+        self.now += 31
+        self.assertEqual(self.call(), "us-central1")
+
+    def test_async_cancelled_trial_is_given_back(self):
+        self.open_circuit()
+        self.now += 31
+
+        async def slow(location):
+            await asyncio.sleep(5)
+
+        async def run():
+            call = asyncio.ensure_future(call_with_circuit_breaker_async("gemini", "us-central1", slow))
+            await asyncio.sleep(0.01)
+            call.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await call
+
+        asyncio.run(run())
+        self.assertEqual(self.get_state(), circuit_breaker.HALF_OPEN)
+        self.assertTrue(circuit_breaker.get_breaker("gemini", "us-central1").allow())
+
+
+class FallbackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.Mock(monotonic=lambda: self.now)
+        patchers = [
+            mock.patch.object(fallback, "time", clock),
+            mock.patch.object(retry, "time", clock),
+            mock.patch.multiple(
+                fallback,
+                model_fallbacks={"gemini-pro": ["gemini-flash", "gemini-lite"]},
+                fallback_reserve_seconds=15,
+                fallback_min_seconds=2,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.calls = []
+
+    def call(self, errors, deadline=1055.0):
+        """
+        Calls the chain of gemini-pro, where the nth model raises errors[n] if there is one.
+        """
+        def fn(model, model_deadline):
+            self.calls.append((model, model_deadline))
+            if len(self.calls) <= len(errors):
+                raise errors[len(self.calls) - 1]
+            return f"answer from {model}"
+
+        return fallback.call_with_fallback("gemini-pro", deadline, fn)
+
+    def test_falls_back_on_rejections_and_unusable_responses(self):
+        errors = [
+            RetriesExhausted("generate_content", mock.Mock(code=429), 4, 8),
+            CircuitOpen("gemini-flash", "us-central1", 30),
+        ]
+        self.assertEqual(self.call(errors), ("answer from gemini-lite", "gemini-lite"))
+        self.assertEqual([model for model, _ in self.calls], ["gemini-pro", "gemini-flash", "gemini-lite"])
+
+        self.calls.clear()
+        self.assertEqual(self.call([fallback.UnusableResponse("No candidates")]), ("answer from gemini-flash", "gemini-flash"))
+
+    def test_client_error_does_not_fall_back(self):
+        from google.genai import errors
+
+        with self.assertRaises(errors.ClientError):
+            self.call([errors.ClientError(400, {"error": {"message": "Invalid argument"}})])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_last_model_raises(self):
+        with self.assertRaises(fallback.UnusableResponse):
+            self.call([fallback.UnusableResponse("No candidates")] * 3)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_time_is_reserved_for_the_fallbacks(self):
+        self.call([fallback.UnusableResponse("No candidates")] * 2)
+        # Every model but the last leaves FALLBACK_RESERVE_SECONDS for the ones after it
+        self.assertEqual([model_deadline for _, model_deadline in self.calls], [1040.0, 1040.0, 1055.0])
+
+    def test_no_time_is_reserved_when_too_little_is_left(self):
+        self.call([], deadline=1010.0)
+        self.assertEqual(self.calls, [("gemini-pro", 1010.0)])
+
+    def test_no_fallback_without_time_left(self):
+        def fn(model, model_deadline):
+            self.calls.append(model)
+            self.now = 1054.0
+            raise fallback.UnusableResponse("No candidates")
+
+        with self.assertRaises(fallback.UnusableResponse):
+            fallback.call_with_fallback("gemini-pro", 1055.0, fn)
+        self.assertEqual(self.calls, ["gemini-pro"])
+
+    def test_async_falls_back(self):
+        async def fn(model, model_deadline):
+            self.calls.append((model, model_deadline))
+            if model == "gemini-pro":
+                raise CircuitOpen(model, "us-central1", 30)
+            return f"answer from {model}"
+
+        self.assertEqual(asyncio.run(fallback.call_with_fallback_async("gemini-pro", 1055.0, fn)), ("answer from gemini-flash", "gemini-flash"))
+        self.assertEqual(self.calls, [("gemini-pro", 1040.0), ("gemini-flash", 1040.0)])
+
+
+class RegionRouterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.open_regions = set()
+        patchers = [
+            mock.patch.multiple(
+                region_router,
+                default_regions="us-central1,europe-west4,asia-northeast1",
+                model_regions={},
+                region_ewma_alpha=0.5,
+                region_error_penalty=10,
+                region_explore_rate=0,
+                get_breaker=lambda model_name, region: mock.Mock(is_open=lambda: region in self.open_regions),
+            ),
+            mock.patch.dict(region_router._stats, clear=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def record_latencies(self, latencies):
+        for region, latency_seconds in latencies.items():
+            region_router.record("gemini", region, latency_seconds, False)
+
+    def test_moving_averages(self):
+        stats = region_router.RegionStats()
+        stats.record(1.0, False)
+        stats.record(3.0, False)
+        self.assertEqual((stats.latency, stats.error_rate), (2.0, 0.0))
+        # A failure moves the error rate, but not the latency
+        stats.record(30.0, True)
+        self.assertEqual((stats.latency, stats.error_rate, stats.calls), (2.0, 0.5, 3))
+        self.assertEqual(stats.score(), 2.0 * (1 + 10 * 0.5))
+
+    def test_chooses_the_fastest_region(self):
+        self.record_latencies({"us-central1": 2.0, "europe-west4": 1.0, "asia-northeast1": 3.0})
+        self.assertEqual(region_router.choose_region("gemini", "us-central1"), "europe-west4")
+
+    def test_regions_without_calls_are_tried_first(self):
+        self.record_latencies({"us-central1": 2.0, "europe-west4": 1.0})
+        self.assertEqual(region_router.choose_region("gemini", "us-central1"), "asia-northeast1")
+
+    def test_error_rate_outweighs_latency(self):
+        self.record_latencies({"us-central1": 2.0, "europe-west4": 1.0, "asia-northeast1": 3.0})
+        region_router.record("gemini", "europe-west4", 1.0, True)
+        self.assertEqual(region_router.choose_region("gemini", "us-central1"), "us-central1")
+
+    def test_skips_open_circuits(self):
+        self.record_latencies({"us-central1": 2.0, "europe-west4": 1.0, "asia-northeast1": 3.0})
+        self.open_regions.add("europe-west4")
+        self.assertEqual(region_router.choose_region("gemini", "us-central1"), "us-central1")
+        # With every circuit open, the first region's breaker decides
+        self.open_regions.update({"us-central1", "asia-northeast1"})
+        self.assertEqual(region_router.choose_region("gemini", "europe-west4"), "us-central1")
+
+    def test_exclude(self):
+        self.record_latencies({"us-central1": 2.0, "europe-west4": 1.0, "asia-northeast1": 3.0})
+        self.assertEqual(region_router.choose_region("gemini", "us-central1", exclude="europe-west4"), "us-central1")
+
+    def test_primary_region_without_regions(self):
+        with mock.patch.multiple(region_router, default_regions=""):
+            self.assertEqual(region_router.get_regions("gemini", "us-east4"), ["us-east4"])
+            self.assertEqual(region_router.choose_region("gemini", "us-east4"), "us-east4")
+
+    def test_model_regions_override_the_default(self):
+        with mock.patch.multiple(region_router, model_regions=region_router.parse_model_regions("gemini=us-east4|europe-west1, other=asia-south1")):
+            self.assertEqual(region_router.get_regions("gemini", "us-central1"), ["us-east4", "europe-west1"])
+            self.assertEqual(region_router.get_regions("gemini-pro", "us-central1"), ["us-central1", "europe-west4", "asia-northeast1"])
+
+
+class HedgeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = hedging.HedgeBudget(max_rate=1, window=10)
+        patchers = [
+            mock.patch.object(hedging, "get_hedge_delay", return_value=0.05),
+            mock.patch.multiple(hedging, hedge_budget=self.budget),
+            mock.patch.dict(hedging._stats, hedged=0, hedge_wins=0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_budget_limits_the_hedged_fraction(self):
+        budget = hedging.HedgeBudget(max_rate=0.5, window=4)
+        # A hedge can't be the first call
+        self.assertFalse(budget.try_hedge())
+        self.assertTrue(budget.try_hedge())
+        self.assertFalse(budget.try_hedge())
+        budget.record(False)
+        self.assertTrue(budget.try_hedge())
+        # The oldest calls leave the window
+        self.assertEqual(list(budget._decisions), [1, 0, 0, 1])
+
+    def test_hedge_fires_after_the_delay(self):
+        release_primary = threading.Event()
+        self.addCleanup(release_primary.set)
+
+        def primary():
+            release_primary.wait(5)
+            return "primary"
+
+        self.assertEqual(hedging.call_hedged(primary, lambda: "hedge", "gemini"), "hedge")
+        self.assertEqual(hedging._stats, {"hedged": 1, "hedge_wins": 1})
+
+    def test_fast_primary_is_not_hedged(self):
+        hedge = mock.Mock(return_value="hedge")
+        self.assertEqual(hedging.call_hedged(lambda: "primary", hedge, "gemini"), "primary")
+        hedge.assert_not_called()
+        self.assertEqual(hedging._stats["hedged"], 0)
+
+    def test_budget_blocks_the_hedge(self):
+        hedge = mock.Mock(return_value="hedge")
+        with mock.patch.multiple(hedging, hedge_budget=hedging.HedgeBudget(max_rate=0, window=10)):
+            self.assertEqual(hedging.call_hedged(lambda: time.sleep(0.1) or "primary", hedge, "gemini"), "primary")
+        hedge.assert_not_called()
+
+    def test_async_hedge_wins_and_the_primary_is_cancelled(self):
+        primary_cancelled = []
+
+        async def primary():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                primary_cancelled.append(True)
+                raise
+
+        async def hedge():
+            return "hedge"
+
+        async def run():
+            self.assertEqual(await hedging.call_hedged_async(primary, hedge, "gemini"), "hedge")
+            # Let the cancelled primary run its except block, before asyncio.run cancels what is left
+            await asyncio.sleep(0)
+            self.assertEqual(primary_cancelled, [True])
+
+        asyncio.run(run())
+        self.assertEqual(hedging._stats, {"hedged": 1, "hedge_wins": 1})
+
+    def test_async_budget_blocks_the_hedge(self):
+        hedge = mock.AsyncMock(return_value="hedge")
+
+        async def primary():
+            await asyncio.sleep(0.1)
+            return "primary"
+
+        with mock.patch.multiple(hedging, hedge_budget=hedging.HedgeBudget(max_rate=0, window=10)):
+            self.assertEqual(asyncio.run(hedging.call_hedged_async(primary, hedge, "gemini")), "primary")
+        hedge.assert_not_called()
+
+    def test_async_caller_cancelled_during_the_delay(self):
+        primary_cancelled = []
+
+        async def primary():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                primary_cancelled.append(True)
+                raise
+
+        async def run():
+            call = asyncio.ensure_future(hedging.call_hedged_async(primary, mock.AsyncMock(), "gemini"))
+            await asyncio.sleep(0.01)
+            call.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await call
+            await asyncio.sleep(0)
+            self.assertEqual(primary_cancelled, [True])
+
+        with mock.patch.object(hedging, "get_hedge_delay", return_value=5):
+            asyncio.run(run())
+
+
+class TracingTests(FakeVertexMixin, unittest.TestCase):
+    """
+    Sends requests through the Flask app to the offline stand-in, and checks the spans they produce.
+    """
+
+    TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+    PARENT_SPAN_ID = "00f067aa0ba902b7"
+
+    def setUp(self):
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        import main
+        import tracing
+
+        self.start_patchers([
+            mock.patch.multiple(main, project="offline", vertex_cf_auth_token="test-secret"),
+            mock.patch.multiple(tracing, _tracer=None),
+            mock.patch.multiple(retry, retry_initial_backoff_seconds=0.01, retry_max_backoff_seconds=0.02),
+            mock.patch.dict(circuit_breaker._breakers, clear=True),
+        ])
+        main.response_cache.clear()
+        self.addCleanup(main.response_cache.clear)
+
+        self.exporter = InMemorySpanExporter()
+        tracing.configure_tracing(self.exporter)
+        self.client = main.create_flask_app().test_client()
+
+    def generate(self, body):
+        request_data = json.dumps(body).encode("utf-8")
+        return self.client.post("/generate_content", data=request_data, headers={
+            "Content-Type": "application/json",
+            "X-Signature": sign(request_data, "test-secret"),
+            "traceparent": f"00-{self.TRACE_ID}-{self.PARENT_SPAN_ID}-01",
+        })
+
+    def get_spans(self, name):
+        return [span for span in self.exporter.get_finished_spans() if span.name == name]
+
+    def test_request_spans(self):
+        self.fake_vertex_config.fail_requests = 1
+        response = self.generate({"contents": "Summarize the sales trend", "parameters": {"temperature": 0}})
+        self.assertEqual(response.status_code, 200)
+
+        route_span, = self.get_spans("/generate_content")
+        # The trace goes on from the incoming traceparent
+        self.assertEqual(format(route_span.context.trace_id, "032x"), self.TRACE_ID)
+        self.assertEqual(format(route_span.parent.span_id, "016x"), self.PARENT_SPAN_ID)
+        self.assertTrue(all(format(span.context.trace_id, "032x") == self.TRACE_ID for span in self.exporter.get_finished_spans()))
+
+        for name in ("signature", "validation", "content_building", "history_window", "gemini_generate", "response_parsing"):
+            self.assertEqual(len(self.get_spans(name)), 1, name)
+        cache_span, = self.get_spans("response_cache")
+        self.assertFalse(cache_span.attributes["gemini.response_cache.hit"])
+
+        # The first attempt got a 503, and was retried after a backoff
+        upstream_spans = self.get_spans("upstream")
+        self.assertEqual(len(upstream_spans), 2)
+        self.assertEqual(upstream_spans[0].status.status_code.name, "ERROR")
+        self.assertEqual(upstream_spans[1].attributes["gen_ai.request.model"], "gemini-2.0-flash-exp")
+        backoff_span, = self.get_spans("retry_backoff")
+        self.assertEqual(backoff_span.attributes["gemini.retry.attempt"], 1)
+        gemini_generate_span, = self.get_spans("gemini_generate")
+        self.assertTrue(all(span.parent.span_id == gemini_generate_span.context.span_id for span in [*upstream_spans, backoff_span]))
+
+    def test_cached_response_skips_the_upstream_call(self):
+        body = {"contents": "Summarize the sales trend", "parameters": {"temperature": 0}}
+        first_response = self.generate(body)
+        self.exporter.clear()
+        second_response = self.generate(body)
+
+        self.assertEqual(second_response.get_json(), first_response.get_json())
+        cache_span, = self.get_spans("response_cache")
+        self.assertTrue(cache_span.attributes["gemini.response_cache.hit"])
+        self.assertEqual(self.get_spans("upstream"), [])
+
+    def test_fallback_answer_is_not_cached(self):
+        body = {"contents": "Summarize the sales trend", "parameters": {"temperature": 0}}
+        self.fake_vertex_config.fail_requests = 1
+        with mock.patch.multiple(retry, retry_max_attempts=1), mock.patch.multiple(fallback, model_fallbacks={"gemini-2.0-flash-exp": ["gemini-1.5-flash"]}):
+            response = self.generate(body)
+        self.assertEqual(response.headers["X-Model-Name"], "gemini-1.5-flash")
+
+        self.exporter.clear()
+        response = self.generate(body)
+        self.assertEqual(response.headers["X-Model-Name"], "gemini-2.0-flash-exp")
+        cache_span, = self.get_spans("response_cache")
+        self.assertFalse(cache_span.attributes["gemini.response_cache.hit"])
+
+
+class OfflineBackendTests(FakeVertexMixin, LiveBackendTests):
+    """
+    Runs the live backend tests against the Flask app and the offline stand-in for Vertex AI, in this process.
+    """
+
+    @classmethod
+    def get_fake_vertex_config(cls):
+        return FakeVertexConfig(latency="fixed:5", chunk_latency="fixed:5")
+
+    @classmethod
+    def setUpClass(cls):
+        from werkzeug.serving import make_server
+        import main
+        import sessions
+
+        super().setUpClass()
+        cls.secret_key = "offline-secret"
+        # Started for the whole class, since the backend serves every test
+        cls.patchers = [
+            *cls.get_fake_vertex_patchers(),
+            mock.patch.multiple(main, project="offline", vertex_cf_auth_token=cls.secret_key),
+            mock.patch.object(sessions, "vertex_cf_auth_token", cls.secret_key),
+        ]
+        for patcher in cls.patchers:
+            patcher.start()
+
+        cls.backend = make_server("127.0.0.1", 0, main.create_flask_app(), threaded=True)
+        threading.Thread(target=cls.backend.serve_forever, daemon=True).start()
+        cls.backend_url = f"http://127.0.0.1:{cls.backend.server_port}"
+        cls.generate_content_url = f"{cls.backend_url}/generate_content"
+        cls.stream_generate_content_url = f"{cls.backend_url}/stream_generate_content"
+        cls.batch_generate_content_url = f"{cls.backend_url}/batch_generate_content"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.shutdown()
+        for patcher in reversed(cls.patchers):
+            patcher.stop()
+        super().tearDownClass()
+
+
+class AsgiTests(FakeVertexMixin, unittest.TestCase):
+    """
+    Sends requests through the Starlette app to the offline stand-in.
+    """
+
+    def setUp(self):
+        from starlette.testclient import TestClient
+        import asgi
+        import main
+
+        self.start_patchers([
+            mock.patch.multiple(main, project="offline", vertex_cf_auth_token="test-secret"),
+            mock.patch.multiple(asgi, warm_up_on_start=False),
+            mock.patch.dict(circuit_breaker._breakers, clear=True),
+        ])
+        main.response_cache.clear()
+        self.addCleanup(main.response_cache.clear)
+
+        # Entered, so every request runs on the same event loop as the pooled async clients
+        self.client = TestClient(asgi.create_asgi_app())
+        self.client.__enter__()
+        self.addCleanup(self.client.__exit__, None, None, None)
+
+    def post(self, path, body, secret="test-secret"):
+        request_data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        return self.client.post(path, content=request_data, headers={
+            "Content-Type": "application/json",
+            "X-Signature": sign(request_data, secret),
+        })
+
+    def test_generate_content(self):
+        response = self.post("/generate_content", {"contents": "Summarize the sales trend"})
+        self.assertEqual(response.status_code, 200)
+        assert_non_zero_text_parts(self, response)
+        self.assertEqual(response.headers["X-Model-Name"], "gemini-2.0-flash-exp")
+
+    def test_stream_generate_content(self):
+        response = self.post("/stream_generate_content", {"contents": "Summarize the sales trend"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/event-stream"))
+        events = [line.split(": ", 1)[1] for line in response.text.splitlines() if line.startswith("event: ")]
+        self.assertIn("text", events)
+        self.assertEqual(events[-1], "usage")
+
+    def test_batch_generate_content(self):
+        response = self.post("/batch_generate_content", {"requests": [{"contents": "Summarize the sales trend"}, {"history": "not a list"}]})
+        self.assertEqual(response.status_code, 200)
+        first_result, second_result = response.json()
+        self.assertEqual(first_result["status"], 200)
+        self.assertEqual(first_result["model_name"], "gemini-2.0-flash-exp")
+        self.assertEqual(second_result["status"], 400)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post("/generate_content", {"contents": "Hello"}, secret="wrong-secret").status_code, 403)
+        self.assertEqual(self.post("/generate_content", b"{not json").status_code, 400)
+        self.assertEqual(self.post("/generate_content", {"history": "not a list"}).status_code, 400)
+        self.assertEqual(self.post("/batch_generate_content", {"requests": []}).status_code, 400)
+
+    def test_metrics_require_signature(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        response = self.client.get("/metrics", headers={"X-Signature": sign(b"", "test-secret")})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("gemini_backend_requests_total", response.text)
+
+    def test_rejected_requests(self):
+        import asgi
+
+        with mock.patch.object(asgi, "gemini_generate_async_with_model", side_effect=AdmissionRejected("gemini-2.0-flash-exp", "queue is full")):
+            response = self.post("/generate_content", {"contents": "Hello"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+
+        async def rejected_events(**generate_args):
+            raise AdmissionRejected("gemini-2.0-flash-exp", "queue is full")
+            yield
+
+        with mock.patch.object(asgi, "gemini_generate_stream_async", rejected_events):
+            response = self.post("/stream_generate_content", {"contents": "Hello"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+
+        with mock.patch.object(asgi, "gemini_generate_async_with_model", side_effect=CircuitOpen("gemini-2.0-flash-exp", "us-central1", 7)):
+            response = self.post("/generate_content", {"contents": "Hello"})
+            batch_response = self.post("/batch_generate_content", {"requests": [{"contents": "Hello"}]})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "7")
+        self.assertEqual(batch_response.json(), [{"status": 503, "error": str(CircuitOpen("gemini-2.0-flash-exp", "us-central1", 7)), "retry_after": 7}])
+
+
+class StreamEventsTests(unittest.TestCase):
+    """
+    Checks that a stream is only answered with 200 once its first event is ready.
+    """
+
+    def test_error_before_the_first_event_is_raised(self):
+        import main
+
+        def events():
+            raise AdmissionRejected("gemini-2.0-flash-exp", "queue is full")
+            yield
+
+        with self.assertRaises(AdmissionRejected):
+            main.stream_events(events())
+
+    def test_error_after_the_first_event_is_streamed(self):
+        import main
+
+        def events():
+            yield "text", {"text": "Hello"}
+            raise RuntimeError("stream broke")
+
+        body = list(main.stream_events(events()))
+        self.assertEqual(body, [main.format_sse_event("text", {"text": "Hello"}), main.format_sse_event("error", {"error": "stream broke"})])
+
+    def test_async_error_before_the_first_event_is_raised(self):
+        import asgi
+
+        async def events():
+            raise CircuitOpen("gemini-2.0-flash-exp", "us-central1", 7)
+            yield
+
+        with self.assertRaises(CircuitOpen):
+            asyncio.run(asgi.stream_events(events()))
+
+    def test_async_error_after_the_first_event_is_streamed(self):
+        import asgi
+        import main
+
+        async def events():
+            yield "text", {"text": "Hello"}
+            raise RuntimeError("stream broke")
+
+        async def read():
+            return [chunk async for chunk in await asgi.stream_events(events())]
+
+        self.assertEqual(asyncio.run(read()), [main.format_sse_event("text", {"text": "Hello"}), main.format_sse_event("error", {"error": "stream broke"})])
+
+
+class BatchDeadlineTests(unittest.TestCase):
+    """
+    Checks that the requests of a batch share one deadline.
+    """
+
+    def setUp(self):
+        import asgi
+        import main
+
+        patchers = [
+            mock.patch.multiple(retry, request_timeout_seconds=0.2),
+            mock.patch.multiple(main, batch_max_parallelism=1),
+            mock.patch.multiple(asgi, batch_max_parallelism=1),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.batch_items = [({"contents": "Hello", "session_id": None}, None), ({"contents": "Hello again", "session_id": None}, None)]
+        self.deadlines = []
+
+    def test_requests_after_the_deadline_fail(self):
+        import main
+
+        def generate(deadline, **generate_args):
+            self.deadlines.append(deadline)
+            time.sleep(0.3)
+            return [{"text": "Hi"}], "gemini-2.0-flash-exp", {}
+
+        with mock.patch.object(main, "gemini_generate_with_model", generate):
+            first_result, second_result = main.gemini_generate_batch(self.batch_items)
+        self.assertEqual(first_result["status"], 200)
+        self.assertEqual(second_result, main.get_batch_item_timeout())
+        self.assertEqual(len(self.deadlines), 1)
+
+    def test_async_requests_after_the_deadline_fail(self):
+        import asgi
+        import main
+
+        async def generate(deadline, **generate_args):
+            self.deadlines.append(deadline)
+            await asyncio.sleep(0.3)
+            return [{"text": "Hi"}], "gemini-2.0-flash-exp", {}
+
+        with mock.patch.object(asgi, "gemini_generate_async_with_model", generate):
+            first_result, second_result = asyncio.run(asgi.gemini_generate_batch(self.batch_items))
+        self.assertEqual(first_result["status"], 200)
+        self.assertEqual(second_result, main.get_batch_item_timeout())
+        self.assertEqual(len(self.deadlines), 1)
+
+    def test_requests_share_the_deadline(self):
+        import main
+
+        def generate(deadline, **generate_args):
+            self.deadlines.append(deadline)
+            return [{"text": "Hi"}], "gemini-2.0-flash-exp", {}
+
+        with mock.patch.object(main, "gemini_generate_with_model", generate):
+            results = main.gemini_generate_batch(self.batch_items)
+        self.assertEqual([result["status"] for result in results], [200, 200])
+        self.assertEqual(len(set(self.deadlines)), 1)
+
+
+class IngestTests(unittest.TestCase):
+    """
+    Checks that request bodies are size checked and signed before they are parsed.
+    """
+
+    def setUp(self):
+        import asgi
+        import main
+
+        patchers = [
+            mock.patch.multiple(main, max_request_bytes=100, vertex_cf_auth_token="test-secret"),
+            mock.patch.multiple(asgi, max_request_bytes=100),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = main.create_flask_app().test_client()
+
+    def post(self, body, signature=None):
+        return self.client.post("/generate_content", data=body, headers={
+            "Content-Type": "application/json",
+            "X-Signature": signature or sign(body, "test-secret"),
+        })
+
+    def test_declared_body_too_large(self):
+        response = self.post(json.dumps({"contents": "x" * 200}).encode("utf-8"))
+        self.assertEqual(response.status_code, 413)
+
+    def test_body_larger_than_its_content_length(self):
+        import asgi
+        import main
+
+        body = json.dumps({"contents": "x" * 200}).encode("utf-8")
+        flask_request = mock.Mock(headers={"X-Signature": sign(body, "test-secret")}, content_length=10, stream=io.BytesIO(body))
+        _, error_response = main.ingest_request(flask_request)
+        self.assertEqual(error_response[1], 413)
+
+        async def stream():
+            for start in range(0, len(body), 50):
+                yield body[start:start + 50]
+
+        asgi_request = mock.Mock(headers={"Content-Length": "10", "X-Signature": sign(body, "test-secret")}, stream=stream)
+        _, error_response = asyncio.run(asgi.ingest_request(asgi_request))
+        self.assertEqual(error_response[1], 413)
+
+    def test_bad_signature_is_rejected_before_parsing(self):
+        import main
+
+        body = json.dumps({"contents": "Hello"}).encode("utf-8")
+        with mock.patch.object(main, "json", wraps=json) as json_module:
+            response = self.post(body, signature=sign(body, "wrong-secret"))
+        self.assertEqual(response.status_code, 403)
+        json_module.loads.assert_not_called()
+
+    def test_invalid_json_with_a_valid_signature(self):
+        response = self.post(b"{not json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {"error": "Invalid JSON body"})
+
+
+class DeferredWarmUpTests(unittest.TestCase):
+
+    def setUp(self):
+        self.warm_up = mock.Mock()
+        patchers = [
+            mock.patch.multiple(client_pool, warm_up=self.warm_up, _warm_up_args=None, _warm_up_thread=None, _refresher=None, _warm_up_retry_at=0.0),
+            # The fork hook drops the clients and resets the status of this process
+            mock.patch.dict(client_pool._clients),
+            mock.patch.dict(client_pool._warm_up_status),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_deferred_warm_up_starts_once_without_a_fork(self):
+        client_pool.defer_warm_up("offline", "us-central1", "gemini")
+        self.assertIsNone(client_pool._warm_up_thread)
+        client_pool.start_deferred_warm_up()
+        client_pool.start_deferred_warm_up()
+        client_pool._warm_up_thread.join()
+        self.warm_up.assert_called_once_with("offline", "us-central1", "gemini")
+
+    def test_deferred_warm_up_starts_in_the_forked_worker(self):
+        client_pool.defer_warm_up("offline", "us-central1", None)
+        # The hooks os.register_at_fork runs around a fork
+        client_pool._before_fork()
+        client_pool._after_fork_in_child()
+        client_pool._warm_up_thread.join()
+        self.warm_up.assert_called_once_with("offline", "us-central1", None)
+        client_pool.start_deferred_warm_up()
+        self.assertEqual(self.warm_up.call_count, 1)
+
+    def test_readiness_retries_a_failed_warm_up(self):
+        import main
+
+        self.now = 1000.0
+        client_pool._warm_up_status.update(state="failed", error="Could not fetch an access token")
+        with mock.patch.object(client_pool, "time", mock.Mock(monotonic=lambda: self.now)), mock.patch.multiple(client_pool, warm_up_retry_seconds=30):
+            _, status_code = main.get_readiness()
+            self.assertEqual(status_code, 503)
+            client_pool._warm_up_thread.join()
+            self.assertEqual(self.warm_up.call_count, 1)
+
+            # Not again until warm_up_retry_seconds have passed
+            self.now = 1029.0
+            main.get_readiness()
+            self.assertEqual(self.warm_up.call_count, 1)
+            self.now = 1030.0
+            main.get_readiness()
+            client_pool._warm_up_thread.join()
+            self.assertEqual(self.warm_up.call_count, 2)
+
+            # Nothing to retry once it succeeded
+            client_pool._warm_up_status.update(state="ready", error=None)
+            self.now = 2000.0
+            _, status_code = main.get_readiness()
+            self.assertEqual(status_code, 200)
+            self.assertEqual(self.warm_up.call_count, 2)
+
+
+class ContextCacheTests(FakeVertexMixin, unittest.TestCase):
+    """
+    Caches the prefixes of requests with the offline stand-in's cachedContents endpoints.
+    """
+
+    def setUp(self):
+        from google.genai import types
+
+        self.registry = context_cache.ContextCacheRegistry(max_entries=10, ttl_seconds=3600, min_tokens=50, min_requests=2)
+        self.start_patchers([mock.patch.multiple(context_cache, context_cache=self.registry, context_cache_mode="auto")])
+
+        self.client = client_pool.get_client("offline", "us-central1")
+        self.config = types.GenerateContentConfig(system_instruction="You answer questions about the sales of the last year. " * 10)
+        self.contents = [
+            types.Content(role="user", parts=[types.Part(text="Which region sold the most?")]),
+            types.Content(role="model", parts=[types.Part(text="The west region sold the most.")]),
+            types.Content(role="user", parts=[types.Part(text="And in the last quarter?")]),
+        ]
+
+    def generate(self, request_contents=None):
+        calls = []
+
+        def fn(request_contents, request_config):
+            calls.append(request_config.cached_content)
+            return self.client.models.generate_content(model="gemini-1.5-flash", contents=request_contents, config=request_config)
+
+        contents = request_contents or self.contents
+        prefix_hashes = context_cache.get_prefix_hashes(self.config, contents)
+        response = context_cache.call_with_context_cache(self.client, "gemini-1.5-flash", "us-central1", self.config, contents, prefix_hashes, fn)
+        return response, calls
+
+    def cache_prefix(self):
+        self.generate()
+        self.generate()
+        wait_until(lambda: self.registry.stats()["creations"] == 1)
+
+    def test_prefixes_are_hashed_once_for_every_region(self):
+        prefix_hashes = context_cache.hash_prefixes(self.config, self.contents, 50)
+        self.assertEqual([content_count for _, content_count, _ in prefix_hashes], [2, 0])
+        central_prefixes = context_cache.get_prefixes("gemini-1.5-flash", "us-central1", prefix_hashes)
+        east_prefixes = context_cache.get_prefixes("gemini-1.5-flash", "us-east1", prefix_hashes)
+        self.assertTrue(all(central.key != east.key for central, east in zip(central_prefixes, east_prefixes)))
+        self.assertEqual([prefix.token_count for prefix in central_prefixes], [prefix.token_count for prefix in east_prefixes])
+
+    def test_small_requests_are_not_hashed(self):
+        self.assertEqual(context_cache.hash_prefixes(self.config, self.contents, 100000), [])
+
+    def test_repeated_prefix_is_cached(self):
+        self.cache_prefix()
+        response, calls = self.generate()
+        self.assertEqual(len(calls), 1)
+        self.assertIsNotNone(calls[0])
+        self.assertGreater(response.usage_metadata.cached_content_token_count, 0)
+        self.assertEqual(self.registry.stats()["hits"], 1)
+
+    def test_gone_cache_is_sent_uncached(self):
+        self.cache_prefix()
+        handle = next(iter(self.registry._handles.values()))
+        self.client.caches.delete(name=handle.name)
+
+        response, calls = self.generate()
+        self.assertEqual(calls, [handle.name, None])
+        self.assertIsNone(response.usage_metadata.cached_content_token_count)
+        self.assertEqual(self.registry.stats()["invalidations"], 1)
+
+    def test_other_client_errors_keep_the_cache(self):
+        from google.genai import errors
+
+        self.cache_prefix()
+
+        def fn(request_contents, request_config):
+            raise errors.ClientError(400, {"error": {"code": 400, "message": "Invalid value at 'temperature'", "status": "INVALID_ARGUMENT"}})
+
+        prefix_hashes = context_cache.get_prefix_hashes(self.config, self.contents)
+        with self.assertRaises(errors.ClientError):
+            context_cache.call_with_context_cache(self.client, "gemini-1.5-flash", "us-central1", self.config, self.contents, prefix_hashes, fn)
+        self.assertEqual(self.registry.stats()["invalidations"], 0)
+
+    def test_cache_gone_errors(self):
+        from google.genai import errors
+
+        def get_error(code, message):
+            return errors.ClientError(code, {"error": {"code": code, "message": message, "status": "FAILED_PRECONDITION"}})
+
+        self.assertTrue(context_cache.is_cache_gone_error(get_error(404, "Not found")))
+        self.assertTrue(context_cache.is_cache_gone_error(get_error(403, "Permission denied on CachedContent projects/offline")))
+        self.assertTrue(context_cache.is_cache_gone_error(get_error(400, "The cached content has expired")))
+        self.assertFalse(context_cache.is_cache_gone_error(get_error(403, "Permission denied on resource project offline")))
+        self.assertFalse(context_cache.is_cache_gone_error(get_error(400, "Request contains an invalid argument")))
+
+
+class HistoryWindowTests(unittest.TestCase):
+
+    def setUp(self):
+        from google.genai import types
+
+        self.types = types
+        # Three turns, the second with a function call and its response
+        self.contents = [
+            self.text("user", "Which explores are there?"),
+            self.text("model", "Orders and users."),
+            self.text("user", "What were the sales in California?"),
+            types.Content(role="model", parts=[types.Part.from_function_call(name="run_query", args={"state": "CA"})]),
+            types.Content(role="user", parts=[types.Part.from_function_response(name="run_query", response={"rows": ["x" * 400]})]),
+            self.text("model", "Sales in California were $1.2M."),
+            self.text("user", "And in Texas?"),
+        ]
+
+    def text(self, role, text):
+        return self.types.Content(role=role, parts=[self.types.Part(text=text)])
+
+    def get_policy(self, **overrides):
+        return {**history_window.get_history_policy(), "summarize": False, **overrides}
+
+    def test_short_history_passes_through(self):
+        for policy in (self.get_policy(mode="off"), self.get_policy(mode="turns", max_turns=3), self.get_policy(mode="tokens", token_budget=10000)):
+            self.assertEqual(history_window.window_contents(self.contents, policy), (self.contents, []))
+        self.assertEqual(history_window.window_contents([], self.get_policy(mode="turns", max_turns=1)), ([], []))
+
+    def test_turns(self):
+        kept, dropped = history_window.window_contents(self.contents, self.get_policy(mode="turns", max_turns=2))
+        self.assertEqual((kept, dropped), (self.contents[2:], self.contents[:2]))
+
+    def test_function_call_and_response_are_kept_together(self):
+        for max_turns in (1, 2):
+            kept, dropped = history_window.window_contents(self.contents, self.get_policy(mode="turns", max_turns=max_turns))
+            self.assertTrue(history_window.is_turn_start(kept[0]))
+            calls = [content for content in kept if content.parts[0].function_call]
+            responses = [content for content in kept if content.parts[0].function_response]
+            self.assertEqual(len(calls), len(responses))
+
+        # The function response alone would fit in the budget, but not with the rest of its turn
+        last_turn_tokens = history_window.estimate_tokens(self.contents[-1])
+        response_tokens = history_window.estimate_tokens(self.contents[4])
+        kept, dropped = history_window.window_contents(self.contents, self.get_policy(mode="tokens", token_budget=last_turn_tokens + response_tokens))
+        self.assertEqual(kept, self.contents[-1:])
+
+    def test_token_budget_is_respected(self):
+        for token_budget in range(1, 250, 7):
+            kept, _ = history_window.window_contents(self.contents, self.get_policy(mode="tokens", token_budget=token_budget))
+            # The last turn, with the request's own message, is kept whatever its size
+            if len(kept) > 1:
+                self.assertLessEqual(sum(history_window.estimate_tokens(content) for content in kept), token_budget)
+            self.assertEqual(kept[-1], self.contents[-1])
+
+    def test_summary_replaces_the_dropped_turns(self):
+        import main
+
+        policy = self.get_policy(mode="turns", max_turns=2, summarize=True)
+        key, _, _ = history_window.get_summary_request(self.contents[:2])
+        summary_cache = ResponseCache(max_entries=10, max_bytes=1024, ttl_seconds=60)
+        summary_cache.put(key, "The user asked which explores there are.")
+        with mock.patch.multiple(main, summary_cache=summary_cache):
+            windowed = main.window_history(self.contents, policy, get_deadline())
+
+        self.assertEqual(len(windowed), len(self.contents) - 2)
+        self.assertEqual(windowed[0].role, "user")
+        self.assertEqual(windowed[0].parts[0].text, history_window.SUMMARY_PREFIX + "The user asked which explores there are.")
+        self.assertEqual(windowed[0].parts[1:], self.contents[2].parts)
+        self.assertEqual(windowed[1:], self.contents[3:])
+
+    def test_no_summary_when_nothing_is_dropped(self):
+        import main
+
+        with mock.patch.object(main, "get_client") as get_client:
+            windowed = main.window_history(self.contents, self.get_policy(mode="turns", max_turns=3, summarize=True), get_deadline())
+        self.assertEqual(windowed, self.contents)
+        get_client.assert_not_called()
+
+
+class PromptRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, "templates.json"), "w") as f:
+            json.dump({"templates": [{
+                "id": "explore",
+                "system_instruction": "You answer questions about the ${model} model. Prices are in $$.",
+                "contents": "$question",
+            }]}, f)
+        self.registry = PromptRegistry([FileLoader(directory.name)], reload_seconds=300, max_entries=10)
+
+    def test_render_with_variables(self):
+        reference = self.registry.resolve({"id": "explore", "variables": {"model": "ecommerce", "question": "Top products?"}})
+        rendered = self.registry.render(reference)
+        self.assertEqual(rendered.system_instruction, "You answer questions about the ecommerce model. Prices are in $.")
+        self.assertEqual(rendered.contents, "Top products?")
+
+    def test_missing_variables(self):
+        with self.assertRaises(PromptTemplateError) as raised:
+            self.registry.resolve({"id": "explore", "variables": {"model": "ecommerce"}})
+        self.assertIn("question", str(raised.exception))
+
+    def test_system_instruction_is_rendered_once(self):
+        for question in ("Top products?", "Top regions?"):
+            self.registry.render(self.registry.resolve({"id": "explore", "variables": {"model": "ecommerce", "question": question}}))
+        # The system instruction only uses model, so the second question reuses it
+        self.assertEqual((self.registry.hits, self.registry.misses), (1, 3))
+
+
+class ExampleSelectorTests(FakeVertexMixin, unittest.TestCase):
+    """
+    Builds example banks with the offline stand-in's embeddings.
+    """
+
+    def setUp(self):
+        self.start_patchers()
+        self.client = client_pool.get_client("offline", "us-central1")
+
+    def get_example_contents(self, inputs):
+        return get_example_contents([{"input": text, "output": f"SELECT '{text}'"} for text in inputs])
+
+    def get_bank(self, selector, example_contents):
+        if selector.get_bank(self.client, "sales", 1, example_contents) is None:
+            wait_until(lambda: selector.get_bank(self.client, "sales", 1, example_contents) is not None)
+        return selector.get_bank(self.client, "sales", 1, example_contents)
+
+    def test_top_k_returns_the_most_similar_last(self):
+        matrix = normalize([[1, 0], [0, 1], [1, 1], [-1, 0]])
+        query = normalize([1, 0.1])
+        self.assertEqual(list(top_k(matrix, query, 2)), [2, 0])
+        self.assertEqual(list(top_k(matrix, query, 10)), [3, 1, 2, 0])
+
+    def test_bank_selects_similar_examples(self):
+        selector = ExampleSelector(None, 10)
+        inputs = ["total sales by region", "top customers this year", "average order value by month"]
+        bank = self.get_bank(selector, self.get_example_contents(inputs))
+        self.assertEqual(bank.shape[0], 3)
+
+        response = self.client.models.embed_content(model="text-embedding-005", contents=["sales by region"], config=get_embedding_config())
+        query = selector.put_query_embedding("sales by region", response.embeddings[0].values)
+        self.assertEqual(inputs[top_k(bank, query, 1)[-1]], "total sales by region")
+        self.assertIs(selector.get_query_embedding("sales by region"), query)
+
+    def test_changed_examples_get_a_new_bank(self):
+        selector = ExampleSelector(None, 10)
+        self.assertEqual(self.get_bank(selector, self.get_example_contents(["total sales", "top customers"])).shape[0], 2)
+        # Same id and version, as when a BigQuery table changes between loads
+        self.assertEqual(self.get_bank(selector, self.get_example_contents(["total sales", "top customers", "orders by month"])).shape[0], 3)
+        self.assertEqual(selector.stats()["banks"], 1)
+
+    def test_select_examples_with_the_request_timeout(self):
+        import main
+
+        inputs = ["total sales by region", "top customers this year", "average order value by month"]
+        example_contents = self.get_example_contents(inputs)
+        template = {"examples": "sales", "examples_version": 1, "example_count": 1}
+        selector = ExampleSelector(None, 10)
+        self.get_bank(selector, example_contents)
+
+        with (
+            mock.patch.multiple(main, example_selector=selector, project="offline", location="us-central1"),
+            mock.patch.object(self.client.models, "embed_content", wraps=self.client.models.embed_content) as embed_content,
+        ):
+            selected = main.select_examples(template, "sales by region", example_contents, time.monotonic() + 10)
+
+        self.assertEqual(selected, example_contents[0:2])
+        timeout = embed_content.call_args_list[0].kwargs["config"].http_options.timeout
+        self.assertTrue(9000 <= timeout <= 10000)
+
+    def test_select_examples_async(self):
+        import main
+
+        example_contents = self.get_example_contents(["total sales by region", "top customers this year", "average order value by month"])
+        template = {"examples": "sales", "examples_version": 1, "example_count": 1}
+        selector = ExampleSelector(None, 10)
+        self.get_bank(selector, example_contents)
+
+        with mock.patch.multiple(main, example_selector=selector, project="offline", location="us-central1"):
+            selected = asyncio.run(main.select_examples_async(template, "best customers", example_contents, time.monotonic() + 10))
+        self.assertEqual(selected, example_contents[2:4])
+
+    def test_saved_bank_is_reused(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        example_contents = self.get_example_contents(["total sales", "top customers"])
+        bank = self.get_bank(ExampleSelector(directory.name, 10), example_contents)
+        self.assertEqual(len(os.listdir(directory.name)), 1)
+
+        # Another worker maps the saved file instead of embedding the examples again
+        with mock.patch.object(ExampleSelector, "_embed", side_effect=AssertionError("embedded again")):
+            saved_bank = self.get_bank(ExampleSelector(directory.name, 10), example_contents)
+        self.assertEqual(saved_bank.tolist(), bank.tolist())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,166 @@
+import contextlib
+import functools
+import inspect
+import logging
+import os
+
+from flask import request
+
+
+# Where spans are sent: "otlp" to OTEL_EXPORTER_OTLP_ENDPOINT, "console" to stdout, "file" to TRACING_FILE.
+# Tracing is off when this isn't set, or when the OpenTelemetry SDK isn't installed.
+tracing_exporter = os.environ.get("TRACING_EXPORTER", "")
+tracing_file = os.environ.get("TRACING_FILE", "spans.jsonl")
+service_name = os.environ.get("OTEL_SERVICE_NAME", "gemini-backend")
+
+_tracer = None
+# The OpenTelemetry modules, only imported once tracing is configured
+propagate = None
+trace = None
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+
+def _get_exporter(name):
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    if name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "file":
+        return ConsoleSpanExporter(out=open(tracing_file, "a"), formatter=lambda span: span.to_json(indent=None) + "\n")
+    raise ValueError(f"Unknown TRACING_EXPORTER: {name}")
+
+
+def configure_tracing(exporter=None):
+    """
+    Starts sending spans to the exporter, or to the one chosen by TRACING_EXPORTER.
+    Tests can pass an InMemorySpanExporter to collect the spans of a request.
+    """
+    global _tracer, propagate, trace
+    try:
+        from opentelemetry import propagate, trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+    except ImportError:
+        logging.warning("Tracing is enabled, but the OpenTelemetry SDK isn't installed")
+        return
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    if exporter is None:
+        # Network exports are batched off the request path
+        processor_class = BatchSpanProcessor if tracing_exporter == "otlp" else SimpleSpanProcessor
+        provider.add_span_processor(processor_class(_get_exporter(tracing_exporter)))
+    else:
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+    _tracer = provider.get_tracer("gemini-backend")
+
+
+@contextlib.contextmanager
+def start_span(name, attributes=None, context=None, kind=None):
+    """
+    Runs the block in a span that is a child of the current span, or of context when given.
+    Yields a span that ignores its attributes when tracing is off.
+    """
+    if _tracer is None:
+        yield _noop_span
+        return
+
+    with _tracer.start_as_current_span(name, context=context, kind=kind or trace.SpanKind.INTERNAL, attributes=attributes) as span:
+        yield span
+
+
+def set_span_attributes(attributes):
+    """
+    Adds attributes to the current span. None values are left out.
+    """
+    if _tracer is None:
+        return
+    trace.get_current_span().set_attributes({key: value for key, value in attributes.items() if value is not None})
+
+
+def start_request_span(name, headers):
+    """
+    Starts the span of an incoming request, continuing the trace in its traceparent header if there is one.
+    """
+    if _tracer is None:
+        return start_span(name)
+    return start_span(name, context=propagate.extract(headers), kind=trace.SpanKind.SERVER)
+
+
+def trace_route(route):
+    """
+    Runs a Flask view in a request span. route is the span name, or a function returning it from the request.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with start_request_span(route(request) if callable(route) else route, request.headers):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_route_async(route):
+    """
+    Runs an ASGI endpoint in a request span.
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            with start_request_span(route, request.headers):
+                return await endpoint(request)
+        return wrapper
+    return decorator
+
+
+def traced(name):
+    """
+    Runs every call of the function, sync or async, in a span.
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with start_span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with start_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_request_attributes(model_name, history, content_list):
+    return {
+        "gen_ai.request.model": model_name,
+        "gemini.history_length": len(history),
+        "gemini.part_count": sum(len(content.parts or []) for content in content_list),
+    }
+
+
+def get_usage_attributes(usage):
+    return {
+        "gen_ai.usage.input_tokens": usage.get("prompt_token_count"),
+        "gen_ai.usage.output_tokens": usage.get("candidates_token_count"),
+        "gen_ai.usage.cache_read.input_tokens": usage.get("cached_content_token_count"),
+    }
+
+
+if tracing_exporter:
+    configure_tracing()